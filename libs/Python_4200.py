@@ -1,15 +1,29 @@
 import matplotlib.pyplot as plt
 import csv
+import numpy as np
 import visa
 import serial
 
+from libs import aio
 from libs import cm110
+from libs import continuous
+from libs import datafile
+from libs import discovery
 from libs import ki4200
+from libs import liveplot
+from libs import planner
+from libs import renderer
+from libs import results
 from libs import shutter
+from libs import sampler
+from libs import sessions
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from serial.tools import list_ports
 from IPython import display
 from math import log10, floor
-from time import sleep, strftime
+from threading import get_ident
+from time import monotonic, sleep, strftime
 from os import path, getcwd, makedirs
 from re import sub
 
@@ -30,14 +44,34 @@ class K4200_test(object):
     Contains general methods that can be used to set up any of the three types
     of capacitance tests. Is the parent class for the more specific CV, CF, and
     CT classes defined below
+
+    All instrument sessions are opened through rm, serial_class and comports,
+    which default to the real VISA and pyserial backends. These can be swapped
+    for a simulated bench with simulator.sim_bench.install().
+
+    With keep_sessions set, sessions are kept open in pool between tests and
+    reused (see sessions.py), holding the COM ports and GPIB sessions until
+    close_sessions() closes them all. Otherwise every test opens its own and
+    closes them when it finishes.
     ---------------------------------------------------------------------------
     """
     rm = visa.ResourceManager()
+    serial_class = serial.Serial
+    comports = staticmethod(list_ports.comports)
+    pool = sessions.session_pool()
+    keep_sessions = False
+    # next to the libs folder, whatever the notebook's working directory
+    discovery_cache = path.join(path.dirname(path.dirname(
+        path.abspath(__file__))), "discovery.json")
+    probe_timeout = 3
+    id_timeout = 1000
     ls331_address = "GPIB0::1::INSTR"
     k4200_address = "GPIB0::17::INSTR"
     lia5302_address = "GPIB0::12::INSTR"
     mono_port = ""
     shutter_port = ""
+    mono_framed = True
+    shutter_travel = 0.9
     cust_name = ""
     run_all = False
     last_test = "_"
@@ -45,6 +79,45 @@ class K4200_test(object):
     lia_mag = 0
     lia_pha = 0
     running = False
+    pipelined = False
+    sample_aux = False
+    use_asyncio = False
+    plot_thread = None
+    sampler = None
+    aux_dropped = None
+    pipeline_depth = 4
+    worker = None
+    bulk_read = True
+    reader = None
+    stream_csv = True
+    stream = None
+    save_binary = True
+    plot_interval = 1
+    live = None
+    use_renderer = False
+    renderer = None
+    export_svg = False
+    sigma_clip = None
+    keep_raw = False
+    save_sem = True
+    sem_target = None
+    sem_of = "primary"
+    min_repetitions = 2
+    max_repetitions = 10
+    repeats = None
+    fine_step = None
+    refine_threshold = 0.05
+    refine_method = "gradient"
+    refine_of = "primary"
+    scan_budget = None
+    max_wavelengths = None
+    planner = None
+    mirror_state = False
+    descending = False
+    figure_num = 1
+    interleave = False
+    scan_speed = None
+    scan_samples = None
 
     def __init__(self, **kwargs):
         for name, value in kwargs.items():
@@ -203,19 +276,48 @@ class K4200_test(object):
         except:
             self.repetitions = int(input("Enter No. or repetitions: "))
 
-    def com_discovery(self, *args):
+    def set_adaptive(self, target=None, minimum=2, maximum=10, of="primary"):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: set_adaptive
+        INPUTS: self, target (float) --> None
+                minimum, maximum (int) --> 2, 10
+                of (str) --> "primary"
+        RETURNS: nothing
+        DEPENDENCIES: none
+        ------------------------------------------------------------------------
+        Makes multi sweeps repeat each wavelength until the standard error of
+        the primary values (or of the LIA magnitude, with of="magnitude") is
+        at most target, as a fraction of the largest value, taking between
+        minimum and maximum repetitions. A target of None goes back to the
+        fixed number set by set_repetitions.
+        ------------------------------------------------------------------------
+        """
+        if of not in ("primary", "magnitude"):
+            raise ValueError("of must be 'primary' or 'magnitude'")
+        self.sem_target = None if target is None else float(target)
+        self.min_repetitions = int(minimum)
+        self.max_repetitions = int(maximum)
+        self.sem_of = of
+
+    def com_discovery(self, *args, full=False):
         """
         ------------------------------------------------------------------------
         FUNCTION: com_discovery
-        INPUTS: *args (any)
+        INPUTS: *args (any), full (bool)
         RETURNS: offline_mode (bool)
                  result, default (str)
-        DEPENDENCIES: serial
+        DEPENDENCIES: serial, discovery
         ------------------------------------------------------------------------
         Searches all available COM ports for the shutter and monochromator.
-        Shutter is identified by COM device with 'Arduino' in name, and
+        Shutter is identified by replying 'Shutter' to a query, and
         monochromator is identified by sending an identification command and
-        checking the reply.
+        checking the reply. All ports are probed at once.
+
+        The ports found are saved to discovery_cache. If the cache holds both
+        the shutter and monochromator, only those ports are probed, falling
+        back to probing every port if either has stopped answering. full
+        skips straight to probing every port.
         ------------------------------------------------------------------------
         """
         cm_okay = False
@@ -224,13 +326,7 @@ class K4200_test(object):
         K4200_test.ard_default = "Offline"
         K4200_test.mono_default = "Offline"
         K4200_test.result = ["Offline"]
-        com_ports = list(list_ports.comports())
-        replies = ['Shutter',
-                   chr(27),
-                   'q']
-        instrs = {chr(27): "Monochromator",
-                  "Shutter": "Shutter",
-                  "q": "5320 LIA"}
+        com_ports = list(self.comports())
         self.devices = {}
 
         if not com_ports:
@@ -240,25 +336,22 @@ class K4200_test(object):
             K4200_test.com_okay = False
         else:
             K4200_test.result = [c[0] for c in com_ports]
-            sessions = [serial.Serial(c) for c in K4200_test.result]
-            sleep(2)
-            for s in sessions:
-                try:
-                    s.flush()
-                    s.write(b'q')
-                    s.write(chr(27).encode())
-                    sleep(0.1)
-                    num_bytes = s.inWaiting()
-                    if num_bytes == 0:
-                        continue
-                    else:
-                        reply = s.read(num_bytes).decode()
-                    for r in replies:
-                        if r in reply:
-                            self.devices[instrs[r]] = s.port
-                except:
-                    print("failed to read from {0}".format(s))
-                s.close()
+            cached = discovery.load_cache(self.discovery_cache, "com")
+            if not full and {"Shutter", "Monochromator"} <= set(cached):
+                self.devices = self.pooled_com_devices(cached)
+            if not full and not self.devices and (
+                    {"Shutter", "Monochromator"} <= set(cached)):
+                # pooled serial sessions would keep their ports busy
+                self.pool.close_all("serial")
+                self.devices = discovery.validate_com_cache(
+                    cached, K4200_test.result, self.serial_class,
+                    self.probe_timeout) or {}
+            if not self.devices:
+                self.pool.close_all("serial")
+                self.devices = discovery.scan_com_ports(
+                    K4200_test.result, self.serial_class, self.probe_timeout)
+                discovery.save_cache(
+                    self.discovery_cache, "com", self.devices)
 
             if "Shutter" in self.devices.keys():
                 sh_okay = True
@@ -276,6 +369,31 @@ class K4200_test(object):
 
             K4200_test.com_okay = sh_okay and cm_okay
 
+    def pooled_com_devices(self, cached):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: pooled_com_devices
+        INPUTS: self, cached (dict, device --> port)
+        RETURNS: cached (dict) or empty dict
+        DEPENDENCIES: none
+        ------------------------------------------------------------------------
+        If the monochromator and shutter at the cached ports are already open
+        in the session pool and still answer, returns the cached mapping
+        without reopening either port (and resetting the Arduino).
+        ------------------------------------------------------------------------
+        """
+        mono = self.pool.find("serial", cached["Monochromator"])
+        sh = self.pool.find("serial", cached["Shutter"])
+        if not (isinstance(mono, cm110.mono) and
+                isinstance(sh, shutter.ard_shutter)):
+            return {}
+        try:
+            if "succesful" in mono.echo() and sh.query():
+                return dict(cached)
+        except:
+            pass
+        return {}
+
     def visa_discovery(self):
         """
         ------------------------------------------------------------------------
@@ -290,6 +408,10 @@ class K4200_test(object):
         its identity is ascertained. The instrument and address are then
         linked. If an important instrument is not a present a flag is set to
         prevent the test running.
+
+        Every instrument is probed at once, and the identification query each
+        one answered is saved to discovery_cache along with its model, so on
+        later runs a known instrument only needs that one query.
         ------------------------------------------------------------------------
         """
         K4200_test.visa_okay = True
@@ -297,32 +419,18 @@ class K4200_test(object):
         K4200_test.instrs['5302'] = "Not Present"
         K4200_test.instrs['MODEL331S'] = "Not Present"
         K4200_test.instrs['KI4200'] = "Not Present"
-        queries = ['ID?', 'ID', '*IDN?']
-        names = ['MODEL331S',
-                 'MODEL 2440',
-                 '34970A',
-                 '5302',
-                 'KI4200',
-                 'HP6634A']
         K4200_test.visa_resources = instr_address = (
             [i for i in self.rm.list_resources() if "ASRL" not in i])
-        sessions = [self.rm.open_resource(i) for i in instr_address]
-
-        for s in sessions:
-            s.clear()
-        for q in queries:
-            for s in sessions:
-                s.write(q)
-        for s in sessions:
-            try:
-                reply = s.read()
-                for name in names:
-                    if name in reply:
-                        K4200_test.instrs[name] = (
-                            "GPIB0::{0}::INSTR".format(s.primary_address))
-            except:
-                print("failed to read from {0}".format(s))
-            s.close()
+
+        cached = discovery.load_cache(self.discovery_cache, "visa")
+        found = discovery.scan_visa(
+            self.rm, instr_address, cached, self.id_timeout)
+        if found != cached:
+            discovery.save_cache(self.discovery_cache, "visa", found)
+        for address in instr_address:
+            if address in found:
+                K4200_test.instrs[found[address]["model"]] = address
+
         if ((K4200_test.instrs['5302'] == "Not Present" or
              K4200_test.instrs['MODEL331S'] == "Not Present" or
              K4200_test.instrs['KI4200'] == "Not Present")):
@@ -337,42 +445,169 @@ class K4200_test(object):
         RETURNS: nothing
         DEPENDENCIES: pyvisa/visa
         ------------------------------------------------------------------------
-        If the 
+        Opens (or takes from the pool) a session for the named instrument and
+        checks its identity. The 4200-SCS is then initialised for the mode of
+        this test. With mirror_state the RPM modules are only switched if the
+        session's kxci_state shows they are not already in the right mode,
+        otherwise only if last_test was of a different kind.
+
+        A test cannot run without the 4200-SCS, so IOError is raised if it
+        does not answer. A missing LS331 or LIA leaves its session as None,
+        and a missing LS331 gives temperatures of 0.
         ------------------------------------------------------------------------
         """
         if instrument.upper() == "K4200":
-            self.k4200 = self.rm.open_resource(self.k4200_address)
-            try:
-                assert "KI4200" in self.k4200.query("ID")
-            except AssertionError:
-                self.k4200.close()
-                print("KI4200 not detected at given address")
+            self.k4200 = self.open_visa(self.k4200_address, "ID", "KI4200")
+            if self.k4200 is None:
+                raise IOError("KI4200 not detected at {0}".format(
+                    self.k4200_address))
 
             if self.mode == "iv":
                 switch = 3
             else:
                 switch = 1
 
+            if not self.mirror_state:
+                # this test writes without the mirror, so it would go stale
+                self.forget_state()
+            state = ki4200.state_of(self.k4200) if self.mirror_state else None
             ki4200.init_4200(
-                self.last_test not in self.mode, switch, self.k4200)
+                self.last_test not in self.mode, switch, self.k4200, state)
 
         elif instrument.upper() == "LS331":
-            self.ls331 = self.rm.open_resource(self.ls331_address)
-            try:
-                assert "MODEL331S" in self.ls331.query("*IDN?")
-            except AssertionError:
-                self.ls331.close()
+            self.ls331 = self.open_visa(
+                self.ls331_address, "*IDN?", "MODEL331S")
+            if self.ls331 is None:
                 print("LS331 not detected at given address")
 
         elif instrument.upper() == "LIA5302":
-            self.lia5302 = self.rm.open_resource(self.lia5302_address)
-            self.lia5302.query_delay = 0.05
-            try:
-                assert "5302" in self.lia5302.query("ID?")
-            except AssertionError:
-                self.lia5302.close()
+            self.lia5302 = self.open_visa(
+                self.lia5302_address, "ID?", "5302", query_delay=0.05)
+            if self.lia5302 is None:
                 print("5302LIA not detected at given address")
 
+    def forget_state(self):
+        """
+        ------------------------------------------------------------------------
+        Empties the KXCI state mirrored on the 4200-SCS session, if there is
+        one, so that the next set up sends every command. Called whenever
+        something goes wrong during a test, as it is then unknown what the
+        4200-SCS has received.
+        ------------------------------------------------------------------------
+        """
+        state = getattr(getattr(self, "k4200", None), "kxci_state", None)
+        if state is not None:
+            state.forget()
+
+    def open_visa(self, address, id_query, expected, **attrs):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: open_visa
+        INPUTS: self, address, id_query, expected (str), **attrs
+        RETURNS: session (VISA resource) or None
+        DEPENDENCIES: pyvisa/visa
+        ------------------------------------------------------------------------
+        Returns a session for address whose reply to id_query contains
+        expected, or None if it cannot be opened or does not identify itself.
+        attrs are set on new sessions. With keep_sessions the session comes
+        from the pool, where the same identity query is used as its health
+        check.
+        ------------------------------------------------------------------------
+        """
+        def opener():
+            session = self.rm.open_resource(address)
+            for name, value in attrs.items():
+                setattr(session, name, value)
+            return session
+
+        def identify(session):
+            timeout = session.timeout
+            session.timeout = 2000
+            try:
+                return expected in session.query(id_query)
+            finally:
+                session.timeout = timeout
+
+        try:
+            if self.keep_sessions:
+                return self.pool.get(("visa", address, id(self.rm)),
+                                     opener, check=identify)
+            session = opener()
+        except:
+            return None
+        if self.pool.healthy(session, identify):
+            return session
+        session.close()
+        return None
+
+    def open_serial(self, name):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: open_serial
+        INPUTS: self, name (str, "mono" or "shutter")
+        RETURNS: cm110.mono or shutter.ard_shutter
+        DEPENDENCIES: cm110, shutter
+        ------------------------------------------------------------------------
+        Opens the monochromator or shutter, or with keep_sessions takes it
+        from the pool if it still answers an echo or query. Reusing the
+        shutter saves the Arduino reset delay.
+        ------------------------------------------------------------------------
+        """
+        if name == "mono":
+            def opener():
+                return cm110.mono(port=self.mono_port,
+                                  serial_class=self.serial_class,
+                                  framed=self.mono_framed)
+            key = ("serial", self.mono_port, id(self.serial_class),
+                   self.mono_framed)
+            check = (lambda m: "succesful" in m.echo())
+            close = (lambda m: m.close())
+        else:
+            def opener():
+                return shutter.ard_shutter(port=self.shutter_port,
+                                           serial_class=self.serial_class,
+                                           travel=self.shutter_travel)
+            key = ("serial", self.shutter_port, id(self.serial_class))
+            check = (lambda s: s.query())
+            close = (lambda s: s.shutdown())
+
+        if not self.keep_sessions:
+            return opener()
+        device = self.pool.get(key, opener, check=check, close=close,
+                               check_new=False)
+        if name == "shutter":
+            device.travel = self.shutter_travel
+        return device
+
+    def release(self, *names):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: release
+        INPUTS: self, *names (str, attribute names of instruments)
+        RETURNS: nothing
+        DEPENDENCIES: none
+        ------------------------------------------------------------------------
+        Called when a test has finished with an instrument. Closes it, unless
+        keep_sessions is set in which case it stays open in the pool.
+        ------------------------------------------------------------------------
+        """
+        if self.keep_sessions:
+            return
+        for name in names:
+            device = getattr(self, name)
+            if name == "sh":
+                device.shutdown()
+            else:
+                device.close()
+
+    def close_sessions(self):
+        """
+        ------------------------------------------------------------------------
+        Closes every pooled session, freeing the ports for other programs.
+        ------------------------------------------------------------------------
+        """
+        self.pool.close_all()
+
     def set_shutter_port(self, p):
         K4200_test.shutter_port = p
 
@@ -438,6 +673,63 @@ class K4200_test(object):
         for w in range(self.wstart, self.wend+1, self.wstep):
             self.wsteps += 1
 
+    def set_refinement(self, fine_step=None, threshold=0.05,
+                       method="gradient", budget=None, max_points=None,
+                       of="primary"):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: set_refinement
+        INPUTS: self, fine_step (int) --> None
+                threshold (float) --> 0.05
+                method (str) --> "gradient"
+                budget (float) --> None
+                max_points (int) --> None
+                of (str) --> "primary"
+        RETURNS: nothing
+        DEPENDENCIES: none
+        ------------------------------------------------------------------------
+        Makes multi sweeps adaptive. The range set by set_wavelengths is first
+        scanned at its step, then wavelengths are added down to fine_step
+        wherever the primary values (or the LIA magnitude, with
+        of="magnitude") change by more than threshold of their range, see
+        planner.scan_planner. budget limits the whole scan to that many
+        seconds and max_points the number of wavelengths. A fine_step of None
+        goes back to an even scan.
+        ------------------------------------------------------------------------
+        """
+        if method not in ("gradient", "curvature"):
+            raise ValueError("method must be 'gradient' or 'curvature'")
+        if of not in ("primary", "magnitude"):
+            raise ValueError("of must be 'primary' or 'magnitude'")
+        self.fine_step = None if fine_step is None else int(fine_step)
+        self.refine_threshold = threshold
+        self.refine_method = method
+        self.scan_budget = budget
+        self.max_wavelengths = max_points
+        self.refine_of = of
+
+    def set_continuous(self, speed=None):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: set_continuous
+        INPUTS: self, speed (int) --> None
+        RETURNS: nothing
+        DEPENDENCIES: none
+        ------------------------------------------------------------------------
+        Makes multi sweeps continuous. Rather than stopping at each
+        wavelength, the monochromator scans the range set by set_wavelengths
+        at speed angstroms per second while measurements are taken back to
+        back, each being put in the wavelength step it was taken in, see
+        run_continuous_sweep. This suits spot measurements, which are quick
+        compared to the time the grating takes to cross a step. The number of
+        repetitions and any refinement are not used. A speed of None goes
+        back to stepping.
+        ------------------------------------------------------------------------
+        """
+        if speed is not None and not 0 < int(speed) < 0x10000:
+            raise ValueError("speed must be from 1 to 65535")
+        self.scan_speed = None if speed is None else int(speed)
+
     def set_single_w(self, w):
         self.single_w_val = w
 
@@ -463,6 +755,7 @@ class K4200_test(object):
                                            t_type, self.cust_name)
         self.csv_path = path.join(folder, filename + ".csv")
         self.img_path = path.join(folder, filename + ".png")
+        self.bin_path = path.join(folder, filename + ".cvw")
 
     def save_to_csv(self, x_name, y_name, x, y, **kwargs):
         """
@@ -475,24 +768,20 @@ class K4200_test(object):
 
         ------------------------------------------------------------------------
         """
-        header = [x_name]
+        # with nothing measured only the header is written
+        sweep = np.ndim(y[0]) > 0 if len(y) else len(self.yaxis) > 1
+        header = self.csv_header(x_name, y_name, sweep)
         data = []
-        if isinstance(y[0], list):
+        if sweep:
             data = [x] + list(zip(*y))
-            if "f" in self.mode:
-                for f in self.yaxis:
-                    header.append(str(f) + " Hz")
-            else:
-                for v in self.yaxis:
-                    header.append(str(v) + " V")
         else:
             data = [x, y]
-            header.append(y_name)
 
         for name, value in kwargs.items():
-            if isinstance(value[0], list):
-                header += name
-                data += value
+            if len(value) and np.ndim(value[0]) > 0:
+                columns = self.csv_header(x_name, y_name, True)[1:]
+                header += [name + " " + c for c in columns]
+                data += list(zip(*value))
             else:
                 header.append(name)
                 data.append(value)
@@ -503,6 +792,150 @@ class K4200_test(object):
             writer.writerows(zip(*data))
             csvfile.close()
 
+    def csv_header(self, x_name, y_name, sweep):
+        """
+        ------------------------------------------------------------------------
+        Returns the first columns of the csv header. For a sweep there is one
+        column per point of yaxis, otherwise a single y_name column.
+        ------------------------------------------------------------------------
+        """
+        header = [x_name]
+        if not sweep:
+            header.append(y_name)
+        elif "f" in self.mode:
+            for f in self.yaxis:
+                header.append(str(f) + " Hz")
+        else:
+            for v in self.yaxis:
+                header.append(str(v) + " V")
+        return header
+
+    def start_stream(self):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: start_stream
+        INPUTS: self
+        RETURNS: nothing
+        DEPENDENCIES: datafile
+        ------------------------------------------------------------------------
+        Reads back the voltage or frequency axis after the first wavelength of
+        a multi sweep and starts writing the csv file, so that every
+        wavelength after this is saved as soon as it has been stored.
+        ------------------------------------------------------------------------
+        """
+        self.read_axis()
+        sweep = not (self.mode == "cv" and not self.vrange_set)
+        header = self.csv_header("Wavelengths (A)", "Voltage (V)", sweep)
+        extra = ["temperature", "phase", "magnitude"]
+        if self.uncertain():
+            extra += ["SEM " + c for c in header[1:]] if sweep else ["SEM"]
+        if self.counted():
+            extra.append("repetitions")
+        self.stream = datafile.csv_stream(self.csv_path, header + extra)
+
+    def stream_row(self, i):
+        """
+        ------------------------------------------------------------------------
+        Appends the results for the i-th wavelength to the csv stream.
+        ------------------------------------------------------------------------
+        """
+        y = self.prim[i]
+        row = [self.wavelengths[i]] + (list(y) if np.ndim(y) else [y])
+        row += [self.temp[i], self.pha[i], self.mag[i]]
+        if self.uncertain():
+            e = self.prim_sem[i]
+            row += list(e) if np.ndim(e) else [e]
+        if self.counted():
+            row.append(self.reps_used[i])
+        self.stream.append(row)
+
+    def uncertain(self):
+        """
+        ------------------------------------------------------------------------
+        Returns whether the standard error of each mean is saved to the csv,
+        which is only when there is more than one repetition to take it from.
+        ------------------------------------------------------------------------
+        """
+        return self.save_sem and (int(self.repetitions) > 1 or
+                                  self.counted())
+
+    def counted(self):
+        """
+        ------------------------------------------------------------------------
+        Returns whether the number of repetitions can differ from wavelength
+        to wavelength, in which case it is saved to the csv as well.
+        ------------------------------------------------------------------------
+        """
+        return self.sem_target is not None or (
+            self.wrange_set and self.scan_speed is not None)
+
+    def test_config(self):
+        """
+        ------------------------------------------------------------------------
+        Returns every setting of this test that is a plain string, number,
+        bool or None, including those inherited from the class.
+        ------------------------------------------------------------------------
+        """
+        config = {}
+        for name in dir(self):
+            if name.startswith("_"):
+                continue
+            value = getattr(self, name)
+            if value is None or isinstance(value, (str, bool, int, float)):
+                config[name] = value
+        return config
+
+    def save_columns(self):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: save_columns
+        INPUTS: self
+        RETURNS: nothing
+        DEPENDENCIES: datafile, numpy
+        ------------------------------------------------------------------------
+        Saves the results of a multi sweep to bin_path as a column file (see
+        datafile.py) next to the csv. primary and secondary are wavelength x
+        voltage/frequency arrays (a single column for spot measurements, and
+        secondary is NaN where it is not measured), along with 1-D arrays of
+        wavelength, axis, temperature, magnitude, phase and LIA frequency.
+        primary_std, secondary_std, primary_used and secondary_used hold the
+        standard deviation of the repetitions and how many were averaged at
+        each point, and repetitions how many were taken at each wavelength.
+        Everything is in order of wavelength, apart from sample_time and
+        sample_wavelength, which a continuous scan adds with the time from
+        the start of the scan and wavelength of each sample. The test
+        settings are saved as metadata.
+        ------------------------------------------------------------------------
+        """
+        r = self.results
+        n = len(self.wavelengths)
+        if not n or not len(r):
+            return
+        # adaptive and descending scans are measured out of order
+        order = np.argsort(self.wavelengths[:n], kind="stable")
+        metadata = self.test_config()
+        metadata.update(date=strftime("%Y-%m-%d %H:%M:%S"),
+                        axis_units="Hz" if "f" in self.mode else "V",
+                        csv=path.basename(self.csv_path))
+        arrays = {
+            "wavelength": np.array(self.wavelengths, dtype=float)[order],
+            "axis": np.array(self.yaxis, dtype=float),
+            "primary": r.means[order, 0],
+            "secondary": r.means[order, 1],
+            "primary_std": r.stds[order, 0],
+            "secondary_std": r.stds[order, 1],
+            "primary_used": r.used[order, 0],
+            "secondary_used": r.used[order, 1],
+            "repetitions": r.counts[order],
+            "temperature": r.aux_means[order, 0],
+            "magnitude": r.aux_means[order, 1],
+            "phase": r.aux_means[order, 2],
+            "frequency": r.freq[order]}
+        if self.scan_samples is not None:
+            arrays["sample_time"], arrays["sample_wavelength"] = \
+                self.scan_samples
+        datafile.write_columns(self.bin_path, arrays, metadata)
+
     def multi_graph(self):
         """
         ------------------------------------------------------------------------
@@ -512,6 +945,21 @@ class K4200_test(object):
         DEPENDENCIES:
         ------------------------------------------------------------------------
 
+        ------------------------------------------------------------------------
+        """
+        title, ylabel = self.graph_labels()
+        axes = liveplot.make_axes(plt.gcf(), title, ylabel)
+
+        display.display(plt.gcf())
+        display.clear_output(wait=True)
+        self.axes = axes
+        self.live = liveplot.live_plot(axes, self.plot_interval)
+        return 0
+
+    def graph_labels(self):
+        """
+        ------------------------------------------------------------------------
+        Returns the title and y label of the primary plot of a multi sweep.
         ------------------------------------------------------------------------
         """
         ylabel = "Capacitance (F)"
@@ -525,32 +973,42 @@ class K4200_test(object):
         elif self.mode == "iv":
             ylabel = "Current (A)"
             title = "IV sweep"
+        return title, ylabel
 
-        ylabels = [ylabel, "Temperature (C)",
-                   "Magnitude (%)", "Phase (°)"]
-        titles = [title, "Temperature", "Magnitude", "Phase"]
-
-        axes = []
-        for i in range(4):
-            axes.append(plt.subplot(221+i))
-
-            axes[i].set_title(titles[i], fontsize=20, family="serif")
-            axes[i].set_ylabel(ylabels[i], fontsize=14)
-            axes[i].set_xlabel("Wavelength (Angstoms)", fontsize=14)
-
-            axes[i].minorticks_on()
-            axes[i].grid(b=True, which='major', color='#6C7A89')
-            axes[i].grid(b=True, which='minor', color='#D2D7D3')
-
-            axes[i].plot()
-
-        axes[3].set_ylim([-180, 0])
-        plt.tight_layout(h_pad=1.0)
+    def start_renderer(self):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: start_renderer
+        INPUTS: self
+        RETURNS: nothing
+        DEPENDENCIES: renderer
+        ------------------------------------------------------------------------
+        Starts a renderer process for the live plot of a multi sweep, in
+        place of drawing it in this process. Its frames are written next to
+        img_path.
+        ------------------------------------------------------------------------
+        """
+        title, ylabel = self.graph_labels()
+        self.live = None
+        self.renderer = renderer.render_process(
+            title, ylabel, path.splitext(self.img_path)[0] + "_live.png",
+            self.plot_interval)
 
-        display.display(plt.gcf())
-        display.clear_output(wait=True)
-        self.axes = axes
-        return 0
+    def save_figure(self):
+        """
+        ------------------------------------------------------------------------
+        Saves the figure to img_path, and as svg as well with export_svg. With
+        a renderer the export is left to it and this returns straight away.
+        ------------------------------------------------------------------------
+        """
+        names = [self.img_path]
+        if self.export_svg:
+            names.append(path.splitext(self.img_path)[0] + ".svg")
+        for name in names:
+            if self.renderer is not None:
+                self.renderer.save(name)
+            else:
+                plt.figure(self.figure_num).savefig(name)
 
     def single_graph(self):
         """
@@ -566,8 +1024,8 @@ class K4200_test(object):
         self.ax = plt.subplot(111)
 
         self.ax.minorticks_on()
-        self.ax.grid(b=True, which='major', color='#6C7A89')
-        self.ax.grid(b=True, which='minor', color='#D2D7D3')
+        self.ax.grid(True, which='major', color='#6C7A89')
+        self.ax.grid(True, which='minor', color='#D2D7D3')
 
         self.ax.set_xlabel("Voltage (V)", fontsize=14)
         self.ax.set_ylabel("Capacitance (F)", fontsize=14)
@@ -601,10 +1059,9 @@ class K4200_test(object):
 
         ------------------------------------------------------------------------
         """
-        plt.clf()
-        plt.close()
+        plt.close(self.figure_num)
         plt.figure(
-            num=1,
+            num=self.figure_num,
             figsize=(14, 10),
             dpi=80,
             facecolor='w',
@@ -693,6 +1150,32 @@ class K4200_test(object):
             "RG 1, {0}".format(self.min_cur),
             "SM DM2", "LI 'VA','IA'", "MD"]
 
+    def select(self):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: select
+        INPUTS: self
+        RETURNS: nothing
+        DEPENDENCIES: ki4200
+        ------------------------------------------------------------------------
+        Puts the 4200-SCS back into the state this test needs after another
+        test has used it, switching the RPM modules and sending the set up
+        commands again. With mirror_state only what has changed is sent, so
+        this costs nothing if this test was the last to use it.
+        ------------------------------------------------------------------------
+        """
+        switch = 3 if self.mode == "iv" else 1
+        if self.mirror_state:
+            state = ki4200.state_of(self.k4200)
+            ki4200.init_4200(False, switch, self.k4200, state)
+            state.upload(self.k4200, self.commands)
+        else:
+            ki4200.init_4200(
+                K4200_test.last_test not in self.mode, switch, self.k4200)
+            for c in self.commands:
+                self.k4200.write(c)
+        K4200_test.last_test = "iv" if self.mode == "iv" else "c"
+
     def setup_test(self):
         """
         ------------------------------------------------------------------------
@@ -701,10 +1184,13 @@ class K4200_test(object):
         RETURNS: nothing
         DEPENDENCIES: pyvisa/visa
         ------------------------------------------------------------------------
-
+        Builds the set up commands for this test and sends them to the
+        4200-SCS (with mirror_state, only those that change something), then
+        opens the other instruments and sets up the graph.
         ------------------------------------------------------------------------
         """
-        if self.vrange_set and self.mode != "ct":
+        # CF tests never set a voltage range but still need the CVU commands
+        if (self.vrange_set or self.mode == "cf") and self.mode != "ct":
             (self.cvf_commands() if self.mode in
              ("cv", "cf") else self.iv_commands())
         elif self.mode != "ct":
@@ -713,19 +1199,91 @@ class K4200_test(object):
             return -1
 
         self.set_visa_instr(instrument="K4200")
-        for c in self.commands:
-            self.k4200.write(c)
+        if self.bulk_read and self.reader is None:
+            self.reader = ki4200.bulk_reader()
+        if self.mirror_state:
+            ki4200.state_of(self.k4200).upload(self.k4200, self.commands)
+        else:
+            for c in self.commands:
+                self.k4200.write(c)
 
         self.set_visa_instr(instrument="LIA5302")
 
-        self.cm = cm110.mono(port=self.mono_port)
-        self.sh = shutter.ard_shutter(port=self.shutter_port)
+        self.cm = self.open_serial("mono")
+        self.sh = self.open_serial("shutter")
         self.sh.open()
-        self.setup_graph()
         self.set_path()
+        if self.wrange_set and self.use_renderer:
+            self.start_renderer()
+        else:
+            self.setup_graph()
         if self.wrange_set:
             self.set_visa_instr(instrument="LS331")
-            self.ls331.timeout = 0.1
+            if self.ls331 is not None:
+                self.ls331.timeout = 0.1
+
+    def start_sampler(self):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: start_sampler
+        INPUTS: self
+        RETURNS: nothing
+        DEPENDENCIES: sampler
+        ------------------------------------------------------------------------
+        Starts reading the LIA and LS331 in the background for the rest of the
+        sweep, see sampler.aux_sampler. From then on those two sessions must
+        only be used by the sampler.
+        ------------------------------------------------------------------------
+        """
+        self.aux_dropped = None
+        self.sampler = sampler.aux_sampler(
+            lia5302=self.lia5302, ls331=getattr(self, "ls331", None))
+        self.sampler.start()
+
+    def stop_sampler(self):
+        """
+        ------------------------------------------------------------------------
+        Stops the sampler, if running. Any channels it dropped are listed in
+        aux_dropped, which is saved with the column file metadata.
+        ------------------------------------------------------------------------
+        """
+        if self.sampler is not None:
+            self.sampler.stop()
+            if self.sampler.dropped:
+                self.aux_dropped = ", ".join(sorted(self.sampler.dropped))
+            self.sampler = None
+
+    def aux_readings(self, start, t, mag, pha, freq=True):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: aux_readings
+        INPUTS: self, start (float), t, mag, pha (float list), freq (bool)
+        RETURNS: nothing
+        DEPENDENCIES: none
+        ------------------------------------------------------------------------
+        Appends temperature, LIA magnitude and LIA phase for a repetition that
+        began at start (monotonic time) to t, mag and pha. When the sampler is
+        running these are averages over the repetition, otherwise the
+        instruments are queried directly and freq sets whether the LIA
+        frequency is read as well. A failed temperature reading gives 0, or
+        NaN from the sampler.
+        ------------------------------------------------------------------------
+        """
+        if self.sampler is not None:
+            means = self.sampler.window(start, monotonic())
+            self.lia_freq = means["freq"]
+            t.append(means["temp"])
+            mag.append(means["mag"])
+            pha.append(means["pha"])
+            return
+        if freq:
+            self.lia_freq = (float(self.lia5302.query('FRQ'))/1000)
+        mag.append(float(self.lia5302.query('MAG'))/100)
+        pha.append(float(self.lia5302.query('PHA'))/1000)
+        try:
+            t.append(float(self.ls331.query('KRDG?').replace('+', '')))
+        except:
+            t.append(0)
 
     def cv_no_v(self):
         """
@@ -738,30 +1296,82 @@ class K4200_test(object):
 
         ------------------------------------------------------------------------
         """
-        data = []
+        values = []
         t = []
         mag = []
         pha = []
-        for r in range(int(self.repetitions)):
+        for r in self.repeats:
+            start = monotonic()
             self.k4200.write(":CVU:TEST:RUN")
             self.k4200.wait_for_srq()
             self.k4200.write(':CVU:DATA:Z?')
-            self.lia_freq = (float(self.lia5302.query('FRQ'))/1000)
-            mag.append(float(self.lia5302.query('MAG'))/100)
-            pha.append(float(self.lia5302.query('PHA'))/1000)
-            values = self.k4200.read(termination=",\r\n", encoding="utf-8")
-            p, s = ki4200.CV_output_san(values)
-            data.append(p)
-            try:
-                t.append(float(self.ls331.query('KRDG?').replace('+', '')))
-            except:
-                t.append(0)
-        self.mag.append(sum(mag)/len(mag))
-        self.pha.append(sum(pha)/len(pha))
-        self.temp.append(sum(t)/len(t))
-        avg = [sum(col) / len(col) for col in zip(*data)]
-        self.prim.append(avg)
-        self.sec.append(s)
+            self.aux_readings(start, t, mag, pha)
+            values.append(self.read_k4200())
+            self.repeat_done(values[-1], mag[-1])
+        self.defer(self.store_cv_no_v, values, t, mag, pha)
+
+    def repeat_done(self, raw, mag):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: repeat_done
+        INPUTS: self, raw (str or array), mag (float)
+        RETURNS: nothing
+        DEPENDENCIES: ki4200, results
+        ------------------------------------------------------------------------
+        Tells repeats that a repetition has been taken, parsing its primary
+        values from the raw reply only if the adaptive rule needs them. raw is
+        whatever cv_no_v, cv_v or iv read from the 4200-SCS.
+        ------------------------------------------------------------------------
+        """
+        rule = self.repeats
+        if not rule.adaptive or rule.of != "primary":
+            rule.add(magnitude=mag)
+        elif self.mode == "iv":
+            rule.add(ki4200.parse_values(raw, strip="NC"))
+        elif self.mode == "cv" and not self.vrange_set:
+            rule.add(float(raw.split(',')[0]))
+        else:
+            rule.add(ki4200.parse_impedance(raw)[:, 0])
+
+    def read_k4200(self, command=None, strip=""):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: read_k4200
+        INPUTS: self, command (str) --> None, strip (str)
+        RETURNS: values (numpy array or str)
+        DEPENDENCIES: ki4200
+        ------------------------------------------------------------------------
+        Sends command if one is given, then reads a block of results from the
+        4200-SCS. With bulk_read the reply is read raw into the reader buffer
+        and parsed to an array straight away (dropping any characters in
+        strip), otherwise it is returned as a string and parsed later by the
+        store methods, which accept either.
+        ------------------------------------------------------------------------
+        """
+        if command is not None:
+            self.k4200.write(command)
+        if self.bulk_read and self.reader is not None:
+            return ki4200.parse_values(self.reader.read(self.k4200), strip)
+        return self.k4200.read(termination=",\r\n", encoding="utf-8")
+
+    def store_cv_no_v(self, values, t, mag, pha):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: store_cv_no_v
+        INPUTS: self, values (str or array list), t, mag, pha (float list)
+        RETURNS: nothing
+        DEPENDENCIES: ki4200, numpy
+        ------------------------------------------------------------------------
+        Parses the raw impedance strings read by cv_no_v and adds them to
+        results one repetition at a time. Runs on the worker when pipelined.
+        ------------------------------------------------------------------------
+        """
+        for i, v in enumerate(values):
+            z = ki4200.parse_impedance(v)
+            self.results.add_repetition(z[:, 0], t[i], mag[i], pha[i],
+                                        secondary=z[:, 1])
+        self.results.finish()
+        self.sync_results()
 
     def cv_v(self):
         """
@@ -778,20 +1388,28 @@ class K4200_test(object):
         t = []
         mag = []
         pha = []
-        for r in range(int(self.repetitions)):
-            data.append(
-                float(self.k4200.query(":CVU:MEASZ?").split(',').pop(0)))
-            mag.append(float(self.lia5302.query('MAG'))/100)
-            pha.append(float(self.lia5302.query('PHA'))/1000)
-            try:
-                t.append(float(self.ls331.query('KRDG?').replace('+', '')))
-            except:
-                t.append(0)
-        self.mag.append(sum(mag)/len(mag))
-        self.pha.append(sum(pha)/len(pha))
-        self.temp.append(sum(t)/len(t))
-        if int(self.repetitions) > 1:
-            self.prim.append(sum(data)/len(data))
+        for r in self.repeats:
+            start = monotonic()
+            data.append(self.k4200.query(":CVU:MEASZ?"))
+            self.aux_readings(start, t, mag, pha, freq=False)
+            self.repeat_done(data[-1], mag[-1])
+        self.defer(self.store_cv_v, data, t, mag, pha)
+
+    def store_cv_v(self, data, t, mag, pha):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: store_cv_v
+        INPUTS: self, data (str list), t, mag, pha (float list)
+        RETURNS: nothing
+        DEPENDENCIES: results
+        ------------------------------------------------------------------------
+        Stores the spot measurements read by cv_v in results. Runs on the
+        worker when pipelined.
+        ------------------------------------------------------------------------
+        """
+        data = [float(d.split(',').pop(0)) for d in data]
+        self.results.add(data, t, mag, pha)
+        self.sync_results()
 
     def iv(self):
         """
@@ -808,62 +1426,195 @@ class K4200_test(object):
         t = []
         mag = []
         pha = []
-        for r in range(int(self.repetitions)):
+        for r in self.repeats:
+            start = monotonic()
             self.k4200.write("ME1")
             self.k4200.wait_for_srq(timeout=None)
-            out = self.k4200.query("DO 'IA'")
-            data.append([float(d) for d in sub(
-                '[NC]', '', out).split(',')])
-            try:
-                t.append(float(self.ls331.query('KRDG?').replace('+', '')))
-            except:
-                t.append(0)
-            # lia_freq = (int(self.lia5302.query('FRQ'))/1000)
-            mag.append(int(self.lia5302.query('MAG'))/100)
-            pha.append(int(self.lia5302.query('PHA'))/1000)
-        self.mag.append(sum(mag)/len(mag))
-        self.pha.append(sum(pha)/len(pha))
-        self.temp.append(sum(t)/len(t))
-        avg = [sum(col) / len(col) for col in zip(*data)]
-        self.prim.append(avg)
+            data.append(self.read_k4200("DO 'IA'", strip="NC"))
+            self.aux_readings(start, t, mag, pha, freq=False)
+            self.repeat_done(data[-1], mag[-1])
+        self.defer(self.store_iv, data, t, mag, pha)
 
-    def re_plot(self, w):
+    def store_iv(self, data, t, mag, pha):
         """
         ------------------------------------------------------------------------
-        FUNCTION:
+        FUNCTION: store_iv
+        INPUTS: self, data (str or array list), t, mag, pha (float list)
+        RETURNS: nothing
+        DEPENDENCIES: ki4200, numpy
+        ------------------------------------------------------------------------
+        Parses the raw current readings taken by iv and adds them to results
+        one repetition at a time. Runs on the worker when pipelined.
+        ------------------------------------------------------------------------
+        """
+        for i, out in enumerate(data):
+            self.results.add_repetition(ki4200.parse_values(out, strip="NC"),
+                                        t[i], mag[i], pha[i])
+        self.results.finish()
+        self.sync_results()
+
+    def sync_results(self):
+        """
+        ------------------------------------------------------------------------
+        Points prim, prim_sem, sec, temp, mag, pha, lia_freqs and reps_used
+        at what has been stored in results so far.
+        ------------------------------------------------------------------------
+        """
+        r = self.results
+        self.prim = r.primary
+        self.prim_sem = r.primary_sem
+        self.sec = r.secondary
+        self.temp = r.temperature
+        self.mag = r.magnitude
+        self.pha = r.phase
+        self.lia_freqs = r.frequency
+        self.reps_used = r.used_repetitions
+
+    def add_wavelength(self, w, lia_freq=None):
+        i = len(self.wavelengths)
+        self.results.freq[i] = self.lia_freq if lia_freq is None else lia_freq
+        self.wavelengths.append(w)
+        self.sync_results()
+        if self.stream is not None:
+            self.stream_row(-1)
+
+    def queue_wavelength(self, w):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: queue_wavelength
+        INPUTS: self, w (int)
+        RETURNS: nothing
+        DEPENDENCIES: none
+        ------------------------------------------------------------------------
+        Queues wavelength w to be added to the results (through defer, so on
+        the worker when pipelined) and plots every wavelength that has been
+        stored so far. Plotting always stays on this thread, as neither
+        matplotlib nor the notebook display can be used from the worker.
+        ------------------------------------------------------------------------
+        """
+        job = self.defer(self.add_wavelength, w, self.lia_freq)
+        self.plots.append((w, len(self.plots) + self.plotted, job))
+        self.plot_stored()
+
+    def plot_stored(self):
+        """
+        ------------------------------------------------------------------------
+        Plots, in order, each queued wavelength whose results have finished
+        being stored, stopping at the first that is still on the worker. Does
+        nothing except on the thread that started the test, so a sweep run
+        on another thread (see aio.run) leaves its plotting to that one.
+        ------------------------------------------------------------------------
+        """
+        if self.plot_thread not in (None, get_ident()):
+            return
+        while self.plots and (self.plots[0][2] is None or
+                              self.plots[0][2].done()):
+            w, row, job = self.plots.popleft()
+            if job is not None:
+                job.result()
+            self.plotted += 1
+            self.re_plot(w, row)
+
+    def start_worker(self):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: start_worker
         INPUTS: self
-        RETURNS:
-        DEPENDENCIES:
+        RETURNS: nothing
+        DEPENDENCIES: concurrent.futures, collections.deque
         ------------------------------------------------------------------------
+        Starts a single background worker for pipelined sweeps. Parsing,
+        averaging and saving for one wavelength then run on the worker while
+        the monochromator moves on to the next, plotting stays on the thread
+        running the sweep. There is only ever one worker so results are
+        stored in the order they were measured.
+        ------------------------------------------------------------------------
+        """
+        self.worker = ThreadPoolExecutor(max_workers=1)
+        self.pending = deque()
 
+    def defer(self, function, *args):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: defer
+        INPUTS: self, function (callable), *args
+        RETURNS: nothing
+        DEPENDENCIES: none
+        ------------------------------------------------------------------------
+        Runs function straight away, or queues it on the worker if one has
+        been started, returning the Future of the queued job (None if it was
+        run here). Each wavelength queues two jobs, storing the data and then
+        adding it to the results. If the worker falls more than
+        pipeline_depth jobs behind, this waits for it to catch up. Errors on
+        the worker are raised here the next time a job is queued.
         ------------------------------------------------------------------------
         """
-        colours = ["g", "b", "r", "c", "m", "y", "k"]
-        if w > self.wstart:
-            del(self.axes[1].lines[-1])
-            del(self.axes[2].lines[-1])
-            del(self.axes[3].lines[-1])
-        self.axes[1].plot(self.wavelengths, self.temp, 'b-')
-        self.axes[2].plot(self.wavelengths, self.mag, 'r-')
-        self.axes[3].plot(self.wavelengths, self.pha, 'g-')
-        if self.vrange_set or self.mode == "cf":
-            self.y = (list(map(list, zip(*self.prim))))
-            i = 0
-            for line in self.y:
-                if w > self.wstart:
-                    del(self.axes[0].lines[-len(self.y)])
-                if i < 7:
-                    self.axes[0].plot(self.wavelengths, line, colours[i])
-                else:
-                    self.axes[0].plot(self.wavelengths, line)
-                i += 1
-        else:
-            if w > self.wstart:
-                del(self.axes[0].lines[-1])
-            self.axes[0].plot(self.wavelengths, self.prim, 'b-')
+        if self.worker is None:
+            function(*args)
+            return None
+        job = self.worker.submit(function, *args)
+        self.pending.append(job)
+        while self.pending and (self.pending[0].done() or
+                                len(self.pending) > self.pipeline_depth):
+            self.pending.popleft().result()
+        return job
 
-        display.display(plt.gcf())
-        display.clear_output(wait=True)
+    def catch_up(self):
+        """
+        ------------------------------------------------------------------------
+        Waits for everything queued on the worker to finish, leaving it
+        running, then plots what it stored.
+        ------------------------------------------------------------------------
+        """
+        while self.worker is not None and self.pending:
+            self.pending.popleft().result()
+        self.plot_stored()
+
+    def stop_worker(self):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: stop_worker
+        INPUTS: self
+        RETURNS: nothing
+        DEPENDENCIES: none
+        ------------------------------------------------------------------------
+        Waits for everything queued on the worker to finish and shuts it down.
+        Does nothing if the sweep is not pipelined.
+        ------------------------------------------------------------------------
+        """
+        if self.worker is None:
+            return
+        try:
+            self.catch_up()
+        finally:
+            self.worker.shutdown(wait=True)
+            self.worker = None
+
+    def re_plot(self, w, i=None):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: re_plot
+        INPUTS: self, w (int), i (int) --> last stored row
+        RETURNS: nothing
+        DEPENDENCIES: liveplot, renderer
+        ------------------------------------------------------------------------
+        Adds wavelength w, stored in row i of the results, to the lines of
+        the live plot. The figure is redrawn at most every plot_interval
+        seconds, finish_multi_sweep draws the last of it. With a renderer the
+        results are sent to it instead and its newest frame is shown.
+        ------------------------------------------------------------------------
+        """
+        if i is None:
+            i = len(self.wavelengths) - 1
+        if self.renderer is not None:
+            self.renderer.add(w, self.prim[i], self.temp[i],
+                              self.mag[i], self.pha[i])
+            self.renderer.show()
+            return
+        if self.live is None:
+            self.live = liveplot.live_plot(self.axes, self.plot_interval)
+        self.live.add(w, self.prim[i], self.temp[i], self.mag[i], self.pha[i])
+        self.live.draw()
 
     def run_multi_sweep(self):
         """
@@ -878,52 +1629,267 @@ class K4200_test(object):
         """
         self.sh.open()
         self.wavelengths = []
+        self.stream = None
+        if self.pipelined:
+            self.start_worker()
+        if self.sample_aux:
+            self.start_sampler()
 
-        for w in range(self.wstart, self.wend+1, self.wstep):
+        for w in self.scan():
+            self.goto_wavelength(w)
+            self.measure(w)
+
+        return self.finish_multi_sweep()
+
+    def goto_wavelength(self, w):
+        """
+        ------------------------------------------------------------------------
+        Moves the monochromator to w, returning once the CM110 has replied
+        that the move is finished. If the wait is long the shutter is closed
+        while it moves and stays closed for the rest of the wait, counted from
+        when it started to close. Otherwise there is nothing left to wait for.
+        ------------------------------------------------------------------------
+        """
+        if self.wait > 0.5:
+            # close while the monochromator moves
+            start = monotonic()
+            self.sh.close(wait=False)
+            print("closing")
+            self.cm.goto(w)
+            sleep(max(self.wait - (monotonic() - start), 0))
+            self.sh.open()
+        else:
+            self.cm.goto(w)
 
-            if self.wait > 0.5:
-                self.sh.close()
-                print("closing")
-                self.cm.command("goto", w)
-                sleep(self.wait)
-                self.sh.open()
+    def measure(self, w):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: measure
+        INPUTS: self, w (int)
+        RETURNS: nothing
+        DEPENDENCIES: none
+        ------------------------------------------------------------------------
+        Takes the repetitions of this test's sweep at wavelength w, which the
+        monochromator must already be at, and queues them to be stored. The
+        csv stream is started after the first wavelength.
+        ------------------------------------------------------------------------
+        """
+        if self.mode in ("cv, cf"):
+            if not (self.mode == "cv" and not self.vrange_set):
+                self.cv_no_v()
             else:
-                self.cm.command("goto", w)
-                sleep(self.wait)
+                self.cv_v()
+        elif self.mode == "iv":
+            self.iv()
 
-            if self.mode in ("cv, cf"):
-                if not (self.mode == "cv" and not self.vrange_set):
-                    self.cv_no_v()
-                else:
-                    self.cv_v()
-            elif self.mode == "iv":
-                self.iv()
+        if self.stream_csv and self.stream is None:
+            self.start_stream()
+        self.queue_wavelength(w)
 
-            self.wavelengths.append(w)
-            self.re_plot(w)
+    def scan(self):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: scan
+        INPUTS: self
+        RETURNS: wavelengths (int generator)
+        DEPENDENCIES: planner
+        ------------------------------------------------------------------------
+        Gives the wavelengths of a multi sweep in the order they are to be
+        measured. Without a planner that is the even range set by
+        set_wavelengths. With one, after each pass this waits for the worker
+        to store what was measured and hands the results to the planner
+        before asking it for the next pass. With descending set the range (or
+        each pass) is measured from the top down.
+        ------------------------------------------------------------------------
+        """
+        if self.planner is None:
+            ws = range(self.wstart, self.wend+1, self.wstep)
+            yield from (reversed(ws) if self.descending else ws)
+            return
+        plan = self.planner
+        while True:
+            ws = plan.next_pass()
+            if not ws:
+                return
+            yield from (reversed(ws) if self.descending else ws)
+            self.catch_up()
+            signal = self.mag if self.refine_of == "magnitude" else self.prim
+            for i in range(len(plan), len(self.wavelengths)):
+                plan.record(self.wavelengths[i], signal[i])
+
+    def run_continuous_sweep(self):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: run_continuous_sweep
+        INPUTS: self
+        RETURNS: 0
+        DEPENDENCIES: continuous, cm110, numpy
+        ------------------------------------------------------------------------
+        Multi sweep with the monochromator moving the whole time. Once the
+        grating is at the first wavelength the CM110 is set scanning at
+        scan_speed, and samples are taken back to back until it replies that
+        the scan is over. The LIA and temperature are read in the background
+        throughout. Each sample is then given the wavelength the grating was
+        at half way through it, using the measured length of the scan, and
+        the samples in each wavelength step are stored as its repetitions.
+        Steps that no sample fell in, because the scan was too fast for the
+        measurement, are left out. The time and wavelength of every sample
+        are kept in scan_samples.
+        ------------------------------------------------------------------------
+        """
+        self.sh.open()
+        self.wavelengths = []
+        self.stream = None
+        if self.pipelined:
+            self.start_worker()
+        self.start_sampler()
+
+        first = self.wstart
+        last = self.wstart + (self.wsteps - 1) * self.wstep
+        step = self.wstep
+        if self.descending:
+            first, last, step = last, first, -step
+        clock = continuous.scan_clock(first, last, self.scan_speed)
+        self.cm.goto(first)
+        sleep(self.wait)
+        self.cm.command("speed", self.scan_speed)
+        self.cm.message_status()
+
+        self.cm.command("scan", first, last)
+        clock.begin()
+        samples = []
+        times = []
+        t = []
+        mag = []
+        pha = []
+        checked = clock.began
+        while True:
+            now = monotonic()
+            if self.cm.ready():
+                # the scan ended some time during the last sample
+                clock.finish((checked + now) / 2)
+                self.cm.message_status()
+                break
+            if now > clock.deadline():
+                print("No reply from the monochromator, using nominal speed")
+                break
+            checked = now
+            samples.append(self.sample())
+            times.append((now + monotonic()) / 2)
+            self.aux_readings(now, t, mag, pha, freq=False)
+
+        if not samples:
+            print("No samples were taken during the scan, "
+                  "saving an empty file")
+        ws = clock.wavelength(times)
+        self.scan_samples = (np.array(times) - clock.began, ws)
+        for w, rows in continuous.bin_samples(ws, first, last, step):
+            self.defer(self.store_samples, [samples[i] for i in rows],
+                       [t[i] for i in rows], [mag[i] for i in rows],
+                       [pha[i] for i in rows])
+            if self.stream_csv and self.stream is None:
+                self.start_stream()
+            self.queue_wavelength(w)
+        return self.finish_multi_sweep()
+
+    def sample(self):
+        """
+        ------------------------------------------------------------------------
+        Takes a single measurement for run_continuous_sweep and returns what
+        was read from the 4200-SCS, unparsed if bulk_read is off.
+        ------------------------------------------------------------------------
+        """
+        if self.mode == "iv":
+            self.k4200.write("ME1")
+            self.k4200.wait_for_srq(timeout=None)
+            return self.read_k4200("DO 'IA'", strip="NC")
+        elif self.mode == "cv" and not self.vrange_set:
+            return self.k4200.query(":CVU:MEASZ?")
+        self.k4200.write(":CVU:TEST:RUN")
+        self.k4200.wait_for_srq()
+        return self.read_k4200(':CVU:DATA:Z?')
 
-        self.cm.close()
+    def store_samples(self, data, t, mag, pha):
+        """
+        ------------------------------------------------------------------------
+        Stores samples taken by sample as the repetitions of one wavelength,
+        with the store method for this test's mode.
+        ------------------------------------------------------------------------
+        """
+        if self.mode == "iv":
+            self.store_iv(data, t, mag, pha)
+        elif self.mode == "cv" and not self.vrange_set:
+            self.store_cv_v(data, t, mag, pha)
+        else:
+            self.store_cv_no_v(data, t, mag, pha)
+
+    def finish_multi_sweep(self):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: finish_multi_sweep
+        INPUTS: self
+        RETURNS: 0
+        DEPENDENCIES: ki4200, pyplot
+        ------------------------------------------------------------------------
+        Waits for any background work, closes the instruments, reads back the
+        voltage or frequency axis, then saves the results and the figure. If
+        the results were streamed the csv file is just finished off. If the
+        wavelengths were not measured in increasing order (an adaptive or
+        descending scan) the csv is then sorted.
+        ------------------------------------------------------------------------
+        """
+        self.stop_worker()
+        self.stop_sampler()
+        self.plot_stored()
+        if self.live is not None:
+            self.live.flush()
         self.sh.close()
-        self.sh.shutdown()
+        self.release("cm", "sh")
+
+        if self.stream is None:
+            self.read_axis()
+        self.release("k4200")
+        if self.stream is not None:
+            self.stream.finish()
+            self.stream = None
+        else:
+            extra = {"SEM": self.prim_sem} if self.uncertain() else {}
+            if self.counted():
+                extra["repetitions"] = self.reps_used
+            self.save_to_csv(
+                x_name="Wavelengths (A)", x=self.wavelengths,
+                y_name="Voltage (V)", y=self.prim,
+                temperature=self.temp,
+                phase=self.pha,
+                magnitude=self.mag,
+                **extra)
+        if np.any(np.diff(self.wavelengths) < 0):
+            datafile.sort_csv(self.csv_path)
+        if self.save_binary:
+            self.save_columns()
+
+        self.save_figure()
+        if self.renderer is not None:
+            # everything is measured, so waiting here costs no instrument time
+            self.renderer.close(wait=True)
+            self.renderer.show()
+            self.renderer = None
+        self.running = False
+        return 0
 
+    def read_axis(self):
+        """
+        ------------------------------------------------------------------------
+        Reads the voltage or frequency axis of the last sweep into yaxis.
+        ------------------------------------------------------------------------
+        """
         if self.mode == "cv" and self.vrange_set:
-            self.yaxis = ki4200.read_4200_x("volts", self.k4200)
+            self.yaxis = ki4200.read_4200_x("volts", self.k4200, self.reader)
         elif self.mode == "cf":
-            self.yaxis = ki4200.read_4200_x("freq", self.k4200)
+            self.yaxis = ki4200.read_4200_x("freq", self.k4200, self.reader)
         elif self.mode == "iv":
             self.yaxis = sub('[NC]',
                              '', self.k4200.query("DO 'VA'")).split(',')
-        self.k4200.close()
-        self.save_to_csv(
-            x_name="Wavelengths (A)", x=self.wavelengths,
-            y_name="Voltage (V)", y=self.prim,
-            temperature=self.temp,
-            phase=self.pha,
-            magnitude=self.mag)
-
-        plt.savefig(self.img_path)
-        self.running = False
-        return 0
 
     def run_single_sweep(self):
         """
@@ -937,34 +1903,36 @@ class K4200_test(object):
         ------------------------------------------------------------------------
         """
         self.cm.command("goto", self.single_w_val)
-        self.cm.close()
+        self.release("cm")
         sleep(1)
         self.sh.open()
-        data = []
-        if self.mode in ("cv", "cf"):
-            for r in range(int(self.repetitions)):
+        stats = None
+        for r in range(int(self.repetitions)):
+            if self.mode in ("cv", "cf"):
                 self.k4200.write(":CVU:TEST:RUN")
                 self.k4200.wait_for_srq(timeout=None)
-                self.k4200.write(':CVU:DATA:Z?')
-                values = self.k4200.read(
-                    termination=",\r\n", encoding="utf-8")
-                d, sec = ki4200.CV_output_san(values)
-                data.append(d)
-        else:
-            for r in range(int(self.repetitions)):
+                values = self.read_k4200(':CVU:DATA:Z?')
+                values = ki4200.parse_impedance(values)[:, 0]
+            else:
                 self.k4200.write("ME1")
                 self.k4200.wait_for_srq(timeout=None)
-                out = self.k4200.query("DO 'IA'")
-                data.append([float(d) for d in sub(
-                    '[NC]', '', out).split(',')])
-        if int(self.repetitions) > 1:
-            self.prim = [sum(col) / len(col) for col in zip(*data)]
+                out = self.read_k4200("DO 'IA'", strip="NC")
+                values = ki4200.parse_values(out, strip="NC")
+            if stats is None:
+                stats = results.running_stats(
+                    len(values), self.sigma_clip,
+                    keep=self.repetitions if self.keep_raw else 0)
+            stats.add(values)
+        if self.keep_raw:
+            stats.clip()
+        self.prim = stats.mean
+        self.prim_sem = stats.sem
         if self.mode == "cv":
-            self.xaxis = ki4200.read_4200_x("volts", self.k4200)
+            self.xaxis = ki4200.read_4200_x("volts", self.k4200, self.reader)
             xname = "Voltage"
             yname = "Capacitance"
         elif self.mode == "cf":
-            self.xaxis = ki4200.read_4200_x("freq", self.k4200)
+            self.xaxis = ki4200.read_4200_x("freq", self.k4200, self.reader)
             xname = "Frequency"
             yname = "Capacitance"
         elif self.mode == "iv":
@@ -973,13 +1941,13 @@ class K4200_test(object):
             xname = "Voltage"
             yname = "Current"
         self.ax.plot(self.xaxis, self.prim)
-        self.k4200.close()
         self.sh.close()
-        self.sh.shutdown()
+        self.release("k4200", "sh")
 
+        errors = {"SEM": self.prim_sem} if self.uncertain() else {}
         self.save_to_csv(
             x_name=xname, x=self.xaxis,
-            y_name=yname, y=self.prim)
+            y_name=yname, y=self.prim, **errors)
 
         display.display(plt.gcf())
         display.clear_output(wait=True)
@@ -995,21 +1963,81 @@ class K4200_test(object):
         RETURNS: nothing
         DEPENDENCIES: pyvisa/visa, serial, time, pyplot
         ------------------------------------------------------------------------
+        Sets up the instruments and runs the sweep this test is set for. If
+        anything raises an error (a VISA timeout, say) the mirrored KXCI state
+        is forgotten before the error is passed on.
+        ------------------------------------------------------------------------
+        """
+        try:
+            self.begin_test()
+            self.run_sweep()
+        except:
+            self.forget_state()
+            raise
 
+    def begin_test(self):
+        """
+        ------------------------------------------------------------------------
+        Sets up the instruments and empties the results ready for a sweep.
+        Plotting is kept to the thread this is called on.
         ------------------------------------------------------------------------
         """
         self.setup_test()
         self.running = True
+        self.plot_thread = get_ident()
         display.clear_output(wait=True)
+        self.prepare_results()
 
+    def run_sweep(self):
+        """
+        ------------------------------------------------------------------------
+        Runs the sweep this test is set for, once begin_test has been called.
+        With use_asyncio a stepped multi sweep is run by aio.run, which keeps
+        plotting on this thread while the coroutine waits.
+        ------------------------------------------------------------------------
+        """
+        if self.wrange_set and self.scan_speed is not None:
+            self.run_continuous_sweep()
+        elif self.wrange_set and self.use_asyncio:
+            aio.run(aio.run_multi_sweep(self), idle=self.plot_stored)
+            self.finish_multi_sweep()
+        elif self.wrange_set:
+            self.run_multi_sweep()
+        else:
+            self.run_single_sweep()
+
+    def prepare_results(self):
+        """
+        ------------------------------------------------------------------------
+        Empties the results of any earlier run and sets up the result
+        buffers, repetition rule and scan planner for a new one.
+        ------------------------------------------------------------------------
+        """
         self.prim = []
+        self.prim_sem = []
         self.sec = []
         self.yaxis = []
         self.temp = []
         self.mag = []
         self.pha = []
-
-        self.run_multi_sweep() if self.wrange_set else self.run_single_sweep()
+        self.lia_freqs = []
+        self.repeats = results.repeat_rule(
+            self.repetitions, self.sem_target, self.min_repetitions,
+            self.max_repetitions, self.sem_of)
+        self.planner = None
+        self.scan_samples = None
+        self.plots = deque()
+        self.plotted = 0
+        if self.wrange_set and self.fine_step is not None:
+            self.planner = planner.scan_planner(
+                self.wstart, self.wend, self.wstep, self.fine_step,
+                self.refine_threshold, self.refine_method,
+                self.scan_budget, self.max_wavelengths)
+        self.results = results.sweep_results(
+            self.wsteps if self.wrange_set else 1, self.repeats.most,
+            sigma=self.sigma_clip, keep_raw=self.keep_raw)
+        # a sweep that stores nothing still saves its (empty) results
+        self.sync_results()
 
 
 class cap_test(K4200_test):
@@ -0,0 +1,358 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from functools import partial
+from time import monotonic
+"""
+--------------------------------------------------------------------------------
+MODULE: aio.py
+REQUIRES: Python 3.7+
+DEPENDENCIES: asyncio, concurrent.futures
+--------------------------------------------------------------------------------
+This module contains an asyncio layer over the instrument drivers, so that a
+test can wait on several instruments at once rather than one after another.
+
+Neither pyvisa nor pyserial can be driven from an event loop directly, so each
+instrument gets its own single worker thread. Calls to the same instrument
+are kept in order while different instruments run side by side, and the
+blocking drivers (and the notebooks that use them) are left as they were.
+
+    -aio_instr    awaitable write, read, query, wait_for_srq for VISA sessions
+    -aio_mono     awaitable command and goto for cm110.mono
+    -aio_shutter  awaitable open, close and query for shutter.ard_shutter
+
+run_multi_sweep() is a coroutine version of K4200_test.run_multi_sweep. At
+each wavelength the shutter closes while the monochromator moves, and the LIA
+and LS331 are read while the 4200-SCS sweep is running. In a notebook,
+"await run_test(test)" runs a whole test on the kernel's event loop.
+
+Example:
+    >>>from libs import aio
+    >>>k4200 = aio.aio_instr(test.k4200)
+    >>>lia = aio.aio_instr(test.lia5302)
+    >>>aio.run(asyncio.gather(k4200.query("ID"), lia.query("MAG")))
+    ['KI4200 KXCI', '4512']
+--------------------------------------------------------------------------------
+"""
+
+
+class aio_device(object):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: aio_device
+    INIT VARIABLES: device (driver object)
+    INHERITANCE: Object
+    ----------------------------------------------------------------------------
+    Runs blocking methods of a driver on a worker thread of its own. Anything
+    not wrapped is passed straight through to the driver, so attributes such
+    as timeout can still be read and set.
+    ----------------------------------------------------------------------------
+    """
+
+    def __init__(self, device):
+        self.__dict__["device"] = device
+        self.__dict__["executor"] = ThreadPoolExecutor(max_workers=1)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__, self.device)
+
+    def __getattr__(self, name):
+        return getattr(self.device, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.device, name, value)
+
+    def call(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(
+            self.executor, partial(function, *args, **kwargs))
+
+    def release(self):
+        self.executor.shutdown(wait=True)
+
+
+class aio_instr(aio_device):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: aio_instr
+    INIT VARIABLES: device (VISA resource)
+    INHERITANCE: aio_device
+    ----------------------------------------------------------------------------
+    Awaitable VISA session.
+    ----------------------------------------------------------------------------
+    """
+
+    async def write(self, message):
+        return await self.call(self.device.write, message)
+
+    async def read(self, **kwargs):
+        return await self.call(self.device.read, **kwargs)
+
+    async def query(self, message):
+        return await self.call(self.device.query, message)
+
+    async def wait_for_srq(self, timeout=25000):
+        return await self.call(self.device.wait_for_srq, timeout=timeout)
+
+    async def clear(self):
+        return await self.call(self.device.clear)
+
+    async def close(self):
+        await self.call(self.device.close)
+        self.release()
+
+
+class aio_mono(aio_device):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: aio_mono
+    INIT VARIABLES: device (cm110.mono)
+                    poll (float) --> 0.01
+    INHERITANCE: aio_device
+    ----------------------------------------------------------------------------
+    Awaitable monochromator. goto only returns once the CM110 has replied to
+    say the move is finished. In framed mode this is a blocking read on the
+    worker thread, otherwise the port is polled every poll seconds without
+    blocking the event loop.
+    ----------------------------------------------------------------------------
+    """
+
+    def __init__(self, device, poll=0.01):
+        aio_device.__init__(self, device)
+        self.__dict__["poll"] = poll
+
+    async def command(self, operation, *args):
+        return await self.call(self.device.command, operation, *args)
+
+    async def goto(self, wavelength):
+        if self.device.framed:
+            return await self.call(self.device.goto, wavelength)
+        await self.command("goto", wavelength)
+        while not await self.call(self.device.ready):
+            await asyncio.sleep(self.poll)
+        return await self.call(self.device.message_status)
+
+    async def close(self):
+        await self.call(self.device.close)
+        self.release()
+
+
+class aio_shutter(aio_device):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: aio_shutter
+    INIT VARIABLES: device (shutter.ard_shutter)
+    INHERITANCE: aio_device
+    ----------------------------------------------------------------------------
+    Awaitable Arduino shutter.
+    ----------------------------------------------------------------------------
+    """
+
+    async def open(self):
+        return await self.call(self.device.open)
+
+    async def close(self):
+        return await self.call(self.device.close)
+
+    async def query(self):
+        return await self.call(self.device.query)
+
+    async def shutdown(self):
+        await self.call(self.device.shutdown)
+        self.release()
+
+
+def run(coroutine, idle=None, interval=0.05):
+    """
+    ---------------------------------------------------------------------------
+    FUNCTION: run
+    INPUTS: coroutine
+            idle (callable) --> None
+            interval (float) --> 0.05
+    RETURNS: result of the coroutine
+    DEPENDENCIES: asyncio, concurrent.futures
+    ---------------------------------------------------------------------------
+    Runs a coroutine to completion from ordinary code. Inside a notebook the
+    kernel already has an event loop running, so the coroutine is given a
+    loop of its own on another thread. This thread then calls idle every
+    interval seconds until it is done, which is how a sweep's plotting is
+    kept off the other thread. From a notebook cell it is better to await
+    run_test, which runs everything on the kernel's own loop.
+    ---------------------------------------------------------------------------
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(asyncio.run, coroutine)
+        while idle is not None:
+            try:
+                return future.result(timeout=interval)
+            except TimeoutError:
+                idle()
+        return future.result()
+
+
+async def aux_readings(test, lia, ls331, start, freq=True):
+    """
+    ---------------------------------------------------------------------------
+    FUNCTION: aux_readings
+    INPUTS: test (K4200_test), lia, ls331 (aio_instr)
+            start (float), freq (bool)
+    RETURNS: t, mag, pha (float)
+    DEPENDENCIES: asyncio
+    ---------------------------------------------------------------------------
+    Awaitable version of K4200_test.aux_readings, reading the LIA and LS331
+    at the same time. Uses the background sampler instead if it is running.
+    ---------------------------------------------------------------------------
+    """
+    if test.sampler is not None:
+        t, mag, pha = [], [], []
+        test.aux_readings(start, t, mag, pha)
+        return t[0], mag[0], pha[0]
+
+    async def temperature():
+        try:
+            return float((await ls331.query('KRDG?')).replace('+', ''))
+        except:
+            return 0
+
+    async def lia_reads():
+        if freq:
+            test.lia_freq = float(await lia.query('FRQ'))/1000
+        mag = float(await lia.query('MAG'))/100
+        pha = float(await lia.query('PHA'))/1000
+        return mag, pha
+
+    t, (mag, pha) = await asyncio.gather(temperature(), lia_reads())
+    return t, mag, pha
+
+
+async def measure(test, k4200, lia, ls331):
+    """
+    ---------------------------------------------------------------------------
+    FUNCTION: measure
+    INPUTS: test (K4200_test), k4200, lia, ls331 (aio_instr)
+    RETURNS: nothing
+    DEPENDENCIES: asyncio
+    ---------------------------------------------------------------------------
+    Coroutine version of cv_no_v, cv_v and iv. Each repetition runs the
+    4200-SCS and reads the auxiliary instruments at the same time, the raw
+    results are then handed to the matching store method through defer.
+    ---------------------------------------------------------------------------
+    """
+    if test.mode == "iv":
+        kind = "iv"
+    elif test.mode == "cv" and not test.vrange_set:
+        kind = "spot"
+    else:
+        kind = "sweep"
+
+    async def sweep():
+        if kind == "sweep":
+            await k4200.write(":CVU:TEST:RUN")
+            await k4200.wait_for_srq()
+            return await k4200.call(test.read_k4200, ':CVU:DATA:Z?')
+        elif kind == "spot":
+            return await k4200.query(":CVU:MEASZ?")
+        await k4200.write("ME1")
+        await k4200.wait_for_srq(timeout=None)
+        return await k4200.call(test.read_k4200, "DO 'IA'", "NC")
+
+    data, t, mag, pha = [], [], [], []
+    for r in test.repeats:
+        start = monotonic()
+        if test.sampler is not None:
+            data.append(await sweep())
+            aux = await aux_readings(test, lia, ls331, start)
+        else:
+            d, aux = await asyncio.gather(
+                sweep(),
+                aux_readings(test, lia, ls331, start, kind == "sweep"))
+            data.append(d)
+        t.append(aux[0])
+        mag.append(aux[1])
+        pha.append(aux[2])
+        test.repeat_done(data[-1], mag[-1])
+
+    store = {"sweep": test.store_cv_no_v,
+             "spot": test.store_cv_v,
+             "iv": test.store_iv}[kind]
+    test.defer(store, data, t, mag, pha)
+
+
+async def run_multi_sweep(test):
+    """
+    ---------------------------------------------------------------------------
+    FUNCTION: run_multi_sweep
+    INPUTS: test (K4200_test)
+    RETURNS: 0
+    DEPENDENCIES: asyncio
+    ---------------------------------------------------------------------------
+    Coroutine version of K4200_test.run_multi_sweep, used by run_test when
+    use_asyncio is set. Expects begin_test to have been run already, and
+    leaves finish_multi_sweep to the caller, so the figure is finished on
+    the thread that drew it.
+    ---------------------------------------------------------------------------
+    """
+    k4200 = aio_instr(test.k4200)
+    lia = aio_instr(test.lia5302)
+    ls331 = aio_instr(test.ls331)
+    cm = aio_mono(test.cm)
+    sh = aio_shutter(test.sh)
+
+    await sh.open()
+    test.wavelengths = []
+    test.stream = None
+    if test.pipelined:
+        test.start_worker()
+    if test.sample_aux:
+        test.start_sampler()
+
+    for w in test.scan():
+        if test.wait > 0.5:
+            start = monotonic()
+            await asyncio.gather(sh.close(), cm.goto(w))
+            await asyncio.sleep(max(test.wait - (monotonic() - start), 0))
+            await sh.open()
+        else:
+            await cm.goto(w)
+
+        await measure(test, k4200, lia, ls331)
+        if test.stream_csv and test.stream is None:
+            await k4200.call(test.start_stream)
+        test.queue_wavelength(w)
+
+    for device in (k4200, lia, ls331, cm, sh):
+        device.release()
+    return 0
+
+
+async def run_test(test):
+    """
+    ---------------------------------------------------------------------------
+    FUNCTION: run_test
+    INPUTS: test (K4200_test)
+    RETURNS: nothing
+    DEPENDENCIES: asyncio
+    ---------------------------------------------------------------------------
+    Awaitable version of K4200_test.run_test for a notebook cell, as in
+    "await aio.run_test(test)". A stepped multi sweep runs as a coroutine on
+    the kernel's own event loop, so the live plot is drawn on the notebook's
+    thread. Any other sweep is run as run_test would run it.
+    ---------------------------------------------------------------------------
+    """
+    try:
+        test.begin_test()
+        if test.wrange_set and test.scan_speed is None:
+            await run_multi_sweep(test)
+            test.finish_multi_sweep()
+        else:
+            test.run_sweep()
+    except:
+        test.forget_state()
+        raise
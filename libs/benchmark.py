@@ -0,0 +1,441 @@
+import json
+import random
+import tempfile
+from decimal import Decimal
+from os import chdir, getcwd, path
+from threading import Lock
+from time import perf_counter, strftime
+
+from libs import Python_4200
+from libs import cm110
+from libs import datafile
+from libs import ki4200
+from libs import shutter
+from libs import simulator
+"""
+--------------------------------------------------------------------------------
+MODULE: benchmark.py
+REQUIRES: Python 3.4+
+DEPENDENCIES: json, tempfile, decimal, Python_4200, datafile, simulator
+--------------------------------------------------------------------------------
+This module times complete tests run through K4200_test.run_test and breaks
+each wavelength step down into the phases that make it up:
+    -mono_move    cm110 commands and waiting for their replies, so a goto
+                  is timed until the grating has stopped
+    -shutter      ard_shutter open and close
+    -settle       sleeps in Python_4200 (the wait between wavelengths)
+    -srq_wait     waiting for the 4200-SCS to finish a sweep
+    -data_read    reading results back from the 4200-SCS
+    -aux_query    LIA 5302 and LS331 queries
+    -parse        ki4200.parse_impedance
+    -plot         K4200_test.re_plot
+    -save         K4200_test.save_to_csv, the streamed csv rows and the
+                  finishing of the file, the column file and save_figure
+                  (the png export)
+Whatever is left of the step is reported as "other".
+
+Tests run against a simulated bench unless another resource manager and
+serial class are given, and the results are written out as JSON so that
+wavelengths per hour can be tracked between versions.
+
+parse_benchmark() separately times the impedance parser against the original
+Decimal based one on long sweeps.
+
+Example:
+    >>>python -m libs.benchmark --modes cv iv --time-scale 0.1 -o bench.json
+    >>>python -m libs.benchmark --parse 10000
+--------------------------------------------------------------------------------
+"""
+
+PHASES = ("mono_move", "shutter", "settle", "srq_wait", "data_read",
+          "aux_query", "parse", "plot", "save")
+
+
+class phase_timer(object):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: phase_timer
+    INHERITANCE: Object
+    ----------------------------------------------------------------------------
+    Collects the time spent in each phase, split into steps. A new step starts
+    every time the monochromator is sent to a new wavelength, anything timed
+    before the first step is put down to setup.
+
+    Functions are timed by wrapping them in place with wrap(), and every
+    wrapper is removed again by restore().
+    ----------------------------------------------------------------------------
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.patched = []
+        self.setup = dict.fromkeys(PHASES, 0.0)
+        self.steps = []
+
+    def new_step(self, wavelength):
+        with self.lock:
+            self.steps.append({"wavelength": wavelength,
+                               "start": perf_counter(),
+                               "phases": dict.fromkeys(PHASES, 0.0)})
+
+    def record(self, phase, seconds):
+        with self.lock:
+            phases = self.steps[-1]["phases"] if self.steps else self.setup
+            phases[phase] += seconds
+
+    def timed(self, function, phase):
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(phase, perf_counter() - start)
+        wrapper.__wrapped__ = function
+        return wrapper
+
+    def wrap(self, owner, name, phase):
+        self.patched.append((owner, name, vars(owner).get(name)))
+        setattr(owner, name, self.timed(getattr(owner, name), phase))
+
+    def restore(self):
+        for owner, name, original in reversed(self.patched):
+            if original is None:
+                delattr(owner, name)
+            else:
+                setattr(owner, name, original)
+        self.patched = []
+
+    def report(self, end):
+        """
+        ------------------------------------------------------------------------
+        Returns the list of steps with wall times, using end as the finish
+        time of the last step.
+        ------------------------------------------------------------------------
+        """
+        steps = []
+        for i, step in enumerate(self.steps):
+            finish = self.steps[i+1]["start"] if i+1 < len(self.steps) \
+                else end
+            wall = finish - step["start"]
+            phases = dict(step["phases"])
+            phases["other"] = max(wall - sum(phases.values()), 0.0)
+            steps.append({"wavelength": step["wavelength"],
+                          "wall": wall,
+                          "phases": phases})
+        return steps
+
+
+class timed_session(object):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: timed_session
+    INIT VARIABLES: session (VISA resource)
+                    timer (phase_timer)
+                    phase (str)
+    INHERITANCE: Object
+    ----------------------------------------------------------------------------
+    Wraps a VISA session so that reads and queries are put down to phase and
+    service request waits to srq_wait. Everything else is passed straight
+    through, including setting attributes such as timeout.
+    ----------------------------------------------------------------------------
+    """
+
+    def __init__(self, session, timer, phase):
+        self.__dict__["session"] = session
+        self.__dict__["timer"] = timer
+        self.__dict__["phase"] = phase
+
+    def __getattr__(self, name):
+        attr = getattr(self.session, name)
+        if name in ("read", "read_raw", "query"):
+            return self.timer.timed(attr, self.phase)
+        elif name == "wait_for_srq":
+            return self.timer.timed(attr, "srq_wait")
+        return attr
+
+    def __setattr__(self, name, value):
+        setattr(self.session, name, value)
+
+
+class timed_rm(object):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: timed_rm
+    INIT VARIABLES: rm (visa.ResourceManager)
+                    timer (phase_timer)
+                    k4200_address (str)
+    INHERITANCE: Object
+    ----------------------------------------------------------------------------
+    Resource manager wrapper handing out timed sessions. Reads from the
+    4200-SCS are data_read, reads from anything else are aux_query.
+    ----------------------------------------------------------------------------
+    """
+
+    def __init__(self, rm, timer, k4200_address):
+        self.rm = rm
+        self.timer = timer
+        self.k4200_address = k4200_address
+
+    def __getattr__(self, name):
+        return getattr(self.rm, name)
+
+    def open_resource(self, address, *args, **kwargs):
+        phase = "data_read" if address == self.k4200_address else "aux_query"
+        return timed_session(self.rm.open_resource(address, *args, **kwargs),
+                             self.timer, phase)
+
+
+def make_test(mode, multi=True, wstart=5000, wend=5500, wstep=100,
+              repetitions=3, wait=1):
+    """
+    ---------------------------------------------------------------------------
+    FUNCTION: make_test
+    INPUTS: mode (str), multi (bool)
+            wstart, wend, wstep, repetitions (int), wait (float)
+    RETURNS: test (K4200_test)
+    DEPENDENCIES: Python_4200
+    ---------------------------------------------------------------------------
+    Builds a cv, cf or iv test with the GUI defaults, set up for either a
+    wavelength sweep or a single wavelength.
+    ---------------------------------------------------------------------------
+    """
+    tests = {"cv": Python_4200.cv_test,
+             "cf": Python_4200.cf_test,
+             "iv": Python_4200.iv_test}
+    test = tests[mode]("bench_" + mode)
+    test.set_repetitions(repetitions)
+    test.wait = wait
+    if mode == "iv":
+        test.set_vrange(-5, 5, 1)
+    if multi:
+        test.set_wavelengths(wstart, wend, wstep)
+    else:
+        test.wrange_set = False
+        test.set_single_w(wstart)
+    return test
+
+
+def benchmark_test(test, rm=None, serial_class=None):
+    """
+    ---------------------------------------------------------------------------
+    FUNCTION: benchmark_test
+    INPUTS: test (K4200_test)
+            rm (visa.ResourceManager), serial_class (class)
+    RETURNS: result (dict)
+    DEPENDENCIES: Python_4200, cm110, datafile, ki4200, shutter
+    ---------------------------------------------------------------------------
+    Runs a single test with every phase timed and returns the timing report.
+    rm and serial_class default to whatever K4200_test is currently using.
+    ---------------------------------------------------------------------------
+    """
+    timer = phase_timer()
+    test_class = Python_4200.K4200_test
+    rm = rm or test_class.rm
+    serial_class = serial_class or test_class.serial_class
+    old = test_class.rm, test_class.serial_class
+    test_class.rm = timed_rm(rm, timer, test_class.k4200_address)
+    test_class.serial_class = serial_class
+
+    def command(mono, operation, *args):
+        if operation.lower() == "goto":
+            timer.new_step(args[0])
+        return original_command(mono, operation, *args)
+    original_command = cm110.mono.command
+
+    timer.patched.append((cm110.mono, "command", original_command))
+    cm110.mono.command = timer.timed(command, "mono_move")
+    # in framed mode command returns once written, the move is the reply
+    timer.wrap(cm110.mono, "read_frames", "mono_move")
+    timer.wrap(shutter.ard_shutter, "open", "shutter")
+    timer.wrap(shutter.ard_shutter, "close", "shutter")
+    timer.wrap(Python_4200, "sleep", "settle")
+    timer.wrap(ki4200, "parse_impedance", "parse")
+    timer.wrap(test_class, "re_plot", "plot")
+    timer.wrap(test_class, "save_to_csv", "save")
+    timer.wrap(test_class, "save_figure", "save")
+    timer.wrap(test_class, "stream_row", "save")
+    timer.wrap(test_class, "save_columns", "save")
+    timer.wrap(datafile.csv_stream, "finish", "save")
+    timer.wrap(datafile, "sort_csv", "save")
+    # the single wavelength sweep still exports through pyplot
+    timer.wrap(Python_4200.plt, "savefig", "save")
+
+    start = perf_counter()
+    try:
+        test.run_test()
+    finally:
+        end = perf_counter()
+        timer.restore()
+        # pooled sessions hold on to the timed wrappers, so don't reuse them
+        test_class.pool.close_all()
+        test_class.rm, test_class.serial_class = old
+
+    steps = timer.report(end)
+    total = end - start
+    measured = sum(s["wall"] for s in steps)
+    return {"mode": test.mode,
+            "type": "multi" if test.wrange_set else "single",
+            "repetitions": int(test.repetitions),
+            "wait": test.wait,
+            "total": total,
+            "setup": total - measured,
+            "setup_phases": timer.setup,
+            "steps": steps,
+            "wavelengths_per_hour": len(steps) / measured * 3600
+            if measured else 0.0}
+
+
+def decimal_parse(values):
+    """
+    ---------------------------------------------------------------------------
+    The original ki4200.CV_output_san, kept as the reference for
+    parse_benchmark.
+    ---------------------------------------------------------------------------
+    """
+    values = values.replace(";", ",").split(",")
+    prim = [float(Decimal(values[i])) for i in range(0, len(values), 2)]
+    sec = [float(values[i]) for i in range(1, len(values), 2)]
+    return prim, sec
+
+
+def parse_benchmark(points=10000, runs=20, seed=0):
+    """
+    ---------------------------------------------------------------------------
+    FUNCTION: parse_benchmark
+    INPUTS: points, runs, seed (int)
+    RETURNS: report (dict)
+    DEPENDENCIES: random, ki4200
+    ---------------------------------------------------------------------------
+    Builds a :CVU:DATA:Z? payload of the given number of points, checks that
+    ki4200.parse_impedance agrees with decimal_parse on it, and returns the
+    best of runs timings of each in seconds, for the string and for the raw
+    bytes read_raw() would return.
+    ---------------------------------------------------------------------------
+    """
+    rand = random.Random(seed)
+    values = ",".join("{0:.6E};{1:.6E}".format(
+        rand.uniform(1e-12, 1e-9), rand.gauss(1e-3, 1e-4))
+        for i in range(points))
+    raw = values.encode()
+
+    prim, sec = decimal_parse(values)
+    z = ki4200.parse_impedance(raw)
+    if z[:, 0].tolist() != prim or z[:, 1].tolist() != sec:
+        raise AssertionError("parse_impedance disagrees with decimal_parse")
+
+    def best(function, data):
+        times = []
+        for r in range(runs):
+            start = perf_counter()
+            function(data)
+            times.append(perf_counter() - start)
+        return min(times)
+
+    report = {"points": points,
+              "runs": runs,
+              "decimal_parse": best(decimal_parse, values),
+              "parse_impedance": best(ki4200.parse_impedance, values),
+              "parse_impedance_bytes": best(ki4200.parse_impedance, raw)}
+    report["speedup"] = report["decimal_parse"] / report["parse_impedance"]
+    return report
+
+
+def run_suite(modes=("cv", "cf", "iv"), multi=(True, False), bench=None,
+              output=None, **test_kwargs):
+    """
+    ---------------------------------------------------------------------------
+    FUNCTION: run_suite
+    INPUTS: modes (str tuple), multi (bool tuple)
+            bench (simulator.sim_bench), output (str)
+            **test_kwargs --> make_test
+    RETURNS: report (dict)
+    DEPENDENCIES: json, tempfile, simulator
+    ---------------------------------------------------------------------------
+    Benchmarks every combination of mode and single/multi wavelength. If no
+    bench is given a simulated one is installed, pass bench=False to run on
+    whatever K4200_test is already set up to use. Test data is written to a
+    temporary folder, and the report is saved as JSON to output if given.
+    ---------------------------------------------------------------------------
+    """
+    if bench is None:
+        bench = simulator.sim_bench(seed=0)
+    if bench:
+        bench.install(Python_4200.K4200_test)
+
+    report = {"date": strftime("%Y-%m-%d %H:%M:%S"),
+              "time_scale": bench.time_scale if bench else 1.0,
+              "latencies": bench.latency if bench else None,
+              "results": []}
+    cwd = getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        chdir(folder)
+        try:
+            for mode in modes:
+                for m in multi:
+                    test = make_test(mode, multi=m, **test_kwargs)
+                    report["results"].append(benchmark_test(test))
+                    Python_4200.K4200_test.last_test = \
+                        "iv" if mode == "iv" else "c"
+        finally:
+            chdir(cwd)
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    """
+    ----------------------------------------------------------------------------
+    Runs the benchmark suite on a simulated bench and prints a summary.
+    ----------------------------------------------------------------------------
+    """
+    import argparse
+    import matplotlib
+    matplotlib.use("Agg")
+
+    parser = argparse.ArgumentParser(description="CVW sweep benchmark")
+    parser.add_argument("--modes", nargs="+", default=["cv", "cf", "iv"])
+    parser.add_argument("--parse", type=int, metavar="POINTS",
+                        help="only benchmark the impedance parser")
+    parser.add_argument("--single", action="store_true",
+                        help="also run single wavelength tests")
+    parser.add_argument("--time-scale", type=float, default=1.0)
+    parser.add_argument("--wstart", type=int, default=5000)
+    parser.add_argument("--wend", type=int, default=5500)
+    parser.add_argument("--wstep", type=int, default=100)
+    parser.add_argument("--repetitions", type=int, default=3)
+    parser.add_argument("--wait", type=float, default=1)
+    parser.add_argument("-o", "--output", default=path.join(
+        getcwd(), "bench_{0}.json".format(strftime("%Y-%m-%d_%H.%M.%S"))))
+    args = parser.parse_args()
+
+    if args.parse:
+        r = parse_benchmark(args.parse)
+        for name in ("decimal_parse", "parse_impedance",
+                     "parse_impedance_bytes"):
+            print("{0:<22} {1:8.3f} ms".format(name, r[name] * 1000))
+        print("{0} points, {1:.1f}x faster".format(r["points"], r["speedup"]))
+        raise SystemExit
+
+    report = run_suite(
+        modes=args.modes,
+        multi=(True, False) if args.single else (True,),
+        bench=simulator.sim_bench(time_scale=args.time_scale, seed=0),
+        output=args.output, wstart=args.wstart, wend=args.wend,
+        wstep=args.wstep, repetitions=args.repetitions, wait=args.wait)
+
+    for r in report["results"]:
+        print("{0} {1}: {2:.2f} s total, {3:.1f} wavelengths/hour".format(
+            r["mode"], r["type"], r["total"], r["wavelengths_per_hour"]))
+        phases = {}
+        for step in r["steps"]:
+            for name, t in step["phases"].items():
+                phases[name] = phases.get(name, 0) + t
+        for name, t in sorted(phases.items(), key=lambda p: -p[1]):
+            print("    {0:<10} {1:8.3f} s".format(name, t))
+    print("Report written to", args.output)
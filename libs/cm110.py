@@ -1,20 +1,29 @@
 import serial
-from time import sleep
+import struct
+from collections import namedtuple
+from time import monotonic, sleep
 """
 --------------------------------------------------------------------------------
 MODULE: cm110.py
 WRITTEN IN: Python 3.4
-DEPENDENCIES: pyserial, time.sleep
+DEPENDENCIES: pyserial, struct, collections.namedtuple, time
 AUTHOR: Finlay TD Knops-Mckim
 LAST MODIFIED: 2015/08/15
 --------------------------------------------------------------------------------
 This module contains a single class (and demo) for controlling the Specrtal
 Products CM110 Compact Monochromator.
 
+Every reply from the CM110 is a fixed length frame ending in the cancel byte
+(24): the status byte on its own, or the high and low data bytes and then
+the status byte for a query. Replies are read a whole frame (or several) at
+a time and unpacked with struct, and any bytes of a frame that has not fully
+arrived are kept for the next read.
+
 Example:
     >>>import cm110.py              # import library
     >>>M1 = cm110.mono(port=COM2)   # monochromator at port COM2
     >>>M1.goto(5500)                # Goto 550nm, green light
+    >>>M1.query().grooves           # Grooves/mm of the current grating
     >>>M1.close()                   # Finish the session
 
 Information on the CM110 can be found at:
@@ -22,6 +31,38 @@ http://www.spectralproducts.com/cm110
 --------------------------------------------------------------------------------
 """
 
+CANCEL = 24
+ECHO_FRAME = struct.Struct(">B")        # echo byte (27)
+STATUS_FRAME = struct.Struct(">BB")     # status byte, cancel byte
+DATA_FRAME = struct.Struct(">HBB")      # high/low data bytes, status, cancel
+
+# query specifiers, in the order of the mono_config fields
+QUERY_BYTES = (0, 1, 2, 3, 4, 5, 6, 13, 14, 19)
+
+
+class mono_config(namedtuple("mono_config", (
+        "position", "type", "grooves", "blaze", "grating", "speed", "size",
+        "gratings", "units", "serial", "status"))):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: mono_config
+    INIT VARIABLES: position, type, grooves, blaze, grating, speed, size,
+                    gratings, units, serial, status (int or None)
+    INHERITANCE: namedtuple
+    ----------------------------------------------------------------------------
+    The configuration of a CM110 as read by mono.query, one int per query
+    specifier, or None for a field that was not received. status is the
+    status byte of the last reply.
+    ----------------------------------------------------------------------------
+    """
+
+    __slots__ = ()
+
+    labels = ("Position:", "Type:", "Grooves/mm:", "Blaze:", "Grating No:",
+              "Speed:", "Size:", "No. of Gratings:", "Current Units:",
+              "Serial No.")
+
 
 class mono(object):
 
@@ -30,6 +71,9 @@ class mono(object):
     CLASS: mono
     INIT VARIABLES: port (string) --> "COM1"
                     debug (boolean) --> False
+                    serial_class (class) --> serial.Serial
+                    framed (boolean) --> False
+                    timeout (float) --> 30
     INHERITANCE: Object
     ----------------------------------------------------------------------------
     An instance of this class represents a single monochromator. The user need
@@ -42,12 +86,33 @@ class mono(object):
 
     When the user is finished with sending commands they should call the close
     method to free up the serial port.
+
+    serial_class can be swapped for anything with the pyserial interface, such
+    as the simulated ports in simulator.py.
+
+    By default each byte is sent separately with a 50ms pause, and replies are
+    collected by polling the port every poll seconds. With framed set, each
+    command is written in a single write and the reply is waited for with a
+    blocking read, which returns as soon as the cancel byte (24) arrives.
+    Either way timeout is the longest a reply is waited for in seconds, so
+    should cover the slowest move.
+
+    The configuration read by the last query is kept in config.
     ----------------------------------------------------------------------------
     """
 
-    def __init__(self, port: str="COM1", debug: bool=False):
+    poll = 0.01
+
+    def __init__(self, port: str="COM1", debug: bool=False,
+                 serial_class=serial.Serial, framed: bool=False,
+                 timeout: float=30):
         self.debug = debug
         self.port = port
+        self.serial_class = serial_class
+        self.framed = framed
+        self.timeout = timeout
+        self.pending = bytearray()
+        self.config = None
         self.setup_cm110()
 
     def __repr__(self):
@@ -64,24 +129,24 @@ class mono(object):
         method.
         ------------------------------------------------------------------------
         """
-        self.cm = serial.Serial(
+        self.cm = self.serial_class(
             port=self.port,
             baudrate=9600,
             bytesize=serial.EIGHTBITS,
             parity=serial.PARITY_NONE,
-            stopbits=serial.STOPBITS_ONE
+            stopbits=serial.STOPBITS_ONE,
+            timeout=self.timeout if self.framed else None
         )
 
     def send(self, item: int):
-        self.cm.write(chr(item).encode())
+        self.cm.write(bytes([item]))
         sleep(0.05)
 
-    def command(self, operation: str, *args):
+    def frame(self, operation: str, *args):
         """
         ------------------------------------------------------------------------
-        *args should contain one argument except when the operation is:
-        -reset, no arguments
-        -scan, two arguments
+        Builds the list of bytes making up a command, see command for the
+        arguments. Returns an empty list for an invalid command.
         ------------------------------------------------------------------------
         """
 
@@ -95,32 +160,100 @@ class mono(object):
             x = args[0] if args else None
         except:
             print("Invalid command")
+            return []
 
         if c in [51, 56, 26, 55, 50]:
-            self.send(c)
-            self.send(x)
+            return [c, x]
 
         elif c in [18, 16, 13]:
-            high, low = divmod(x, 0x100)
-            self.send(c)
-            self.send(high)
-            self.send(low)
+            return [c] + list(divmod(x, 0x100))
 
-        elif c is 255:
-            for i in range(3):
-                self.send(255)
+        elif c == 255:
+            return [255] * 3
 
-        elif c is 12:
+        elif c == 12:
             y = args[1]
-            s_high, s_low = divmod(x, 0x100)
-            e_high, e_low = divmod(y, 0x100)
-            self.send(c)
+            return [c] + list(divmod(x, 0x100)) + list(divmod(y, 0x100))
+
+        return [c]
+
+    def command(self, operation: str, *args):
+        """
+        ------------------------------------------------------------------------
+        *args should contain one argument except when the operation is:
+        -reset, no arguments
+        -scan, two arguments
 
-            self.send(s_high)
-            self.send(s_low)
+        In framed mode any unread replies are thrown away first, so that the
+        next reply read belongs to this command.
+        ------------------------------------------------------------------------
+        """
+        frame = self.frame(operation, *args)
+        if self.framed:
+            self.discard()
+            self.cm.write(bytes(frame))
+        else:
+            for item in frame:
+                self.send(item)
 
-            self.send(e_high)
-            self.send(e_low)
+    def discard(self):
+        """
+        ------------------------------------------------------------------------
+        Throws away every reply received but not yet read, including any part
+        of a frame kept from an earlier read.
+        ------------------------------------------------------------------------
+        """
+        self.cm.reset_input_buffer()
+        self.pending = bytearray()
+
+    def read_frames(self, layout, count: int=1):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: read_frames
+        INPUTS: self, layout (struct.Struct), count (int) --> 1
+        RETURNS: frames (list of tuples)
+        DEPENDENCIES: struct, time
+        ------------------------------------------------------------------------
+        Reads count replies laid out as layout and returns each unpacked into
+        a tuple. The bytes still missing are read in as few reads as possible:
+        in framed mode a single blocking read, otherwise all that is waiting
+        each time the port is polled. Any bytes past the last frame, or a part
+        frame left when the timeout runs out, are kept for the next call, so
+        fewer than count frames are returned on a timeout.
+        ------------------------------------------------------------------------
+        """
+        size = layout.size * count
+        end = monotonic() + self.timeout
+        while len(self.pending) < size:
+            if self.framed:
+                self.cm.timeout = max(end - monotonic(), 0)
+                data = self.cm.read(size - len(self.pending))
+            else:
+                waiting = self.cm.inWaiting()
+                data = self.cm.read(waiting) if waiting else b""
+            self.pending += data
+            if len(self.pending) >= size or monotonic() >= end:
+                break
+            if not self.framed and not data:
+                sleep(self.poll)
+        n = min(len(self.pending) // layout.size, count)
+        frames = [layout.unpack_from(self.pending, i * layout.size)
+                  for i in range(n)]
+        del self.pending[:n * layout.size]
+        if layout is not ECHO_FRAME and any(f[-1] != CANCEL for f in frames):
+            # out of step with the replies, so nothing buffered can be trusted
+            self.pending = bytearray()
+        return frames
+
+    def ready(self, size: int=2):
+        """
+        ------------------------------------------------------------------------
+        Returns whether a reply of at least size bytes is waiting, without
+        reading it. Used to find out when a scan has finished while other
+        instruments are being read.
+        ------------------------------------------------------------------------
+        """
+        return len(self.pending) + self.cm.inWaiting() >= size
 
     def close(self):
         """
@@ -135,41 +268,32 @@ class mono(object):
         ------------------------------------------------------------------------
         Interprets data received from the Monochromator in the format of a high
         and low byte. Also reads the status and message bytes. If the message
-        byte is not equal to 24 the function returns -1 to signify an error.
+        byte is not equal to 24 (or no reply came) the function returns -1 to
+        signify an error.
         ------------------------------------------------------------------------
         """
-        raw = []
-        sleep(0.01)
-        for j in range(self.cm.inWaiting()):
-            raw += self.cm.read()
-        data = int(hex(raw[0]) + hex(raw[1]).replace('0x', ''), 16)
-        status = raw[2]
-        message = raw[3]
-        try:
-            assert(message == 24)
-            return data, status, message
-        except AssertionError:
+        frames = self.read_frames(DATA_FRAME)
+        if not frames or frames[0][2] != CANCEL:
             return -1
+        return frames[0]
 
     def message_status(self, raw=None):
         """
         ------------------------------------------------------------------------
-        Reads in the status and message bits and
+        Reads in the status and message bytes, or takes them from raw, and
+        returns the status messages. Returns -1 if there was no reply or the
+        message byte is not 24.
         ------------------------------------------------------------------------
         """
         if not raw:
-            raw = []
-            for j in range(self.cm.inWaiting()):
-                raw += self.cm.read()
-                sleep(0.1)
-        status = raw[0]
-        message = raw[1]
-        stat_message = self.status(status)
-        try:
-            assert message == 24
-            return stat_message
-        except AssertionError:
+            frames = self.read_frames(STATUS_FRAME)
+            if not frames:
+                return -1
+            raw = frames[0]
+        status, message = raw[0], raw[1]
+        if message != CANCEL:
             return -1
+        return self.status(status)
 
     def status(self, status: int):
         """
@@ -250,8 +374,8 @@ class mono(object):
         """
 
         self.command("echo")
-        sleep(0.01)
-        if chr(27) == self.cm.read().decode():
+        reply = self.read_frames(ECHO_FRAME)
+        if reply and reply[0][0] == 27:
             return("Echo test succesful")
         else:
             return("No response recieved")
@@ -263,9 +387,9 @@ class mono(object):
         ------------------------------------------------------------------------
         """
         self.command("goto", wavelength)
-        while self.cm.inWaiting() < 2:
-            sleep(0.1)
         stat_message = self.message_status()
+        if self.config is not None and stat_message != -1:
+            self.config = self.config._replace(position=wavelength)
         if self.debug:
             return stat_message
         else:
@@ -297,45 +421,45 @@ class mono(object):
         else:
             return 0
 
-    def query(self):
-        """
-        ------------------------------------------------------------------------
-
-        ------------------------------------------------------------------------
-        """
-        # self.cm.read(self.cm.inWaiting())
-        sleep(0.1)
-        print("CURRENT CONGIGURATION")
-        print("=====================")
-        properties = ("Position:",
-                      "Type:",
-                      "Grooves/mm:",
-                      "Blaze:",
-                      "Grating No:",
-                      "Speed:",
-                      "Size:",
-                      "No. of Gratings:",
-                      "Current Units:",
-                      "Serial No.")
-        q_bytes = list(range(7)) + [13, 14, 19]
-        i = 0
-        for q in q_bytes:
-
-            self.command("query", q)
-            raw = []
-            sleep(0.05)
-            try:
-                for j in range(self.cm.inWaiting()):
-                    raw += self.cm.read()
-                data = int(hex(raw[0]) + hex(raw[1]).replace('0x', ''), 16)
-            except:
-                data = "Not recieved"
-            print(properties[i], data)
-            i += 1
-        print("\nSTATUS BYTE REPORT")
-        print("==================")
-        for m in self.message_status(raw=[raw[2], raw[3]]):
-            print(m)
+    def query(self, show: bool=True):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: query
+        INPUTS: self, show (bool) --> True
+        RETURNS: config (mono_config)
+        DEPENDENCIES: struct
+        ------------------------------------------------------------------------
+        Reads the whole configuration in one exchange: all ten query commands
+        are sent before any reply is read, then the ten replies are read back
+        together. The result is kept in config (the position is kept up to
+        date by goto) and returned. With show it is printed along with the
+        status byte of the last reply.
+        ------------------------------------------------------------------------
+        """
+        self.discard()
+        frames = [self.frame("query", q) for q in QUERY_BYTES]
+        if self.framed:
+            self.cm.write(bytes(sum(frames, [])))
+        else:
+            for item in sum(frames, []):
+                self.send(item)
+        replies = self.read_frames(DATA_FRAME, len(frames))
+        values = [r[0] if r[2] == CANCEL else None for r in replies]
+        values += [None] * (len(frames) - len(values))
+        status = replies[-1][1] if replies else None
+        self.config = mono_config(*values, status=status)
+
+        if show:
+            print("CURRENT CONGIGURATION")
+            print("=====================")
+            for label, value in zip(mono_config.labels, values):
+                print(label, "Not recieved" if value is None else value)
+            if status is not None:
+                print("\nSTATUS BYTE REPORT")
+                print("==================")
+                for m in self.status(status):
+                    print(m)
+        return self.config
 
     def reset(self):
         """
@@ -353,7 +477,6 @@ class mono(object):
         ------------------------------------------------------------------------
         """
         self.command("scan", start, end)
-        sleep(0.1)
         print(self.message_status())
 
     def speed(self, speed: int):
@@ -363,8 +486,10 @@ class mono(object):
         ------------------------------------------------------------------------
         """
         self.command("speed", speed)
-        sleep(0.01)
-        print(self.message_status())
+        stat_message = self.message_status()
+        if self.config is not None and stat_message != -1:
+            self.config = self.config._replace(speed=speed)
+        print(stat_message)
 
     def step(self):
         pass
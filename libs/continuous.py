@@ -0,0 +1,142 @@
+import numpy as np
+from time import monotonic
+"""
+--------------------------------------------------------------------------------
+MODULE: continuous.py
+REQUIRES: Python 3.4+
+DEPENDENCIES: numpy, time.monotonic
+--------------------------------------------------------------------------------
+This module contains the timing for continuous multi wavelength scans. Rather
+than stopping the monochromator at each wavelength and waiting for it to
+settle, the CM110 is told to scan the whole range at a set speed and the
+measurements are taken back to back while it moves. Each measurement is
+timestamped, and afterwards its wavelength is worked out from how far
+through the scan it was taken.
+
+The CM110 only replies to a scan once the grating has stopped, so the time
+that reply arrives gives the real length of the scan. Where it is known it is
+used instead of the length worked out from the speed, which takes up any
+difference between the nominal and actual scan rate.
+
+The samples are then put into wavelength steps, each step's samples being
+stored as its repetitions, so a continuous scan is saved and plotted the same
+way as a stepped one.
+
+Example:
+    >>>clock = scan_clock(4000, 7000, 50)   # 50 angstroms per second
+    >>>clock.begin()                        # as the scan command is sent
+    >>>...                                  # sample, keeping the times
+    >>>clock.finish()                       # when the CM110 replies
+    >>>ws = clock.wavelength(times)
+    >>>for w, rows in bin_samples(ws, 4000, 7000, 100):
+    ...    store(w, [samples[i] for i in rows])
+--------------------------------------------------------------------------------
+"""
+
+
+class scan_clock(object):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: scan_clock
+    INIT VARIABLES: start, end (int)
+                    speed (float, units per second)
+    INHERITANCE: Object
+    ----------------------------------------------------------------------------
+    Maps monotonic times to the wavelength of a scan from start to end (in
+    either direction) that began at began. The grating is taken to move at
+    a constant rate, so the wavelength is in proportion to the time since
+    began, reaching end after duration seconds. Times before the scan give
+    start and times after it give end.
+
+    Until finish() is called the duration is the nominal one from the speed.
+    ----------------------------------------------------------------------------
+    """
+
+    def __init__(self, start, end, speed):
+        if speed <= 0:
+            raise ValueError("speed must be positive")
+        self.start = int(start)
+        self.end = int(end)
+        self.speed = float(speed)
+        self.began = None
+        self.ended = None
+
+    def __repr__(self):
+        return "%s(%r, %r, %r)" % (self.__class__, self.start, self.end,
+                                   self.speed)
+
+    @property
+    def nominal(self):
+        return abs(self.end - self.start) / self.speed
+
+    @property
+    def duration(self):
+        if self.began is not None and self.ended is not None and (
+                self.ended > self.began):
+            return self.ended - self.began
+        return self.nominal
+
+    def begin(self, t=None):
+        self.began = monotonic() if t is None else t
+        self.ended = None
+
+    def finish(self, t=None):
+        self.ended = monotonic() if t is None else t
+
+    def deadline(self, margin=2.0, grace=10.0):
+        """
+        ------------------------------------------------------------------------
+        Returns the time by which the scan should certainly be over, margin
+        times its nominal length plus grace seconds after it began. Past this
+        the CM110 reply is no longer waited for.
+        ------------------------------------------------------------------------
+        """
+        return self.began + margin * self.nominal + grace
+
+    def wavelength(self, t):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: wavelength
+        INPUTS: self, t (float or float array, monotonic time)
+        RETURNS: wavelength (float or float array)
+        DEPENDENCIES: numpy
+        ------------------------------------------------------------------------
+        Returns where the grating was at time t. begin() must have been
+        called first.
+        ------------------------------------------------------------------------
+        """
+        duration = self.duration
+        done = (np.asarray(t, dtype=float) - self.began) / duration \
+            if duration > 0 else np.ones(np.shape(t))
+        return self.start + (self.end - self.start) * np.clip(done, 0, 1)
+
+
+def bin_samples(wavelengths, start, end, step):
+    """
+    ---------------------------------------------------------------------------
+    FUNCTION: bin_samples
+    INPUTS: wavelengths (float array), start, end, step (int)
+    RETURNS: bins (list of (int, int list))
+    DEPENDENCIES: numpy
+    ---------------------------------------------------------------------------
+    Puts each sample into the nearest wavelength of start, start + step, ...
+    up to end (step is negative for a falling scan). Returns a list of
+    (wavelength, sample indices) in the order the wavelengths were first
+    reached, leaving out any wavelength no sample fell into. Samples outside
+    the range are dropped.
+    ---------------------------------------------------------------------------
+    """
+    w = np.asarray(wavelengths, dtype=float)
+    count = int(abs(end - start) // abs(step)) + 1
+    index = np.rint((w - start) / step).astype(int)
+    bins = []
+    rows = {}
+    for i, b in enumerate(index.tolist()):
+        if not 0 <= b < count:
+            continue
+        if b not in rows:
+            rows[b] = []
+            bins.append((start + b * step, rows[b]))
+        rows[b].append(i)
+    return bins
@@ -0,0 +1,239 @@
+import csv
+import json
+import numpy as np
+import struct
+from os import fsync, path, remove, replace
+"""
+--------------------------------------------------------------------------------
+MODULE: datafile.py
+REQUIRES: Python 3.4+
+DEPENDENCIES: csv, json, numpy, os, struct
+--------------------------------------------------------------------------------
+This module contains writers for test results that save data as it is taken
+rather than all at once at the end of a test, so that an overnight sweep that
+fails part way through still leaves everything measured up to that point on
+disk.
+
+csv_stream writes to a ".part" file next to the final one, flushing every row
+to disk as it is added. finish() then renames it into place in one step, so
+the final file is either missing or complete, never half written. sort_csv()
+puts the rows of a finished file in order, replacing it the same way.
+
+write_columns() saves a set of named numpy arrays and a JSON metadata block to
+a single binary file, and column_file reads them back memory mapped, so a
+slice of one array can be read without loading the rest of the file. The
+layout is:
+    -8 byte magic, COLUMN_MAGIC
+    -8 byte little endian length of the JSON header
+    -JSON header: {"metadata": {...}, "arrays": {name: dtype, shape, offset}}
+    -each array as raw C ordered data, starting on a COLUMN_ALIGN boundary
+
+Example:
+    >>>f = csv_stream("data.csv", ["Wavelengths (A)", "-1.0 V", "1.0 V"])
+    >>>f.append([5000, 1.2e-10, 1.1e-10])
+    >>>f.append([5100, 1.3e-10, 1.2e-10])
+    >>>f.finish()
+    >>>write_columns("data.cvw", {"primary": prim}, {"mode": "cv"})
+    >>>column_file("data.cvw")["primary"][10:20, 0]
+--------------------------------------------------------------------------------
+"""
+
+COLUMN_MAGIC = b"CVWCOL01"
+COLUMN_ALIGN = 64
+
+
+class csv_stream(object):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: csv_stream
+    INIT VARIABLES: filename (str), header (list)
+                    sync (bool) --> True
+    INHERITANCE: Object
+    ----------------------------------------------------------------------------
+    Appends rows to filename + ".part", each one flushed (and with sync,
+    forced to disk) before append returns. Nothing is held in memory between
+    rows. If a test crashes the ".part" file is left behind holding every row
+    written so far.
+    ----------------------------------------------------------------------------
+    """
+
+    def __init__(self, filename, header, sync=True):
+        self.filename = filename
+        self.part = filename + ".part"
+        self.sync = sync
+        self.rows = 0
+        self.file = open(self.part, "w", newline="")
+        self.writer = csv.writer(self.file)
+        self.write(header)
+
+    def __repr__(self):
+        return "%s(%r, %r rows)" % (self.__class__, self.filename, self.rows)
+
+    @property
+    def closed(self):
+        return self.file.closed
+
+    def write(self, row):
+        self.writer.writerow(row)
+        self.file.flush()
+        if self.sync:
+            fsync(self.file.fileno())
+
+    def append(self, row):
+        self.write(row)
+        self.rows += 1
+
+    def finish(self):
+        """
+        ------------------------------------------------------------------------
+        Closes the ".part" file and renames it to filename, replacing any file
+        already there.
+        ------------------------------------------------------------------------
+        """
+        if self.closed:
+            return
+        self.file.close()
+        replace(self.part, self.filename)
+
+    def abort(self, keep=True):
+        """
+        ------------------------------------------------------------------------
+        Closes the ".part" file without finishing it, deleting it unless keep
+        is set.
+        ------------------------------------------------------------------------
+        """
+        if self.closed:
+            return
+        self.file.close()
+        if not keep and path.exists(self.part):
+            remove(self.part)
+
+
+def sort_csv(filename, column=0):
+    """
+    ---------------------------------------------------------------------------
+    FUNCTION: sort_csv
+    INPUTS: filename (str), column (int) --> 0
+    RETURNS: nothing
+    DEPENDENCIES: csv, os
+    ---------------------------------------------------------------------------
+    Sorts the rows of a csv file after its header by the number in column,
+    keeping rows with equal values in the order they were. The sorted file
+    is written under a ".part" name and renamed into place.
+    ---------------------------------------------------------------------------
+    """
+    with open(filename, newline="") as f:
+        rows = list(csv.reader(f))
+    if len(rows) < 3:
+        return
+    header, rows = rows[0], rows[1:]
+    rows.sort(key=lambda row: float(row[column]))
+    part = filename + ".part"
+    with open(part, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+        f.flush()
+        fsync(f.fileno())
+    replace(part, filename)
+
+
+def write_columns(filename, arrays, metadata=None):
+    """
+    ---------------------------------------------------------------------------
+    FUNCTION: write_columns
+    INPUTS: filename (str), arrays (dict, name --> array)
+            metadata (dict) --> None
+    RETURNS: nothing
+    DEPENDENCIES: json, numpy, struct
+    ---------------------------------------------------------------------------
+    Writes arrays and metadata to filename in the layout described above.
+    Arrays are stored little endian. metadata must be JSON serialisable. The
+    file is written under a ".part" name and renamed into place once
+    complete.
+    ---------------------------------------------------------------------------
+    """
+    arrays = {name: np.ascontiguousarray(
+        a, dtype=np.asarray(a).dtype.newbyteorder("<"))
+        for name, a in arrays.items()}
+
+    # offsets depend on the header length, so lay out until it stops growing
+    offsets = {}
+    header = b""
+    while True:
+        start = len(COLUMN_MAGIC) + 8 + len(header)
+        offset = start
+        for name, a in arrays.items():
+            offset = -(-offset // COLUMN_ALIGN) * COLUMN_ALIGN
+            offsets[name] = offset
+            offset += a.nbytes
+        layout = json.dumps({
+            "metadata": metadata or {},
+            "arrays": {name: {"dtype": a.dtype.str,
+                              "shape": list(a.shape),
+                              "offset": offsets[name]}
+                       for name, a in arrays.items()}}).encode()
+        if len(layout) <= len(header):
+            break
+        header = layout + b" " * 64
+    header = layout + b" " * (len(header) - len(layout))
+
+    part = filename + ".part"
+    with open(part, "wb") as f:
+        f.write(COLUMN_MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for name, a in arrays.items():
+            f.write(b"\0" * (offsets[name] - f.tell()))
+            f.write(a.tobytes())
+        f.flush()
+        fsync(f.fileno())
+    replace(part, filename)
+
+
+class column_file(object):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: column_file
+    INIT VARIABLES: filename (str)
+    INHERITANCE: Object
+    ----------------------------------------------------------------------------
+    Reads a file written by write_columns. Only the header is read when it is
+    opened. file[name] returns a read only memory map of that array, so
+    slicing it only reads the part of the file that is asked for, and
+    load(name) returns an ordinary in-memory copy.
+    ----------------------------------------------------------------------------
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            if f.read(len(COLUMN_MAGIC)) != COLUMN_MAGIC:
+                raise ValueError("{0} is not a column file".format(filename))
+            size, = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(size).decode())
+        self.metadata = header["metadata"]
+        self.arrays = header["arrays"]
+
+    def __repr__(self):
+        return "%s(%r, %r)" % (self.__class__, self.filename,
+                               sorted(self.arrays))
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    def __getitem__(self, name):
+        a = self.arrays[name]
+        shape = tuple(a["shape"])
+        if not np.prod(shape):
+            return np.empty(shape, dtype=a["dtype"])
+        return np.memmap(self.filename, dtype=a["dtype"], mode="r",
+                         offset=a["offset"], shape=shape)
+
+    def keys(self):
+        return self.arrays.keys()
+
+    def load(self, name):
+        return np.array(self[name])
@@ -0,0 +1,274 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+from time import monotonic, sleep
+"""
+--------------------------------------------------------------------------------
+MODULE: discovery.py
+REQUIRES: Python 3.4+
+DEPENDENCIES: json, concurrent.futures
+--------------------------------------------------------------------------------
+This module contains the probing used by K4200_test.com_discovery and
+K4200_test.visa_discovery. Every port or VISA resource is probed at the same
+time on its own thread, each with its own timeout, so one silent instrument
+no longer holds up the rest.
+
+What was found is saved to a small JSON cache. Next time, the cached ports
+are probed first and only if one of them no longer answers is every port
+scanned again. For VISA instruments the cache also records which
+identification query each address answered, so a known instrument is
+confirmed with that one query alone.
+
+Example:
+    >>>found = scan_com_ports(["COM1", "COM12"], serial.Serial)
+    >>>found
+    {'Monochromator': 'COM1', 'Shutter': 'COM12'}
+    >>>save_cache("discovery.json", "com", found)
+    >>>scan_visa(rm, rm.list_resources())
+    {'GPIB0::17::INSTR': {'model': 'KI4200', 'query': 'ID'}, ...}
+--------------------------------------------------------------------------------
+"""
+
+# reply fragment --> device, checked in this order
+COM_REPLIES = (("Shutter", "Shutter"),
+               (chr(27), "Monochromator"),
+               ("q", "5320 LIA"))
+
+# identification dialects, tried in this order on unknown instruments. Most
+# instruments answer the IEEE 488.2 query so it goes first.
+VISA_QUERIES = ('*IDN?', 'ID?', 'ID')
+
+# model names looked for in identification replies
+VISA_MODELS = ('MODEL331S',
+               'MODEL 2440',
+               '34970A',
+               '5302',
+               'KI4200',
+               'HP6634A')
+
+
+def probe_com_port(port, serial_class, timeout=3, boot=2, interval=0.05):
+    """
+    ---------------------------------------------------------------------------
+    FUNCTION: probe_com_port
+    INPUTS: port (str), serial_class (class)
+            timeout, boot, interval (float)
+    RETURNS: device (str) or None
+    DEPENDENCIES: time
+    ---------------------------------------------------------------------------
+    Opens port, waits boot seconds for an Arduino to come out of the reset
+    opening its port causes, then sends the shutter query 'q' and the
+    monochromator echo (27) once. The port is read every interval seconds
+    until one of the replies in COM_REPLIES comes back or timeout seconds
+    have passed since it was opened. The probe is not repeated, so whatever
+    else is on the port only ever sees the two bytes. The port is closed
+    again before returning.
+    ---------------------------------------------------------------------------
+    """
+    try:
+        s = serial_class(port, timeout=0)
+    except:
+        print("failed to open {0}".format(port))
+        return None
+    try:
+        end = monotonic() + max(timeout, boot)
+        sleep(boot)
+        s.reset_input_buffer()
+        s.write(b'q')
+        s.write(chr(27).encode())
+        reply = ""
+        while True:
+            num_bytes = s.inWaiting()
+            if num_bytes:
+                reply += s.read(num_bytes).decode(errors="ignore")
+            for r, device in COM_REPLIES:
+                if r in reply:
+                    return device
+            if monotonic() >= end:
+                return None
+            sleep(interval)
+    except:
+        print("failed to read from {0}".format(port))
+        return None
+    finally:
+        s.close()
+
+
+def scan_com_ports(ports, serial_class, timeout=3):
+    """
+    ---------------------------------------------------------------------------
+    FUNCTION: scan_com_ports
+    INPUTS: ports (str list), serial_class (class), timeout (float)
+    RETURNS: devices (dict, device --> port)
+    DEPENDENCIES: concurrent.futures
+    ---------------------------------------------------------------------------
+    Probes every port at once and returns the devices that answered.
+    ---------------------------------------------------------------------------
+    """
+    devices = {}
+    if not ports:
+        return devices
+    with ThreadPoolExecutor(max_workers=len(ports)) as executor:
+        found = executor.map(
+            lambda p: probe_com_port(p, serial_class, timeout), ports)
+        for port, device in zip(ports, found):
+            if device is not None:
+                devices[device] = port
+    return devices
+
+
+def validate_com_cache(cached, ports, serial_class, timeout=3):
+    """
+    ---------------------------------------------------------------------------
+    FUNCTION: validate_com_cache
+    INPUTS: cached (dict, device --> port), ports (str list)
+            serial_class (class), timeout (float)
+    RETURNS: devices (dict) or None
+    DEPENDENCIES: concurrent.futures
+    ---------------------------------------------------------------------------
+    Probes only the cached ports, at once. Returns the cached mapping if every
+    one of them still answers as the same device, otherwise None.
+    ---------------------------------------------------------------------------
+    """
+    if not cached or any(p not in ports for p in cached.values()):
+        return None
+    found = scan_com_ports(list(cached.values()), serial_class, timeout)
+    return found if found == cached else None
+
+
+def identify_model(reply):
+    """
+    ---------------------------------------------------------------------------
+    Returns the first name in VISA_MODELS found in reply, or None.
+    ---------------------------------------------------------------------------
+    """
+    for name in VISA_MODELS:
+        if name in reply:
+            return name
+    return None
+
+
+def probe_visa(rm, address, queries=VISA_QUERIES, timeout=1000):
+    """
+    ---------------------------------------------------------------------------
+    FUNCTION: probe_visa
+    INPUTS: rm (VISA resource manager), address (str)
+            queries (str tuple), timeout (int, ms)
+    RETURNS: entry (dict, model and query) or None
+    DEPENDENCIES: none
+    ---------------------------------------------------------------------------
+    Opens address and sends each query in turn, reading back with a timeout
+    of timeout ms, until a reply names one of VISA_MODELS. Returns the model
+    and the query that found it. The session is closed again before
+    returning.
+    ---------------------------------------------------------------------------
+    """
+    try:
+        s = rm.open_resource(address)
+    except:
+        print("failed to open {0}".format(address))
+        return None
+    try:
+        s.timeout = timeout
+        for q in queries:
+            try:
+                s.clear()
+                s.write(q)
+                model = identify_model(s.read())
+            except:
+                continue
+            if model is not None:
+                return {"model": model, "query": q}
+        return None
+    finally:
+        try:
+            s.close()
+        except:
+            print("failed to close {0}".format(address))
+
+
+def scan_visa(rm, addresses, cached=None, timeout=1000):
+    """
+    ---------------------------------------------------------------------------
+    FUNCTION: scan_visa
+    INPUTS: rm (VISA resource manager), addresses (str list)
+            cached (dict, address --> entry) --> None
+            timeout (int, ms)
+    RETURNS: found (dict, address --> entry)
+    DEPENDENCIES: concurrent.futures
+    ---------------------------------------------------------------------------
+    Probes every address at once. An address in cached is first sent only the
+    query it answered last time, and if that reply is not the same model it
+    is probed with the remaining queries. Addresses that do not identify
+    themselves are left out.
+    ---------------------------------------------------------------------------
+    """
+    cached = cached or {}
+
+    def probe(address):
+        entry = cached.get(address)
+        if entry and entry.get("query") in VISA_QUERIES:
+            found = probe_visa(rm, address, (entry["query"],), timeout)
+            if found == entry:
+                return found
+            queries = [q for q in VISA_QUERIES if q != entry["query"]]
+            return found or probe_visa(rm, address, queries, timeout)
+        return probe_visa(rm, address, VISA_QUERIES, timeout)
+
+    found = {}
+    if not addresses:
+        return found
+    with ThreadPoolExecutor(max_workers=len(addresses)) as executor:
+        for address, entry in zip(addresses, executor.map(probe, addresses)):
+            if entry is not None:
+                found[address] = entry
+    return found
+
+
+def load_cache(filename, section):
+    """
+    ---------------------------------------------------------------------------
+    FUNCTION: load_cache
+    INPUTS: filename, section (str)
+    RETURNS: cache (dict)
+    DEPENDENCIES: json
+    ---------------------------------------------------------------------------
+    Returns one section of the discovery cache, or an empty dict if there is
+    no cache or it cannot be read.
+    ---------------------------------------------------------------------------
+    """
+    if not filename or not path.exists(filename):
+        return {}
+    try:
+        with open(filename) as f:
+            return json.load(f).get(section, {})
+    except (IOError, ValueError, AttributeError):
+        return {}
+
+
+def save_cache(filename, section, data):
+    """
+    ---------------------------------------------------------------------------
+    FUNCTION: save_cache
+    INPUTS: filename, section (str), data (dict)
+    RETURNS: nothing
+    DEPENDENCIES: json
+    ---------------------------------------------------------------------------
+    Replaces one section of the discovery cache, leaving the others alone.
+    ---------------------------------------------------------------------------
+    """
+    if not filename:
+        return
+    cache = {}
+    if path.exists(filename):
+        try:
+            with open(filename) as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            cache = {}
+    cache[section] = data
+    try:
+        with open(filename, "w") as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+    except IOError:
+        print("could not write discovery cache {0}".format(filename))
@@ -2,7 +2,8 @@ import ipywidgets as widgets
 from IPython.display import display
 from threading import Timer
 from libs import Python_4200
-from time import sleep, strftime
+from libs import scheduler
+from time import strftime
 
 
 class CIVW_GUI(object):
@@ -137,8 +138,9 @@ class CIVW_GUI(object):
         Generates four sliders for the selection of start/end wavelengths,
         wavelength step, and single wavelength. Adds a description to each.
         Also creates a single or many wavelength selector with corresponding
-        function hide sliders. Tick box and all sliders are packaged in a
-        widget box and returned
+        function hide sliders, and a tick box and speed slider for continuous
+        scans. Tick boxes and all sliders are packaged in a widget box and
+        returned
         ------------------------------------------------------------------------
         """
 
@@ -189,9 +191,26 @@ class CIVW_GUI(object):
 
         single_w.on_trait_change(one_or_many, 'value')
 
+        continuous_tick = widgets.Checkbox(
+            description="Continuous Scan:",
+            value=False)
+
+        scan_speed_slider = widgets.IntSlider(
+            min=10, max=1000, step=10, value=100,
+            description="Scan Speed (A/s)")
+
+        def continuous(on, speed):
+            test.set_continuous(speed if on else None)
+
+        continuous_set = widgets.interactive(
+            continuous,
+            on=continuous_tick,
+            speed=scan_speed_slider)
+
         return widgets.Box(
-            children=[single_w, wavelength_sliders, single_wavelength_set],
-            height=200,
+            children=[single_w, wavelength_sliders, single_wavelength_set,
+                      continuous_set],
+            height=260,
             margin=20,
             align="center")
 
@@ -849,6 +868,30 @@ class CIVW_GUI(object):
             self.K4200_class_update,
             run_all=self.oneall_tick)
 
+        self.pipeline_tick = widgets.Checkbox(
+            description="Pipelined?",
+            margin=20)
+
+        widgets.interactive(
+            self.K4200_class_update,
+            pipelined=self.pipeline_tick)
+
+        self.sampler_tick = widgets.Checkbox(
+            description="Sample LIA/LS331?",
+            margin=20)
+
+        widgets.interactive(
+            self.K4200_class_update,
+            sample_aux=self.sampler_tick)
+
+        self.interleave_tick = widgets.Checkbox(
+            description="Interleave?",
+            margin=20)
+
+        widgets.interactive(
+            self.K4200_class_update,
+            interleave=self.interleave_tick)
+
         self.select_types = widgets.ToggleButtons(
             options=["CV", "CF", "IV"],
             description="Test",
@@ -864,6 +907,9 @@ class CIVW_GUI(object):
         top = widgets.HBox(children=[
             self.select_types,
             self.oneall_tick,
+            self.pipeline_tick,
+            self.sampler_tick,
+            self.interleave_tick,
             self.start_button])
         display(top, self.cv_tabs, self.cf_tabs, self.iv_tabs)
 
@@ -878,16 +924,13 @@ class CIVW_GUI(object):
         ------------------------------------------------------------------------
         """
         if Python_4200.K4200_test.run_all:
-            self.cv_test.run_test()
-            Python_4200.K4200_test.last_test = "c"
-            sleep(1)
-
-            self.cf_test.run_test()
-            Python_4200.K4200_test.last_test = "c"
-            sleep(1)
-
-            self.iv_test.run_test()
-            Python_4200.K4200_test.last_test = "iv"
+            queue = scheduler.job_queue(
+                [self.cv_test, self.cf_test, self.iv_test])
+            print(queue.summary())
+            if Python_4200.K4200_test.interleave:
+                queue.interleave()
+            else:
+                queue.run()
 
         elif self.cv_tabs.visible:
             self.cv_test.run_test()
@@ -1,22 +1,107 @@
-from decimal import Decimal
+import numpy as np
+
+
+class bulk_reader(object):
+
+    """
+    ---------------------------------------------------------------------------
+    CLASS: bulk_reader
+    INIT VARIABLES: size (int) --> 65536
+                    chunk_size (int) --> 20480
+    INHERITANCE: Object
+    ---------------------------------------------------------------------------
+    Receive buffer for large 4200-SCS transfers. read() pulls a reply with
+    read_raw in chunks of chunk_size bytes straight into a bytearray that is
+    kept between reads, growing it if a reply does not fit, and returns a
+    memoryview of the reply. The view is only valid until the next read.
+    ---------------------------------------------------------------------------
+    """
+
+    def __init__(self, size=64 * 1024, chunk_size=20 * 1024):
+        self.buffer = bytearray(size)
+        self.chunk_size = chunk_size
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__, len(self.buffer))
+
+    def read(self, instrument):
+        n = 0
+        while True:
+            chunk = instrument.read_raw(self.chunk_size)
+            end = n + len(chunk)
+            if end > len(self.buffer):
+                self.buffer.extend(bytes(max(end, 2 * len(self.buffer)) -
+                                         len(self.buffer)))
+            self.buffer[n:end] = chunk
+            n = end
+            if not chunk or chunk.endswith(b"\n"):
+                return memoryview(self.buffer)[:n]
+
+
+def parse_values(values, strip=""):
+    """
+    ---------------------------------------------------------------------------
+    FUNCTION: parse_values
+    INPUTS: values (str, bytes or memoryview), strip (str)
+    RETURNS: x (numpy array, float64)
+    DEPENDENCIES: numpy
+    ---------------------------------------------------------------------------
+    Parses a comma or semicolon separated list of numbers as returned by KXCI
+    into an array in one pass, ignoring any trailing separator and
+    termination. Characters in strip are removed first, such as the status
+    letters "NC" in front of each reading from DO. Arrays are returned as
+    they are. Raises ValueError if any entry is not a number.
+    ---------------------------------------------------------------------------
+    """
+    if isinstance(values, np.ndarray):
+        return values
+    if isinstance(values, str):
+        values = values.encode("ascii")
+    values = bytes(values).translate(None, strip.encode("ascii"))
+    values = values.replace(b";", b",").strip(b", \r\n")
+    if not values:
+        return np.empty(0)
+    x = np.fromstring(values, sep=",")
+    if x.size != values.count(b",") + 1:
+        raise ValueError("malformed KXCI data")
+    return x
+
+
+def parse_impedance(values):
+    """
+    ---------------------------------------------------------------------------
+    FUNCTION: parse_impedance
+    INPUTS: values (str, bytes or memoryview)
+    RETURNS: z (numpy array, N x 2 float64)
+    DEPENDENCIES: numpy
+    ---------------------------------------------------------------------------
+    Takes data as produced by KXCI command :CVU:DATA:Z?, either the string
+    from read() or the raw bytes from read_raw(), and returns it as an array
+    with one row per point holding the primary and secondary values. The
+    whole payload is parsed by numpy in one pass. Raises ValueError if the
+    data is not a complete list of pairs of numbers.
+    ---------------------------------------------------------------------------
+    """
+    z = parse_values(values)
+    if z.size % 2:
+        raise ValueError("malformed CVU impedance data")
+    return z.reshape(-1, 2)
 
 
 def CV_output_san(values):
     """
     ---------------------------------------------------------------------------
     FUNCTION: CV_output_san
-    INPUTS: values (str)
+    INPUTS: values (str or bytes)
     RETURNS: prim, sec (list float)
-    DEPENDENCIES: none
+    DEPENDENCIES: numpy
     ---------------------------------------------------------------------------
     Takes data string as produced by KXCI command :CVU:OUTPUT:Z? and returns
     two arrays of decimal numbers representing the pairs of values received
     ---------------------------------------------------------------------------
     """
-    values = values.replace(";", ",").split(",")
-    prim = [float(Decimal(values[i])) for i in range(0, len(values), 2)]
-    sec = [float(values[i]) for i in range(1, len(values), 2)]
-    return prim, sec
+    z = parse_impedance(values)
+    return z[:, 0].tolist(), z[:, 1].tolist()
 
 
 def select_device(rm):
@@ -47,17 +132,19 @@ def select_device(rm):
     return(devices[selection])
 
 
-def read_4200_x(read_command, instrument):
+def read_4200_x(read_command, instrument, reader=None):
     """
     ---------------------------------------------------------------------------
     FUNCTION: read_4200_x
     INPUTS: read_command (str), instrument (visa resource)
+            reader (bulk_reader) --> None
     RETURNS: x (float list)
-    DEPENDENCIES: pyvisa/visa
+    DEPENDENCIES: pyvisa/visa, numpy
     ---------------------------------------------------------------------------
     Takes an appropriate CVU read command as an argument and sends it to a
     4200-SCS. Then reads the raw returned data and formats it into an list of
-    floats. Acceptable read commands are:
+    floats. If a reader is given the data is read with it rather than as a
+    string. Acceptable read commands are:
     1) volt --> :CVU:DATA:VOLT?
     2) freq --> :CVU:DATA:FREQ?
     3) status --> :CVU:DATA:STATUS?
@@ -74,6 +161,8 @@ def read_4200_x(read_command, instrument):
         print('Incorrect read command passed')
 
     instrument.write(commands[read_command])
+    if reader is not None:
+        return parse_values(reader.read(instrument)).tolist()
     data = instrument.read(termination=",\r\n", encoding="utf-8").split(",")
     x = [float(d) for d in data]
     return x
@@ -84,11 +173,12 @@ def rpm_switch(channel, mode, instrument):
     ---------------------------------------------------------------------------
     FUNCTION: rpm_switch
     INPUTS: channel, mode (int)
-    RETURNS: nothing
+    RETURNS: switched (bool)
     DEPENDENCIES: pyvisa/visa
     ---------------------------------------------------------------------------
     Sends a command to the 4225 RPM modules of the 4200-SCS to set a given
-    channel to a given mode (see below).
+    channel to a given mode (see below). Returns False if every attempt timed
+    out.
     0 = Pulsing
     1 = 2 Wire CVU
     2 = 4 Wire CVU
@@ -109,28 +199,234 @@ def rpm_switch(channel, mode, instrument):
         except:
             print("Service Request timed out")
             count += 1
+    return not running
 
 
-def init_4200(rpm, mode, instrument):
+def init_4200(rpm, mode, instrument, state=None):
     """
     ---------------------------------------------------------------------------
     FUNCTION: init_4200
     INPUTS: rpm (bool), mode, instrument (int)
+            state (kxci_state) --> None
     RETURNS: nothing
     DEPENDENCIES: pyvisa/visa
     ---------------------------------------------------------------------------
     Sets up the 4200-SCS to receive measurement commands and respond correctly
-    when RPM modules are attached. See function above for RPM modes.
-    ---------------------------------------------------------------------------
-    """
-    # clear the visa resource
-    instrument.clear()
-    # send srq when finished with task
-    instrument.write('DR1')
-    if rpm:
-        # access the user library page
-        instrument.write('UL')
-        rpm_switch(1, mode, instrument)
-        rpm_switch(2, mode, instrument)
-    # clear the buffer
-    instrument.write('BC')
+    when RPM modules are attached. See function above for RPM modes. If
+    state is given, rpm is ignored and the RPM modules are only switched if
+    state does not already have them in mode, and state is kept up to date.
+    The mode is only recorded once both modules have confirmed the switch,
+    and state is forgotten if any write fails.
+    ---------------------------------------------------------------------------
+    """
+    if state is not None:
+        rpm = state.settings.get("RPM") != mode
+    try:
+        # clear the visa resource
+        instrument.clear()
+        # send srq when finished with task
+        instrument.write('DR1')
+        if rpm:
+            # access the user library page
+            instrument.write('UL')
+            if state is not None:
+                # settings made before the switch are not relied on after it
+                state.forget()
+                state.record('UL')
+            first = rpm_switch(1, mode, instrument)
+            second = rpm_switch(2, mode, instrument)
+            if state is not None and first and second:
+                state.settings["RPM"] = mode
+        # clear the buffer
+        instrument.write('BC')
+        if state is not None:
+            state.record('DR1')
+    except:
+        # unknown what the 4200-SCS received, so trust nothing
+        if state is not None:
+            state.forget()
+        raise
+
+
+PAGE_COMMANDS = ("DE", "SS", "SM", "MD", "UL")
+
+
+def page_of(command):
+    """
+    ---------------------------------------------------------------------------
+    Returns the KXCI page command selects, or None if it is not a page
+    command.
+    ---------------------------------------------------------------------------
+    """
+    words = command.split()
+    return words[0] if words and words[0] in PAGE_COMMANDS else None
+
+
+class kxci_state(object):
+
+    """
+    ---------------------------------------------------------------------------
+    CLASS: kxci_state
+    INHERITANCE: Object
+    ---------------------------------------------------------------------------
+    Mirror of the settings sent to a 4200-SCS over KXCI, so that setting up a
+    test only sends what has changed since the last one. upload() takes the
+    full list of set up commands for a test, as built by cvf_commands or
+    iv_commands, and writes only the ones that are needed:
+        -CVU commands (":CVU:...") are sent one by one if their value differs
+         from the mirror. The sweep commands share one setting, as only the
+         last one sent is used. ":CVU:RESET" is skipped if the mirror has
+         seen a reset since the session was opened and every setting made
+         since is also in the new list, as then everything it would restore
+         is about to be overwritten anyway.
+        -SMU commands belong to the page (DE, SS, SM, MD) selected before
+         them, so each page is sent whole, page command first, if anything
+         on it differs. The page the list ends on is always selected
+         afterwards, as later commands such as ME1 depend on it.
+        -anything else is sent if its value differs.
+    The mirror only knows what has been sent through it, so it starts empty
+    for each new session and forget() empties it, after which everything is
+    sent again. A command is only recorded once it has been written without
+    error. A failed write forgets everything, as it is then unknown what the
+    4200-SCS received, and so does switching the RPM modules in init_4200.
+    It is kept on the session as session.kxci_state, see state_of(), and
+    is forgotten when the session is discarded from the pool.
+
+    Changes made on the 4200-SCS itself, such as from the front panel or by
+    a reboot, are not seen by the mirror, so forget() should be called (or
+    mirroring left off) whenever that may have happened.
+    ---------------------------------------------------------------------------
+    """
+
+    def __init__(self):
+        self.settings = {}
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__, self.settings)
+
+    def forget(self):
+        self.settings = {}
+
+    def key(self, command, page=None):
+        """
+        ------------------------------------------------------------------------
+        Returns the setting that command changes and the value it sets it
+        to.
+        ------------------------------------------------------------------------
+        """
+        command = command.strip()
+        header, _, value = command.partition(" ")
+        if header.startswith(":CVU:SWEEP:"):
+            return ":CVU:SWEEP", command
+        if header.startswith(":CVU:"):
+            return header, value.strip()
+        if header[:2] == "DR":
+            return "DR", command
+        return (page, header), command
+
+    def record(self, command):
+        """
+        ------------------------------------------------------------------------
+        Updates the mirror for a command that has been written.
+        ------------------------------------------------------------------------
+        """
+        command = command.strip()
+        if command == ":CVU:RESET":
+            for key in [k for k in self.settings if str(k).startswith(":CVU")]:
+                del self.settings[key]
+            self.settings[":CVU:RESET"] = True
+            return
+        page = page_of(command)
+        if page is not None:
+            self.settings["page"] = page
+        key, value = self.key(command, self.settings.get("page"))
+        self.settings[key] = value
+
+    def plan(self, commands):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: plan
+        INPUTS: self, commands (str list)
+        RETURNS: send (str list)
+        DEPENDENCIES: none
+        ------------------------------------------------------------------------
+        Returns the commands from the full set up list commands that need to
+        be sent for the 4200-SCS to end up as if all of them had been, in the
+        order they should be sent.
+        ------------------------------------------------------------------------
+        """
+        settings = self.settings
+        cvu = [c.strip() for c in commands if c.strip().startswith(":CVU")]
+        wanted = {self.key(c)[0] for c in cvu}
+        if ":CVU:RESET" in cvu and (not settings.get(":CVU:RESET") or any(
+                str(k).startswith(":CVU") and k not in wanted
+                for k in settings)):
+            settings = {k: v for k, v in settings.items()
+                        if not str(k).startswith(":CVU")}
+        else:
+            commands = [c for c in commands if c.strip() != ":CVU:RESET"]
+
+        send = []
+        group = []
+        page = None
+
+        def send_group():
+            if any(settings.get(self.key(c, page)[0]) !=
+                   self.key(c, page)[1] for c in group):
+                send.extend(group)
+
+        for c in commands:
+            c = c.strip()
+            if page_of(c) is not None:
+                send_group()
+                page = page_of(c)
+                group = [c]
+            elif page is not None and not c.startswith(":CVU"):
+                group.append(c)
+            else:
+                key, value = self.key(c)
+                if c == ":CVU:RESET" or settings.get(key) != value:
+                    send.append(c)
+        send_group()
+
+        sent_page = [page_of(c) for c in send if page_of(c) is not None]
+        current = sent_page[-1] if sent_page else settings.get("page")
+        if page is not None and current != page:
+            send.append(group[0])
+        return send
+
+    def upload(self, instrument, commands):
+        """
+        ------------------------------------------------------------------------
+        Writes the commands plan() picks from commands to instrument, updating
+        the mirror as each one is written, and returns them. If a write fails
+        the mirror is forgotten and the error raised.
+        ------------------------------------------------------------------------
+        """
+        send = self.plan(commands)
+        for c in send:
+            try:
+                instrument.write(c)
+            except:
+                self.forget()
+                raise
+            self.record(c)
+        return send
+
+
+def state_of(instrument):
+    """
+    ---------------------------------------------------------------------------
+    FUNCTION: state_of
+    INPUTS: instrument (visa resource)
+    RETURNS: state (kxci_state)
+    DEPENDENCIES: none
+    ---------------------------------------------------------------------------
+    Returns the kxci_state kept on instrument, creating it the first time.
+    ---------------------------------------------------------------------------
+    """
+    state = getattr(instrument, "kxci_state", None)
+    if state is None:
+        state = kxci_state()
+        instrument.kxci_state = state
+    return state
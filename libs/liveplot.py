@@ -0,0 +1,229 @@
+import numpy as np
+from IPython import display
+from time import monotonic
+"""
+--------------------------------------------------------------------------------
+MODULE: liveplot.py
+REQUIRES: Python 3.4+
+DEPENDENCIES: numpy, matplotlib, IPython.display
+--------------------------------------------------------------------------------
+This module contains the live plot shown while a multi wavelength test runs.
+Each line is created once and then moved on to the new data with set_data,
+rather than every line being deleted and plotted again at each wavelength.
+
+The results are appended to arrays that grow in place, and the axis limits
+follow the running minimum and maximum, so adding a wavelength does not go
+back over the ones before it. Drawing the figure is what costs the most, so
+it is only redrawn every interval seconds however fast wavelengths come in,
+and lines longer than max_points are thinned out before they are drawn. The
+time spent plotting at each wavelength therefore stays the same however long
+the scan gets.
+
+make_axes() sets up the four axes themselves, and is shared with the
+separate renderer process in renderer.py.
+
+Example:
+    >>>axes = make_axes(plt.gcf(), "CVW sweep", "Capacitance (F)")
+    >>>plot = live_plot(axes, interval=2)
+    >>>plot.add(w, prim, temp, mag, pha)     # at each wavelength
+    >>>plot.draw()
+    >>>plot.flush()                 # at the end of the test
+--------------------------------------------------------------------------------
+"""
+
+
+def make_axes(figure, title, ylabel):
+    """
+    ---------------------------------------------------------------------------
+    FUNCTION: make_axes
+    INPUTS: figure (matplotlib figure), title, ylabel (str)
+    RETURNS: axes (list of 4 matplotlib axes)
+    DEPENDENCIES: matplotlib
+    ---------------------------------------------------------------------------
+    Adds the four subplots of a multi wavelength test to figure: the primary
+    values with the given title and y label, then temperature, magnitude and
+    phase, all against wavelength.
+    ---------------------------------------------------------------------------
+    """
+    ylabels = [ylabel, "Temperature (C)",
+               "Magnitude (%)", "Phase (°)"]
+    titles = [title, "Temperature", "Magnitude", "Phase"]
+
+    axes = []
+    for i in range(4):
+        axes.append(figure.add_subplot(221+i))
+
+        axes[i].set_title(titles[i], fontsize=20, family="serif")
+        axes[i].set_ylabel(ylabels[i], fontsize=14)
+        axes[i].set_xlabel("Wavelength (Angstoms)", fontsize=14)
+
+        axes[i].minorticks_on()
+        axes[i].grid(True, which='major', color='#6C7A89')
+        axes[i].grid(True, which='minor', color='#D2D7D3')
+
+        axes[i].plot()
+
+    axes[3].set_ylim([-180, 0])
+    figure.tight_layout(h_pad=1.0)
+    return axes
+
+
+class live_plot(object):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: live_plot
+    INIT VARIABLES: axes (list of 4 matplotlib axes)
+                    interval (float) --> 1
+                    max_points (int) --> 2000
+                    inline (bool) --> True
+    INHERITANCE: Object
+    ----------------------------------------------------------------------------
+    Updates the four axes of K4200_test.multi_graph: the primary values
+    against wavelength (one line per voltage or frequency, or a single line
+    for spot measurements), then temperature, magnitude and phase.
+
+    With inline set (the notebook inline backend) the figure is redrawn by
+    displaying it again, otherwise the canvas of an interactive backend is
+    asked to redraw itself.
+    ----------------------------------------------------------------------------
+    """
+
+    colours = ["g", "b", "r", "c", "m", "y", "k"]
+    aux_styles = ["b-", "r-", "g-"]
+
+    def __init__(self, axes, interval=1, max_points=2000, inline=True):
+        self.axes = axes
+        self.figure = axes[0].figure
+        self.interval = interval
+        self.max_points = max_points
+        self.inline = inline
+        self.lines = None
+        self.x = None
+        self.y = None
+        self.n = 0
+        self.direction = 0
+        self.limits = None
+        self.last_draw = None
+        self.pending = False
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__, self.figure)
+
+    def create_lines(self, columns):
+        self.lines = []
+        for i in range(columns):
+            style = self.colours[i] if i < len(self.colours) else ""
+            self.lines.append(self.axes[0].plot([], [], style)[0])
+        for ax, style in zip(self.axes[1:], self.aux_styles):
+            self.lines.append(ax.plot([], [], style)[0])
+        self.x = np.empty(64)
+        self.y = np.empty((64, columns + 3))
+        # x min, x max, then y min and y max for each axis
+        self.limits = np.array([[np.inf, -np.inf]] * 5)
+
+    def thin(self, a):
+        step = -(-len(a) // self.max_points)
+        return a[::step] if step > 1 else a
+
+    def add(self, w, prim, temp, mag, pha):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: add
+        INPUTS: self, w (int)
+                prim (float or points array)
+                temp, mag, pha (float)
+        RETURNS: nothing
+        DEPENDENCIES: numpy
+        ------------------------------------------------------------------------
+        Adds the results for wavelength w to the lines and widens the axis
+        limits to take them in. The results are kept in arrays that grow in
+        place, in the direction of the scan, so a point taken in order is
+        just appended. Only a wavelength an adaptive scan comes back to is
+        put in among the others. Nothing is drawn until draw() is called.
+        ------------------------------------------------------------------------
+        """
+        row = np.append(np.asarray(prim, dtype=float).ravel(),
+                        [temp, mag, pha])
+        if self.lines is None:
+            self.create_lines(len(row) - 3)
+        if self.n == len(self.x):
+            self.x = np.resize(self.x, 2 * self.n)
+            self.y = np.resize(self.y, (2 * self.n, self.y.shape[1]))
+        if self.direction == 0 and self.n and w != self.x[0]:
+            self.direction = 1 if w > self.x[0] else -1
+
+        n = self.n
+        i = n
+        if self.direction and (w - self.x[n - 1]) * self.direction < 0:
+            key = self.x[:n] * self.direction
+            i = int(np.searchsorted(key, w * self.direction, side="right"))
+            self.x[i + 1:n + 1] = self.x[i:n]
+            self.y[i + 1:n + 1] = self.y[i:n]
+        self.x[i] = w
+        self.y[i] = row
+        self.n += 1
+
+        for limit, v in zip(self.limits, (self.x[i:i + 1], row[:-3],
+                                          row[-3:-2], row[-2:-1], row[-1:])):
+            v = v[np.isfinite(v)]
+            if len(v):
+                limit[0] = min(limit[0], v.min())
+                limit[1] = max(limit[1], v.max())
+        self.pending = True
+
+    def refresh(self):
+        """
+        ------------------------------------------------------------------------
+        Moves every line on to the data added so far and sets the axis limits
+        from the running minimum and maximum of each axis.
+        ------------------------------------------------------------------------
+        """
+        if self.lines is None:
+            return
+        x = self.thin(self.x[:self.n])
+        for i, line in enumerate(self.lines):
+            line.set_data(x, self.thin(self.y[:self.n, i]))
+        for i, ax in enumerate(self.axes):
+            ax.set_xlim(*self.span(self.limits[0]))
+            # phase keeps the fixed limits set by multi_graph
+            if i != 3 and np.isfinite(self.limits[i + 1]).all():
+                ax.set_ylim(*self.span(self.limits[i + 1]))
+
+    def span(self, limit, margin=0.05):
+        low, high = limit
+        pad = (high - low) * margin or abs(low) * margin or 1
+        return low - pad, high + pad
+
+    def draw(self, force=False):
+        """
+        ------------------------------------------------------------------------
+        Redraws the figure if anything has changed and at least interval
+        seconds have passed since the last redraw, or if force is set.
+        Returns whether it was redrawn.
+        ------------------------------------------------------------------------
+        """
+        now = monotonic()
+        if not self.pending or not (force or self.last_draw is None or
+                                    now - self.last_draw >= self.interval):
+            return False
+        self.refresh()
+        self.show()
+        self.last_draw = monotonic()
+        self.pending = False
+        return True
+
+    def due(self):
+        return self.last_draw is None or (
+            monotonic() - self.last_draw >= self.interval)
+
+    def show(self):
+        if self.inline:
+            display.display(self.figure)
+            display.clear_output(wait=True)
+        else:
+            self.figure.canvas.draw_idle()
+            self.figure.canvas.flush_events()
+
+    def flush(self):
+        return self.draw(force=True)
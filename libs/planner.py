@@ -0,0 +1,180 @@
+import numpy as np
+from time import monotonic
+"""
+--------------------------------------------------------------------------------
+MODULE: planner.py
+REQUIRES: Python 3.4+
+DEPENDENCIES: numpy
+--------------------------------------------------------------------------------
+This module contains the planner for adaptive multi wavelength scans. Rather
+than stepping evenly from start to end at the finest step wanted, the scan
+starts with a coarse pass and then adds wavelengths only where the results
+change quickly, such as around an absorption edge, leaving the flat parts of
+the spectrum at the coarse step.
+
+Each refinement pass halves the intervals whose change (or curvature) is
+above a threshold, until none are left, the intervals are down to the fine
+step, or the time budget or point limit would be exceeded. Every pass is
+measured in increasing wavelength, the same order as an ordinary scan.
+
+Example:
+    >>>plan = scan_planner(3000, 8000, 200, fine_step=10, budget=3600)
+    >>>while True:
+    ...    ws = plan.next_pass()
+    ...    if not ws:
+    ...        break
+    ...    for w in ws:
+    ...        plan.record(w, measure(w))
+--------------------------------------------------------------------------------
+"""
+
+
+class scan_planner(object):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: scan_planner
+    INIT VARIABLES: wstart, wend, wstep (int)
+                    fine_step (int) --> 10
+                    threshold (float) --> 0.05
+                    method (str) --> "gradient"
+                    budget (float) --> None
+                    max_points (int) --> None
+    INHERITANCE: Object
+    ----------------------------------------------------------------------------
+    Plans the wavelengths of an adaptive scan. The first pass is the coarse
+    grid from wstart to wend in steps of wstep. After that an interval
+    between neighbouring wavelengths is split if it is at least twice
+    fine_step wide and:
+        -"gradient": any result changes across it by more than threshold of
+         that result's full range over the scan
+        -"curvature": the second difference at either end, scaled the same
+         way, is more than threshold
+
+    Each result is normalised by its own range, so a scan with several
+    voltages or frequencies is refined wherever any one of them changes.
+
+    budget is a limit in seconds on the whole scan, judged from the average
+    time per wavelength so far, and max_points a limit on how many
+    wavelengths are measured. When a pass would go over either, the
+    intervals that change the most are split first.
+    ----------------------------------------------------------------------------
+    """
+
+    def __init__(self, wstart, wend, wstep, fine_step=10, threshold=0.05,
+                 method="gradient", budget=None, max_points=None):
+        if method not in ("gradient", "curvature"):
+            raise ValueError("method must be 'gradient' or 'curvature'")
+        self.wstart = int(wstart)
+        self.wend = int(wend)
+        self.wstep = int(wstep)
+        self.fine_step = max(int(fine_step), 1)
+        self.threshold = threshold
+        self.method = method
+        self.budget = budget
+        self.max_points = max_points
+        self.values = {}
+        self.passes = 0
+        self.planned = 0
+        self.started = None
+
+    def __repr__(self):
+        return "%s(%r, %r, %r, %r measured)" % (
+            self.__class__, self.wstart, self.wend, self.wstep,
+            len(self.values))
+
+    def __len__(self):
+        return len(self.values)
+
+    def record(self, w, values):
+        """
+        ------------------------------------------------------------------------
+        Stores the results for wavelength w, a single value or one per
+        voltage or frequency.
+        ------------------------------------------------------------------------
+        """
+        self.values[int(w)] = np.atleast_1d(np.asarray(values, dtype=float))
+
+    def scores(self):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: scores
+        INPUTS: self
+        RETURNS: w (int array), score (float array)
+        DEPENDENCIES: numpy
+        ------------------------------------------------------------------------
+        Returns the measured wavelengths in order and a score for each
+        interval between them (one fewer than w), scaled so that the
+        interval should be split if its score is above threshold.
+        ------------------------------------------------------------------------
+        """
+        w = np.array(sorted(self.values))
+        if len(w) < 2:
+            return w, np.zeros(0)
+        y = np.array([self.values[x] for x in w])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            span = np.nanmax(y, axis=0) - np.nanmin(y, axis=0)
+            y = (y - np.nanmin(y, axis=0)) / np.where(span > 0, span, np.inf)
+            if self.method == "gradient":
+                change = np.abs(np.diff(y, axis=0))
+            else:
+                curve = np.zeros(y.shape)
+                curve[1:-1] = np.abs(y[2:] - 2*y[1:-1] + y[:-2])
+                change = np.maximum(curve[1:], curve[:-1])
+            score = np.where(np.isnan(change), 0, change).max(axis=1)
+        return w, score
+
+    def remaining(self):
+        """
+        ------------------------------------------------------------------------
+        Returns how many more wavelengths fit within max_points and the time
+        budget, or None if there is no limit.
+        ------------------------------------------------------------------------
+        """
+        left = []
+        if self.max_points is not None:
+            left.append(int(self.max_points) - len(self.values))
+        if self.budget is not None and self.values:
+            elapsed = monotonic() - self.started
+            per_point = elapsed / len(self.values)
+            left.append(int((self.budget - elapsed) / per_point))
+        return max(min(left), 0) if left else None
+
+    def next_pass(self):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: next_pass
+        INPUTS: self
+        RETURNS: wavelengths (int list)
+        DEPENDENCIES: numpy
+        ------------------------------------------------------------------------
+        Returns the wavelengths to measure next in increasing order, or an
+        empty list once the scan is complete. Every wavelength of the
+        previous pass should have been recorded first.
+        ------------------------------------------------------------------------
+        """
+        self.passes += 1
+        if self.started is None:
+            self.started = monotonic()
+            ws = list(range(self.wstart, self.wend+1, self.wstep))
+            if self.max_points is not None:
+                ws = ws[:int(self.max_points)]
+            self.planned += len(ws)
+            return ws
+
+        w, score = self.scores()
+        split = ((score > self.threshold) &
+                 (np.diff(w) >= 2 * self.fine_step))
+        candidates = []
+        for i in np.flatnonzero(split):
+            mid = int(round((w[i] + w[i+1]) / 2.0))
+            if mid not in self.values:
+                candidates.append((score[i], mid))
+
+        left = self.remaining()
+        if left is not None and len(candidates) > left:
+            candidates.sort(reverse=True)
+            candidates = candidates[:left]
+        ws = sorted(mid for s, mid in candidates)
+        self.planned += len(ws)
+        return ws
@@ -0,0 +1,186 @@
+import multiprocessing
+from IPython import display
+from os import path, replace
+from queue import Empty
+from time import monotonic
+from libs import liveplot
+"""
+--------------------------------------------------------------------------------
+MODULE: renderer.py
+REQUIRES: Python 3.4+
+DEPENDENCIES: multiprocessing, matplotlib, IPython.display, liveplot
+--------------------------------------------------------------------------------
+This module contains a renderer that draws the live plot of a multi
+wavelength test in a separate process, so that rasterising the figure never
+holds up the instruments.
+
+The test sends each new wavelength's results down a queue, and the renderer
+process draws them into its own figure at most once every interval seconds,
+writing each frame to a PNG file. The notebook only has to display the
+latest frame, which is cheap compared to drawing it. Exports (PNG, SVG or
+anything else savefig understands) are queued the same way and written in
+the background.
+
+The process is started with "spawn" rather than forked, as the test process
+has instrument sessions and threads open that must not be copied.
+
+Example:
+    >>>r = render_process("CVW sweep", "Capacitance (F)", "live.png")
+    >>>r.add(5000, [1.2e-10, 1.1e-10], 295.0, 80.1, -45.2)
+    >>>r.show()                     # displays the newest frame, if any
+    >>>r.save("sweep.png")
+    >>>r.close()
+--------------------------------------------------------------------------------
+"""
+
+
+class frame_plot(liveplot.live_plot):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: frame_plot
+    INIT VARIABLES: axes (list of 4 matplotlib axes), frame_path (str)
+                    frames (multiprocessing.Value)
+                    interval (float) --> 1
+    INHERITANCE: liveplot.live_plot
+    ----------------------------------------------------------------------------
+    Live plot that shows itself by writing a PNG to frame_path and counting
+    the frames written in frames. The file is replaced in one step so it is
+    never read half written.
+    ----------------------------------------------------------------------------
+    """
+
+    def __init__(self, axes, frame_path, frames, interval=1):
+        liveplot.live_plot.__init__(self, axes, interval, inline=False)
+        self.frame_path = frame_path
+        self.frames = frames
+
+    def show(self):
+        part = self.frame_path + ".part.png"
+        self.figure.savefig(part)
+        replace(part, self.frame_path)
+        with self.frames.get_lock():
+            self.frames.value += 1
+
+
+def render_loop(queue, frames, title, ylabel, frame_path, interval, figsize):
+    """
+    ---------------------------------------------------------------------------
+    FUNCTION: render_loop
+    INPUTS: queue (multiprocessing.Queue), frames (multiprocessing.Value)
+            title, ylabel, frame_path (str), interval (float)
+            figsize (tuple)
+    RETURNS: nothing
+    DEPENDENCIES: matplotlib, liveplot
+    ---------------------------------------------------------------------------
+    Runs in the renderer process. Takes every message waiting on the queue,
+    then redraws if it is due, until told to stop. Messages are tuples:
+        -("add", w, prim, temp, mag, pha)   results for one more wavelength
+        -("save", filename)                 export the figure as it stands
+        -("stop",)                          draw a last frame and finish
+    ---------------------------------------------------------------------------
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    figure = plt.figure(figsize=figsize, dpi=80, facecolor='w', edgecolor='k')
+    axes = liveplot.make_axes(figure, title, ylabel)
+    plot = frame_plot(axes, frame_path, frames, interval)
+    changed = False
+    running = True
+
+    while running:
+        timeout = None if not changed else max(
+            interval - (monotonic() - (plot.last_draw or 0)), 0)
+        messages = []
+        try:
+            messages.append(queue.get(timeout=timeout))
+            while True:
+                messages.append(queue.get_nowait())
+        except Empty:
+            pass
+
+        for message in messages:
+            if message[0] == "add":
+                plot.add(*message[1:])
+                changed = True
+            elif message[0] == "save":
+                plot.refresh()
+                figure.savefig(message[1])
+            elif message[0] == "stop":
+                running = False
+
+        if changed and (plot.due() or not running):
+            plot.draw(force=True)
+            changed = False
+    plt.close(figure)
+
+
+class render_process(object):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: render_process
+    INIT VARIABLES: title, ylabel, frame_path (str)
+                    interval (float) --> 1
+                    figsize (tuple) --> (14, 10)
+    INHERITANCE: Object
+    ----------------------------------------------------------------------------
+    Starts render_loop in a new process and sends it results. None of the
+    methods wait for the renderer, apart from close(wait=True).
+    ----------------------------------------------------------------------------
+    """
+
+    def __init__(self, title, ylabel, frame_path, interval=1,
+                 figsize=(14, 10)):
+        context = multiprocessing.get_context("spawn")
+        self.frame_path = frame_path
+        self.queue = context.Queue()
+        self.frames = context.Value("i", 0)
+        self.shown = 0
+        self.process = context.Process(
+            target=render_loop, name="renderer",
+            args=(self.queue, self.frames, title, ylabel, frame_path,
+                  interval, figsize))
+        self.process.start()
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__, self.frame_path)
+
+    @property
+    def running(self):
+        return self.process.is_alive()
+
+    def add(self, w, prim, temp, mag, pha):
+        self.queue.put(("add", w, prim, temp, mag, pha))
+
+    def save(self, filename):
+        self.queue.put(("save", filename))
+
+    def show(self):
+        """
+        ------------------------------------------------------------------------
+        Displays the newest frame in the notebook if there is one that has not
+        been shown yet. Returns whether anything was displayed.
+        ------------------------------------------------------------------------
+        """
+        frames = self.frames.value
+        if frames == self.shown or not path.exists(self.frame_path):
+            return False
+        self.shown = frames
+        display.display(display.Image(filename=self.frame_path))
+        display.clear_output(wait=True)
+        return True
+
+    def close(self, wait=False, timeout=30):
+        """
+        ------------------------------------------------------------------------
+        Tells the renderer to finish once everything already queued is done.
+        With wait, blocks until it has, for at most timeout seconds.
+        ------------------------------------------------------------------------
+        """
+        if self.process.is_alive():
+            self.queue.put(("stop",))
+        if wait:
+            self.process.join(timeout)
@@ -0,0 +1,493 @@
+import numpy as np
+"""
+--------------------------------------------------------------------------------
+MODULE: results.py
+REQUIRES: Python 3.4+
+DEPENDENCIES: numpy
+--------------------------------------------------------------------------------
+This module contains the result buffers for multi wavelength tests. Rather
+than growing Python lists of Python floats, the results of every wavelength
+are written in place into numpy arrays allocated once at the start of a
+test, from the number of wavelength steps already known from the test
+settings, and the filled part of each array is handed out as a view for
+plotting and saving.
+
+Repetitions are combined by running_stats, which keeps the mean, variance
+and count of every point as repetitions arrive (Welford's method), so the
+standard deviation and standard error are known without a second pass or
+keeping the repetitions themselves. Outlying repetitions can be rejected by
+sigma clipping. repeat_rule uses the same statistics to decide how many
+repetitions to take at each wavelength.
+
+Example:
+    >>>s = running_stats(points=3, sigma=3)
+    >>>for sweep in repetitions:
+    ...    s.add(sweep)
+    >>>s.mean, s.sem
+
+    >>>r = sweep_results(wsteps=5, repetitions=3)
+    >>>for sweep in [[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]]:
+    ...    r.add_repetition(sweep, t=295, mag=80, pha=-45)
+    >>>r.finish()
+    0
+    >>>r.primary
+    array([[3., 4.]])
+--------------------------------------------------------------------------------
+"""
+
+
+class running_stats(object):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: running_stats
+    INIT VARIABLES: points (int)
+                    sigma (float) --> None
+                    keep (int) --> 0
+                    min_count (int) --> 3
+    INHERITANCE: Object
+    ----------------------------------------------------------------------------
+    Mean, variance and count of each of points values over repeated sweeps,
+    updated one sweep at a time in O(points) memory. NaN readings are
+    skipped.
+
+    With sigma set, once a point has min_count readings any new reading
+    more than sigma standard deviations from its mean is rejected as it
+    arrives. This depends on the order the readings come in, so if keep is
+    set the last keep sweeps are also held and clip() can redo the clipping
+    over all of them at once.
+    ----------------------------------------------------------------------------
+    """
+
+    def __init__(self, points, sigma=None, keep=0, min_count=3):
+        self.points = int(points)
+        self.sigma = sigma
+        self.min_count = min_count
+        self.raw = np.full((int(keep), self.points), np.nan)
+        self.kept = 0
+        self.reset()
+
+    def __repr__(self):
+        return "%s(%r, n=%r)" % (self.__class__, self.points,
+                                 int(self.count.max(initial=0)))
+
+    def reset(self):
+        self.count = np.zeros(self.points, dtype=int)
+        self.rejected = np.zeros(self.points, dtype=int)
+        self.mean = np.zeros(self.points)
+        self.m2 = np.zeros(self.points)
+
+    def add(self, x):
+        """
+        ------------------------------------------------------------------------
+        Adds one sweep of readings, returning a mask of the points that were
+        accepted.
+        ------------------------------------------------------------------------
+        """
+        x = np.asarray(x, dtype=float).reshape(self.points)
+        if self.kept < len(self.raw):
+            self.raw[self.kept] = x
+            self.kept += 1
+        elif len(self.raw):
+            self.raw = np.roll(self.raw, -1, axis=0)
+            self.raw[-1] = x
+        return self.update(x)
+
+    def update(self, x):
+        use = ~np.isnan(x)
+        if self.sigma is not None:
+            settled = self.count >= self.min_count
+            outlier = np.abs(x - self.mean) > self.sigma * self.std
+            reject = use & settled & outlier
+            self.rejected += reject
+            use &= ~reject
+        self.count += use
+        n = np.maximum(self.count, 1)
+        delta = np.where(use, x - self.mean, 0)
+        self.mean += delta / n
+        self.m2 += delta * np.where(use, x - self.mean, 0)
+        return use
+
+    @property
+    def variance(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.count > 1,
+                            self.m2 / (self.count - 1), np.nan)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    @property
+    def sem(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.std / np.sqrt(self.count)
+
+    def clip(self, sigma=None, iterations=5):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: clip
+        INPUTS: self, sigma (float) --> self.sigma
+                iterations (int) --> 5
+        RETURNS: self
+        DEPENDENCIES: numpy
+        ------------------------------------------------------------------------
+        Recalculates the statistics from the kept sweeps, repeatedly dropping
+        readings more than sigma standard deviations from the mean of those
+        left until none are dropped or iterations runs out. Points with fewer
+        than min_count readings are not clipped.
+        ------------------------------------------------------------------------
+        """
+        sigma = self.sigma if sigma is None else sigma
+        raw = self.raw[:self.kept]
+        if sigma is None or not len(raw):
+            return self
+        use = ~np.isnan(raw)
+        for i in range(iterations):
+            n = use.sum(axis=0)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                mean = np.where(use, raw, 0).sum(axis=0) / n
+                std = np.sqrt(np.where(use, (raw - mean)**2, 0).sum(axis=0) /
+                              (n - 1))
+            keep = ~(np.abs(raw - mean) > sigma * std) | (n < self.min_count)
+            if (use & keep).sum() == use.sum():
+                break
+            use &= keep
+        self.reset()
+        self.rejected = (~use & ~np.isnan(raw)).sum(axis=0)
+        for x in np.where(use, raw, np.nan):
+            self.update_unclipped(x)
+        return self
+
+    def update_unclipped(self, x):
+        sigma, self.sigma = self.sigma, None
+        try:
+            self.update(x)
+        finally:
+            self.sigma = sigma
+
+
+class repeat_rule(object):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: repeat_rule
+    INIT VARIABLES: repetitions (int)
+                    target (float) --> None
+                    minimum, maximum (int) --> 2, 10
+                    of (str) --> "primary"
+                    relative (bool) --> True
+    INHERITANCE: Object
+    ----------------------------------------------------------------------------
+    Decides how many repetitions to take at a wavelength. Iterating over it
+    gives the repetition numbers, and add() is called with the results of
+    each repetition as it is taken.
+
+    Without a target it always gives repetitions. With one it keeps going
+    until the standard error of the primary values (of="primary") or of the
+    LIA magnitude (of="magnitude") is no more than target, taking at least
+    minimum and at most maximum repetitions. With relative the target is a
+    fraction of the largest mean, so 0.01 is 1% of full scale; otherwise it
+    is in the units of the values.
+    ----------------------------------------------------------------------------
+    """
+
+    def __init__(self, repetitions, target=None, minimum=2, maximum=10,
+                 of="primary", relative=True):
+        if of not in ("primary", "magnitude"):
+            raise ValueError("of must be 'primary' or 'magnitude'")
+        self.repetitions = int(repetitions)
+        self.target = target
+        self.minimum = max(int(minimum), 2)
+        self.maximum = max(int(maximum), self.minimum)
+        self.of = of
+        self.relative = relative
+        self.reset()
+
+    def __repr__(self):
+        return "%s(%r, %r)" % (self.__class__, self.repetitions, self.target)
+
+    def __iter__(self):
+        self.reset()
+        while not self.done:
+            yield self.n
+
+    @property
+    def adaptive(self):
+        return self.target is not None
+
+    @property
+    def most(self):
+        return self.maximum if self.adaptive else self.repetitions
+
+    def reset(self):
+        self.n = 0
+        self.stats = None
+
+    def add(self, primary=None, magnitude=None):
+        """
+        ------------------------------------------------------------------------
+        Counts one repetition. Only the values the rule is watching are used,
+        and only when it is adaptive, so the others may be left out.
+        ------------------------------------------------------------------------
+        """
+        self.n += 1
+        if not self.adaptive:
+            return
+        x = np.atleast_1d(np.asarray(
+            primary if self.of == "primary" else magnitude, dtype=float))
+        if self.stats is None:
+            self.stats = running_stats(x.size)
+        self.stats.add(x)
+
+    @property
+    def error(self):
+        """
+        ------------------------------------------------------------------------
+        The largest standard error of the watched values so far, as a
+        fraction of their largest mean if relative. NaN before two
+        repetitions.
+        ------------------------------------------------------------------------
+        """
+        if self.stats is None or self.n < 2:
+            return np.nan
+        with np.errstate(invalid="ignore", divide="ignore"):
+            if np.all(np.isnan(self.stats.sem)):
+                return np.nan
+            error = np.nanmax(self.stats.sem)
+            if self.relative:
+                error /= np.nanmax(np.abs(self.stats.mean))
+        return error
+
+    @property
+    def done(self):
+        if not self.adaptive:
+            return self.n >= self.repetitions
+        if self.n < self.minimum:
+            return False
+        return self.n >= self.maximum or self.error <= self.target
+
+
+class sweep_results(object):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: sweep_results
+    INIT VARIABLES: wsteps, repetitions (int)
+                    points (int) --> None
+                    sigma (float) --> None
+                    keep_raw (bool) --> False
+    INHERITANCE: Object
+    ----------------------------------------------------------------------------
+    Holds the per wavelength means, standard deviations and number of
+    repetitions used of the primary and secondary values of a test as
+    (wsteps, 2, points) arrays, and the mean temperature, magnitude and
+    phase as a (wsteps, 3) array. If points is not given the arrays are
+    allocated by the first repetition, once the number of points is known.
+    Should a test run to more wavelengths than planned the arrays are
+    enlarged.
+
+    Each repetition is fed into a running_stats for its wavelength with
+    add_repetition() as it comes in, and finish() stores the statistics and
+    moves on to the next wavelength, so only one repetition is held at a
+    time. add() does both for a wavelength whose repetitions are all to
+    hand. With sigma set, repetitions more than sigma standard deviations
+    out are rejected as they arrive.
+
+    With keep_raw the repetitions themselves are also kept, in raw_primary
+    and raw_secondary as (wsteps, repetitions, points) arrays and raw_aux as
+    (wsteps, repetitions, 3), NaN where nothing has been stored. The sigma
+    clipping of each wavelength is then redone over all its repetitions at
+    once when it is finished.
+
+    primary, secondary, temperature, magnitude, phase and frequency are views
+    of the means for the wavelengths stored so far, and primary_sem and
+    secondary_sem the standard errors. For spot measurements (one point)
+    primary and secondary are 1-D.
+    ----------------------------------------------------------------------------
+    """
+
+    def __init__(self, wsteps, repetitions, points=None, sigma=None,
+                 keep_raw=False):
+        self.wsteps = max(int(wsteps), 1)
+        self.repetitions = max(int(repetitions), 1)
+        self.sigma = sigma
+        self.keep_raw = keep_raw
+        self.points = None
+        self.n = 0
+        self.stats = None
+        if points is not None:
+            self.allocate(points)
+
+    def __repr__(self):
+        return "%s(%r of %r, %r, %r)" % (self.__class__, self.n, self.wsteps,
+                                         self.repetitions, self.points)
+
+    def __len__(self):
+        return self.n
+
+    def allocate(self, points):
+        w, r, p = self.wsteps, self.repetitions, int(points)
+        self.points = p
+        self.raw_primary = self.raw_secondary = self.raw_aux = None
+        if self.keep_raw:
+            self.raw_primary = np.full((w, r, p), np.nan)
+            self.raw_secondary = np.full((w, r, p), np.nan)
+            self.raw_aux = np.full((w, r, 3), np.nan)
+        self.counts = np.zeros(w, dtype=int)
+        self.means = np.full((w, 2, p), np.nan)
+        self.stds = np.full((w, 2, p), np.nan)
+        self.used = np.zeros((w, 2, p), dtype=int)
+        self.aux_means = np.full((w, 3), np.nan)
+        self.freq = np.zeros(w)
+
+    def buffers(self):
+        return (self.raw_primary, self.raw_secondary, self.raw_aux,
+                self.counts, self.means, self.stds, self.used,
+                self.aux_means, self.freq)
+
+    def resize(self, wsteps, repetitions):
+        """
+        ------------------------------------------------------------------------
+        Enlarges the buffers to hold at least wsteps wavelengths and
+        repetitions repetitions, keeping what has been stored.
+        ------------------------------------------------------------------------
+        """
+        w = max(int(wsteps), self.wsteps)
+        r = max(int(repetitions), self.repetitions)
+        old = self.buffers()
+        self.wsteps, self.repetitions = w, r
+        self.allocate(self.points)
+        for a, b in zip(old, self.buffers()):
+            if a is not None:
+                b[tuple(slice(0, s) for s in a.shape)] = a
+
+    def add_repetition(self, primary, t, mag, pha, secondary=None):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: add_repetition
+        INPUTS: self, primary (points array or list, or float)
+                t, mag, pha (float)
+                secondary (as primary) --> None
+        RETURNS: nothing
+        DEPENDENCIES: numpy
+        ------------------------------------------------------------------------
+        Adds one repetition to the statistics of the wavelength being
+        measured, starting a new one if the last was finished.
+        ------------------------------------------------------------------------
+        """
+        primary = np.asarray(primary, dtype=float).ravel()
+        if self.points is None:
+            self.allocate(len(primary))
+        if self.stats is None:
+            if self.n >= self.wsteps:
+                self.resize(self.wsteps * 2, self.repetitions)
+            keep = self.repetitions if self.keep_raw else 0
+            self.stats = [running_stats(self.points, self.sigma, keep),
+                          running_stats(self.points, self.sigma, keep),
+                          running_stats(3)]
+            self.reps = 0
+
+        row, rep = self.n, self.reps
+        if self.keep_raw and rep >= self.repetitions:
+            self.resize(self.wsteps, rep + 1)
+        aux = np.array([t, mag, pha], dtype=float)
+        self.stats[0].add(primary)
+        self.stats[2].add(aux)
+        if self.keep_raw:
+            self.raw_primary[row, rep] = primary
+            self.raw_aux[row, rep] = aux
+        if secondary is not None:
+            secondary = np.asarray(secondary, dtype=float).ravel()
+            self.stats[1].add(secondary)
+            if self.keep_raw:
+                self.raw_secondary[row, rep] = secondary
+        self.reps += 1
+
+    def finish(self):
+        """
+        ------------------------------------------------------------------------
+        Stores the statistics of the wavelength being measured and returns
+        the row they were stored in.
+        ------------------------------------------------------------------------
+        """
+        row = self.n
+        for column, stats in enumerate(self.stats[:2]):
+            if self.keep_raw:
+                stats.clip()
+            self.means[row, column] = np.where(stats.count, stats.mean,
+                                               np.nan)
+            self.stds[row, column] = stats.std
+            self.used[row, column] = stats.count
+        aux = self.stats[2]
+        self.aux_means[row] = np.where(aux.count == self.reps, aux.mean,
+                                       np.nan)
+        self.counts[row] = self.reps
+        self.stats = None
+        self.n += 1
+        return row
+
+    def add(self, primary, t, mag, pha, secondary=None):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: add
+        INPUTS: self, primary (repetitions x points array or list)
+                t, mag, pha (float list, one per repetition)
+                secondary (as primary) --> None
+        RETURNS: row (int)
+        DEPENDENCIES: numpy
+        ------------------------------------------------------------------------
+        Adds every repetition of the next wavelength and finishes it,
+        returning the row it was stored in.
+        ------------------------------------------------------------------------
+        """
+        for i, x in enumerate(primary):
+            self.add_repetition(x, t[i], mag[i], pha[i],
+                                None if secondary is None else secondary[i])
+        return self.finish()
+
+    def values(self, column):
+        v = self.means[:self.n, column]
+        return v[:, 0] if self.points == 1 else v
+
+    def sem(self, column):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            v = self.stds[:self.n, column] / np.sqrt(
+                self.used[:self.n, column])
+        return v[:, 0] if self.points == 1 else v
+
+    @property
+    def primary(self):
+        return self.values(0) if self.points else np.empty(0)
+
+    @property
+    def secondary(self):
+        return self.values(1) if self.points else np.empty(0)
+
+    @property
+    def primary_sem(self):
+        return self.sem(0) if self.points else np.empty(0)
+
+    @property
+    def secondary_sem(self):
+        return self.sem(1) if self.points else np.empty(0)
+
+    @property
+    def used_repetitions(self):
+        return self.counts[:self.n] if self.points else np.empty(0, dtype=int)
+
+    @property
+    def temperature(self):
+        return self.aux_means[:self.n, 0] if self.points else np.empty(0)
+
+    @property
+    def magnitude(self):
+        return self.aux_means[:self.n, 1] if self.points else np.empty(0)
+
+    @property
+    def phase(self):
+        return self.aux_means[:self.n, 2] if self.points else np.empty(0)
+
+    @property
+    def frequency(self):
+        return self.freq[:self.n] if self.points else np.empty(0)
@@ -0,0 +1,211 @@
+from collections import deque
+from threading import Condition, Event, Thread
+from time import monotonic
+"""
+--------------------------------------------------------------------------------
+MODULE: sampler.py
+REQUIRES: Python 3.4+
+DEPENDENCIES: collections.deque, threading, time.monotonic
+--------------------------------------------------------------------------------
+This module contains a background sampler for the auxiliary instruments, the
+5302 lock in amplifier and the LS331 temperature controller. Rather than
+querying them between 4200-SCS sweeps, a thread reads them continuously and
+keeps timestamped readings in ring buffers. The mean over the time a sweep was
+running can then be looked up once it has finished.
+
+Example:
+    >>>s = aux_sampler(lia5302=lia, ls331=ls)
+    >>>s.start()
+    >>>start = monotonic()
+    >>>...                          # run a sweep on the 4200-SCS
+    >>>s.window(start, monotonic())
+    {'freq': 137.0, 'mag': 45.2, 'pha': -45.0, 'temp': 295.0}
+    >>>s.stop()
+--------------------------------------------------------------------------------
+"""
+
+
+class aux_sampler(object):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: aux_sampler
+    INIT VARIABLES: lia5302 (VISA resource) --> None
+                    ls331 (VISA resource) --> None
+                    interval (float) --> 0
+                    size (int) --> 4096
+                    retries (int) --> 5
+                    backoff (float) --> 0.5
+    INHERITANCE: Object
+    ----------------------------------------------------------------------------
+    Reads frequency (Hz), magnitude (%) and phase (degrees) from the lock in,
+    and temperature (K) from the LS331, as fast as the instruments allow or
+    every interval seconds. Each channel keeps the last size readings as
+    (time, value) pairs. Readings that cannot be parsed are skipped. After
+    a query fails (a timeout, say) the channel is left for backoff seconds,
+    doubling with every further failure in a row up to max_backoff, so an
+    instrument that is not answering costs a timeout only now and then.
+    After retries failures in a row the channel is dropped: it is not read
+    again, window() gives NaN for it, and it is listed in dropped along with
+    when it was dropped.
+
+    While the sampler is running it must be the only thing using the two
+    sessions, as VISA sessions cannot be shared between threads.
+    ----------------------------------------------------------------------------
+    """
+
+    channels = (("freq", "lia5302", "FRQ", 1000),
+                ("mag", "lia5302", "MAG", 100),
+                ("pha", "lia5302", "PHA", 1000),
+                ("temp", "ls331", "KRDG?", 1))
+
+    max_backoff = 30
+
+    def __init__(self, lia5302=None, ls331=None, interval=0, size=4096,
+                 retries=5, backoff=0.5):
+        self.lia5302 = lia5302
+        self.ls331 = ls331
+        self.interval = interval
+        self.retries = retries
+        self.backoff = backoff
+        self.buffers = {c[0]: deque(maxlen=size) for c in self.channels}
+        self.changed = Condition()
+        self.stopping = Event()
+        self.thread = None
+        self.reset()
+
+    def reset(self):
+        self.dead = set()
+        self.dropped = {}
+        self.failures = {c[0]: 0 for c in self.channels}
+        self.retry_at = {c[0]: 0 for c in self.channels}
+
+    def __repr__(self):
+        return "%s(%r, %r)" % (self.__class__, self.lia5302, self.ls331)
+
+    def start(self, timeout=2):
+        """
+        ------------------------------------------------------------------------
+        Starts the sampler thread and waits until every channel has its first
+        reading or a failed query, for at most timeout seconds altogether, so
+        that window() has something to return from the start.
+        ------------------------------------------------------------------------
+        """
+        self.stopping.clear()
+        self.reset()
+        self.thread = Thread(target=self.run, name="aux_sampler", daemon=True)
+        self.thread.start()
+        end = monotonic() + timeout
+        for name, instr, command, scale in self.channels:
+            if getattr(self, instr) is not None:
+                self.wait_for(name, max(end - monotonic(), 0))
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def read(self, name, session, command, scale):
+        """
+        ------------------------------------------------------------------------
+        Takes a single reading and adds it to the channel buffer, timestamped
+        half way through the query. Does nothing while the channel is backing
+        off after a failed query, or once it has been dropped.
+        ------------------------------------------------------------------------
+        """
+        start = monotonic()
+        if (session is None or name in self.dead or
+                start < self.retry_at[name]):
+            return
+        try:
+            reply = session.query(command)
+        except:
+            self.failed(name)
+            return
+        self.failures[name] = 0
+        try:
+            value = float(reply.replace('+', ''))/scale
+        except ValueError:
+            return
+        with self.changed:
+            self.buffers[name].append(((start + monotonic())/2, value))
+            self.changed.notify_all()
+
+    def failed(self, name):
+        """
+        ------------------------------------------------------------------------
+        Counts a failed query on a channel, backing off before the next one or
+        dropping the channel after retries failures in a row.
+        ------------------------------------------------------------------------
+        """
+        with self.changed:
+            self.failures[name] += 1
+            n = self.failures[name]
+            if n >= self.retries:
+                self.dead.add(name)
+                self.dropped[name] = monotonic()
+                print("aux_sampler: no reply to {0} after {1} tries, "
+                      "dropped".format(name, n))
+            else:
+                self.retry_at[name] = monotonic() + min(
+                    self.backoff * 2**(n - 1), self.max_backoff)
+            self.changed.notify_all()
+
+    def run(self):
+        while not self.stopping.is_set():
+            start = monotonic()
+            for name, instr, command, scale in self.channels:
+                self.read(name, getattr(self, instr), command, scale)
+            self.stopping.wait(max(self.interval - (monotonic() - start), 0))
+
+    def wait_for(self, name, timeout=2):
+        """
+        ------------------------------------------------------------------------
+        Blocks until a channel has at least one reading or a failed query, or
+        the timeout runs out. Used by start().
+        ------------------------------------------------------------------------
+        """
+        with self.changed:
+            return self.changed.wait_for(
+                lambda: (self.buffers[name] or self.failures[name] or
+                         name in self.dead or not self.running), timeout)
+
+    def window(self, start, end):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: window
+        INPUTS: self, start, end (float, monotonic time)
+        RETURNS: means (dict of float)
+        DEPENDENCIES: none
+        ------------------------------------------------------------------------
+        Returns the mean of each channel over readings taken between start and
+        end. If there were none, the last reading before end is used instead,
+        unless the channel has been dropped. A channel with nothing to use
+        gives NaN. Never waits for the instruments.
+        ------------------------------------------------------------------------
+        """
+        means = {}
+        for name, instr, command, scale in self.channels:
+            with self.changed:
+                readings = list(self.buffers[name])
+                dead = name in self.dead
+            inside = [v for t, v in readings if start <= t <= end]
+            if not inside and not dead:
+                before = [v for t, v in readings if t <= end]
+                inside = before[-1:] or [v for t, v in readings[:1]]
+            means[name] = sum(inside)/len(inside) if inside else float("nan")
+        return means
+
+    def samples(self, name):
+        """
+        ------------------------------------------------------------------------
+        Returns a copy of every (time, value) pair held for a channel.
+        ------------------------------------------------------------------------
+        """
+        with self.changed:
+            return list(self.buffers[name])
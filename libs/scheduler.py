@@ -0,0 +1,448 @@
+from libs import Python_4200
+from math import log10
+from time import monotonic
+"""
+--------------------------------------------------------------------------------
+MODULE: scheduler.py
+REQUIRES: Python 3.4+
+DEPENDENCIES: Python_4200
+--------------------------------------------------------------------------------
+This module contains the job queue used to run a batch of tests, such as the
+CV, CF and IV tests of "run all", in the order that wastes the least time
+between them.
+
+Two things cost time between tests. Switching the RPM modules between CVU
+and SMU takes several seconds, so tests needing the same mode are run
+together, starting with the mode the modules are already in. Slewing the
+monochromator back to the start of the range is avoided by running each
+multi wavelength test in whichever direction starts nearest to where the
+last one finished, so consecutive scans over the same range alternate up and
+down.
+
+interleave() instead runs every test at each wavelength of a single scan,
+so a full characterisation only moves the monochromator through the
+spectrum once. The tests are run a mode at a time, and the order of the
+modes is swapped at every wavelength, so the RPM modules switch only once per
+wavelength.
+
+Before anything is run the plan and a predicted time for each test can be
+shown. The prediction is a simple model of the instruments (TIMINGS), scaled
+by how long tests of the same mode actually took earlier in the session.
+
+Example:
+    >>>queue = job_queue([cv, cf, iv])
+    >>>print(queue.summary())
+    >>>queue.run()
+    >>>queue.interleave()           # or all three in one scan
+--------------------------------------------------------------------------------
+"""
+
+TIMINGS = {
+    "setup": 3.0,                           # set up, files and graph
+    "rpm_switch": 3.0,                      # both RPM modules
+    "mono_rate": 1000.0,                    # CM110 slew in angstroms/s
+    "aux": 0.1,                             # LIA and temperature readings
+    "cvu_point": (0.02, 0.1, 0.5),          # per CVU point for speed 0-2
+    "cvu_spot": 0.05,                       # :CVU:MEASZ? spot measurement
+    "smu_point": (0.005, 0.01, 0.02, 0.3),  # per SMU point for IT 0-3
+}
+
+# test settings interleave() overrides for the length of a run
+SHARED = ("keep_sessions", "wrange_set", "wstart", "wend", "wstep", "wsteps",
+          "figure_num", "descending")
+
+
+def rpm_mode(test):
+    """
+    ---------------------------------------------------------------------------
+    Returns the RPM mode test needs, as passed to ki4200.rpm_switch.
+    ---------------------------------------------------------------------------
+    """
+    return 3 if test.mode == "iv" else 1
+
+
+def sweep_points(test):
+    """
+    ---------------------------------------------------------------------------
+    FUNCTION: sweep_points
+    INPUTS: test (K4200_test)
+    RETURNS: points (int)
+    DEPENDENCIES: math
+    ---------------------------------------------------------------------------
+    Estimates the number of points in one 4200-SCS sweep of test: one per
+    voltage step, nine per decade of a frequency sweep, or one for a spot
+    measurement.
+    ---------------------------------------------------------------------------
+    """
+    if test.mode == "cf":
+        try:
+            return int(round(9 * log10(float(test.fstop) /
+                                       float(test.fstart)))) + 1
+        except (AttributeError, ValueError, ZeroDivisionError):
+            return 1
+    if not getattr(test, "vrange_set", False):
+        return 1
+    return int(round((float(test.vend) - float(test.vstart)) /
+                     float(test.vstep))) + 1
+
+
+def current_rpm():
+    """
+    ---------------------------------------------------------------------------
+    Returns the mode the RPM modules were last switched to through the pooled
+    4200-SCS session, or None if that is not known.
+    ---------------------------------------------------------------------------
+    """
+    test = Python_4200.K4200_test
+    session = test.pool.find("visa", test.k4200_address)
+    state = getattr(session, "kxci_state", None)
+    return None if state is None else state.settings.get("RPM")
+
+
+def scan_ends(test):
+    """
+    ---------------------------------------------------------------------------
+    Returns the first and last wavelength of an ascending scan of test, or
+    the single wavelength twice.
+    ---------------------------------------------------------------------------
+    """
+    if not test.wrange_set:
+        w = getattr(test, "single_w_val", 0)
+        return w, w
+    last = test.wstart + (test.wsteps - 1) * test.wstep
+    return test.wstart, last
+
+
+class job_queue(object):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: job_queue
+    INIT VARIABLES: tests (K4200_test list) --> None
+                    position (int) --> None
+                    rpm (int) --> None
+    INHERITANCE: Object
+    ----------------------------------------------------------------------------
+    Holds tests to be run as a batch. position is where the monochromator
+    is now and rpm the mode the RPM modules are in, if known. plan() orders
+    the tests and picks the direction of each scan, predict() estimates how
+    long each will take and run() runs them in that order.
+
+    If position is not given it is where the last queue left the
+    monochromator, and if rpm is not given it is read from the state mirror
+    of the pooled 4200-SCS session (see ki4200.kxci_state).
+
+    scale holds, for each mode, the ratio of actual to predicted time of the
+    tests run so far. It is shared by every queue, so predictions get better
+    as a session goes on.
+    ----------------------------------------------------------------------------
+    """
+
+    scale = {}
+    last_position = None
+
+    def __init__(self, tests=None, position=None, rpm=None):
+        self.tests = list(tests or [])
+        self.position = job_queue.last_position if position is None \
+            else position
+        self.rpm = current_rpm() if rpm is None else rpm
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__, [t.mode for t in self.tests])
+
+    def __len__(self):
+        return len(self.tests)
+
+    def add(self, test):
+        self.tests.append(test)
+
+    def plan(self):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: plan
+        INPUTS: self
+        RETURNS: plan (list of (test, descending) tuples)
+        DEPENDENCIES: none
+        ------------------------------------------------------------------------
+        Orders the tests so that those needing the same RPM mode run
+        together, the mode the modules are in (or else that of the first
+        test) going first, and otherwise keeps the order they were added in.
+        Each multi wavelength test is then set to run downwards if its last
+        wavelength is nearer the monochromator than its first.
+        ------------------------------------------------------------------------
+        """
+        modes = []
+        if self.rpm is not None:
+            modes.append(self.rpm)
+        for test in self.tests:
+            if rpm_mode(test) not in modes:
+                modes.append(rpm_mode(test))
+
+        plan = []
+        position = self.position
+        for mode in modes:
+            for test in self.tests:
+                if rpm_mode(test) != mode:
+                    continue
+                first, last = scan_ends(test)
+                descending = (test.wrange_set and position is not None and
+                              abs(position - last) < abs(position - first))
+                plan.append((test, descending))
+                position = first if descending else last
+        return plan
+
+    def predict(self, test, descending=False, position=None, rpm=None):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: predict
+        INPUTS: self, test (K4200_test)
+                descending (bool) --> False
+                position, rpm (int) --> None
+        RETURNS: seconds (float)
+        DEPENDENCIES: none
+        ------------------------------------------------------------------------
+        Estimates how long test will take starting with the monochromator at
+        position and the RPM modules in mode rpm, from TIMINGS, the test
+        settings and scale. Adaptive repetitions are counted halfway between
+        their minimum and maximum, and an adaptive scan as twice its coarse
+        pass (or max_wavelengths), limited to its budget. A continuous scan
+        takes as long as the grating takes to cross the range.
+        ------------------------------------------------------------------------
+        """
+        t = TIMINGS
+        seconds = t["setup"]
+        if rpm is None or rpm != rpm_mode(test):
+            seconds += t["rpm_switch"]
+
+        points = sweep_points(test)
+        if test.mode == "iv":
+            sweep = points * t["smu_point"][min(int(test.speed), 3)]
+        elif points == 1 and test.mode == "cv":
+            sweep = t["cvu_spot"]
+        else:
+            sweep = points * t["cvu_point"][min(int(test.speed), 2)]
+
+        repetitions = int(test.repetitions)
+        if getattr(test, "sem_target", None) is not None:
+            repetitions = (test.min_repetitions + test.max_repetitions) / 2.0
+        measure = repetitions * (sweep + t["aux"])
+
+        first, last = scan_ends(test)
+        start = last if descending else first
+        if position is not None:
+            seconds += abs(position - start) / t["mono_rate"]
+        if not test.wrange_set:
+            seconds += 1 + measure
+        elif getattr(test, "scan_speed", None) is not None:
+            seconds += float(test.wait) + (last - first) / test.scan_speed
+        else:
+            wavelengths = test.wsteps
+            if getattr(test, "fine_step", None) is not None:
+                wavelengths = test.max_wavelengths or 2 * test.wsteps
+            step = test.wstep / t["mono_rate"]
+            if float(test.wait) > 0.5:
+                # the shutter stays closed for the wait, including the move
+                step = max(step, float(test.wait))
+            seconds += wavelengths * (step + measure)
+            budget = getattr(test, "scan_budget", None)
+            if getattr(test, "fine_step", None) is not None and budget:
+                seconds = min(seconds, t["setup"] + budget)
+        return seconds * self.scale.get(test.mode, 1.0)
+
+    def schedule(self):
+        """
+        ------------------------------------------------------------------------
+        Returns the plan as a list of (test, descending, predicted seconds).
+        ------------------------------------------------------------------------
+        """
+        schedule = []
+        position, rpm = self.position, self.rpm
+        for test, descending in self.plan():
+            schedule.append((test, descending, self.predict(
+                test, descending, position, rpm)))
+            first, last = scan_ends(test)
+            position = first if descending else last
+            rpm = rpm_mode(test)
+        return schedule
+
+    def summary(self):
+        """
+        ------------------------------------------------------------------------
+        Returns the plan and predicted times as a table to be printed.
+        ------------------------------------------------------------------------
+        """
+        lines = ["{0:<4}{1:<16}{2:<6}{3:<22}{4:>10}".format(
+            "#", "Test", "Mode", "Wavelengths (A)", "Time")]
+        total = 0
+        for i, (test, descending, seconds) in enumerate(self.schedule()):
+            first, last = scan_ends(test)
+            if not test.wrange_set:
+                scan = str(first)
+            elif descending:
+                scan = "{0} -> {1}".format(last, first)
+            else:
+                scan = "{0} -> {1}".format(first, last)
+            lines.append("{0:<4}{1:<16}{2:<6}{3:<22}{4:>10}".format(
+                i + 1, str(getattr(test, "label", test.mode))[:15],
+                test.mode, scan, clock(seconds)))
+            total += seconds
+        lines.append("{0:<48}{1:>10}".format("Predicted total", clock(total)))
+        return "\n".join(lines)
+
+    def run(self, confirm=None):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: run
+        INPUTS: self, confirm (callable) --> None
+        RETURNS: times (list of (test, seconds) tuples)
+        DEPENDENCIES: Python_4200, time
+        ------------------------------------------------------------------------
+        Runs the tests in the order of plan(), each in its planned direction.
+        If confirm is given it is called with summary() first, and nothing is
+        run unless it returns True. The time each test takes updates scale,
+        and the monochromator position and RPM mode are carried over to the
+        next batch.
+        ------------------------------------------------------------------------
+        """
+        schedule = self.schedule()
+        if confirm is not None and not confirm(self.summary()):
+            return []
+
+        times = []
+        for test, descending, predicted in schedule:
+            test.descending = descending
+            start = monotonic()
+            try:
+                test.run_test()
+            finally:
+                test.descending = False
+            seconds = monotonic() - start
+            times.append((test, seconds))
+
+            ratio = seconds / predicted * self.scale.get(test.mode, 1.0)
+            self.scale[test.mode] = (
+                ratio if test.mode not in self.scale
+                else (self.scale[test.mode] + ratio) / 2)
+            first, last = scan_ends(test)
+            self.position = first if descending else last
+            job_queue.last_position = self.position
+            self.rpm = rpm_mode(test)
+            Python_4200.K4200_test.last_test = "iv" if self.rpm == 3 else "c"
+        return times
+
+    def interleave(self):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: interleave
+        INPUTS: self
+        RETURNS: 0
+        DEPENDENCIES: Python_4200
+        ------------------------------------------------------------------------
+        Runs every test at each wavelength of one scan, rather than one scan
+        per test. The first test in plan order leads: its wavelength range
+        (and scan planner, if it has one) sets the wavelengths, scanned in
+        the direction plan() picks for it, and the others are given the same
+        range so all the results share one wavelength axis. Each test still
+        saves its own csv, column file and figure.
+
+        The tests share one worker and one sampler if those are turned on.
+        The instrument sessions are pooled for the run, as every test uses
+        the same ones, and closed at the end unless keep_sessions is set.
+        Before each test the 4200-SCS is set up for it again with select(),
+        so with mirror_state only the commands that differ between the tests
+        are sent. An error part way through forgets the mirrored state.
+
+        The settings in SHARED are only changed for the run, so afterwards
+        (even if it fails) every test has its own range, direction, figure
+        and keep_sessions back.
+        ------------------------------------------------------------------------
+        """
+        plan = self.plan()
+        if not plan:
+            return 0
+        lead, descending = plan[0]
+        plan = [test for test, d in plan]
+        if not lead.wrange_set:
+            raise ValueError("interleaved tests need a wavelength range")
+        if any(test.scan_speed is not None for test in plan):
+            raise ValueError("interleaved tests cannot scan continuously")
+        # each test's own settings, put back once the run is over
+        missing = object()
+        saved = [{name: vars(test).get(name, missing) for name in SHARED}
+                 for test in plan]
+
+        groups = []
+        for test in plan:
+            if not groups or rpm_mode(groups[-1][0]) != rpm_mode(test):
+                groups.append([])
+            groups[-1].append(test)
+
+        try:
+            for i, test in enumerate(plan):
+                test.keep_sessions = True
+                test.wrange_set = True
+                test.wstart, test.wend = lead.wstart, lead.wend
+                test.wstep, test.wsteps = lead.wstep, lead.wsteps
+                test.figure_num = i + 1
+                test.descending = descending
+                test.setup_test()
+                test.running = True
+                test.prepare_results()
+                test.wavelengths = []
+                test.stream = None
+
+            lead.sh.open()
+            if lead.pipelined:
+                lead.start_worker()
+            if lead.sample_aux:
+                lead.start_sampler()
+            for test in plan[1:]:
+                if lead.worker is not None:
+                    test.worker, test.pending = lead.worker, lead.pending
+                test.sampler = lead.sampler
+
+            try:
+                for n, w in enumerate(lead.scan()):
+                    lead.goto_wavelength(w)
+                    for group in (groups if n % 2 == 0 else groups[::-1]):
+                        for test in group:
+                            test.select()
+                            test.measure(w)
+            except:
+                for test in plan:
+                    test.forget_state()
+                raise
+            finally:
+                lead.stop_worker()
+                lead.stop_sampler()
+                for test in plan[1:]:
+                    test.worker = test.sampler = None
+
+            for test in plan:
+                test.select()
+                test.finish_multi_sweep()
+        finally:
+            for test, attributes in zip(plan, saved):
+                for name, value in attributes.items():
+                    if value is missing:
+                        vars(test).pop(name, None)
+                    else:
+                        setattr(test, name, value)
+            if not any(test.keep_sessions for test in plan):
+                lead.close_sessions()
+        if lead.wavelengths:
+            self.position = lead.wavelengths[-1]
+            job_queue.last_position = self.position
+        self.rpm = rpm_mode(plan[-1])
+        return 0
+
+
+def clock(seconds):
+    """
+    ---------------------------------------------------------------------------
+    Formats a number of seconds as h:mm:ss.
+    ---------------------------------------------------------------------------
+    """
+    seconds = int(round(seconds))
+    return "{0}:{1:02d}:{2:02d}".format(seconds // 3600,
+                                        seconds // 60 % 60, seconds % 60)
@@ -0,0 +1,130 @@
+from threading import RLock
+"""
+--------------------------------------------------------------------------------
+MODULE: sessions.py
+REQUIRES: Python 3.4+
+DEPENDENCIES: threading
+--------------------------------------------------------------------------------
+This module contains a pool of open instrument sessions, so that VISA
+resources, the monochromator and the shutter are opened once and then reused
+by every test that follows rather than being reopened each time. This matters
+most for the shutter, as opening its port resets the Arduino.
+
+Sessions are keyed by a tuple starting with their kind ("visa" or "serial")
+and address, followed by anything else that would make a session unsuitable
+for reuse. They are checked before being handed out again, and a session
+that fails its check is closed and a fresh one opened in its place.
+
+Example:
+    >>>pool = session_pool()
+    >>>k = pool.get(("visa", addr), lambda: rm.open_resource(addr),
+    ...              check=lambda s: "KI4200" in s.query("ID"))
+    >>>pool.close_all()
+--------------------------------------------------------------------------------
+"""
+
+
+class session_pool(object):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: session_pool
+    INHERITANCE: Object
+    ----------------------------------------------------------------------------
+    Holds open sessions along with the function used to close each one. get()
+    returns a pooled session if there is a healthy one, otherwise it opens a
+    new one. Nothing is closed until discard() or close_all() is called.
+    ----------------------------------------------------------------------------
+    """
+
+    def __init__(self):
+        self.lock = RLock()
+        self.sessions = {}
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__, sorted(self.sessions, key=str))
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def healthy(self, session, check):
+        if check is None:
+            return True
+        try:
+            return bool(check(session))
+        except:
+            return False
+
+    def get(self, key, opener, check=None, close=None, check_new=True):
+        """
+        ------------------------------------------------------------------------
+        FUNCTION: get
+        INPUTS: self, key (tuple), opener (callable)
+                check (callable) --> None
+                close (callable) --> None
+                check_new (bool) --> True
+        RETURNS: session, or None
+        DEPENDENCIES: none
+        ------------------------------------------------------------------------
+        Returns the pooled session for key if check(session) is true, or a new
+        one from opener(). close(session) is what closes it later, the default
+        is session.close(). New sessions are checked as well unless check_new
+        is False, if that fails the session is closed and None is returned.
+        ------------------------------------------------------------------------
+        """
+        with self.lock:
+            closer = close or (lambda s: s.close())
+            if key in self.sessions:
+                session, closer = self.sessions[key]
+                if self.healthy(session, check):
+                    return session
+                self.discard(key)
+            session = opener()
+            if check_new and not self.healthy(session, check):
+                closer(session)
+                return None
+            self.sessions[key] = (session, closer)
+            return session
+
+    def find(self, kind, address):
+        """
+        ------------------------------------------------------------------------
+        Returns the pooled session of the given kind at address, or None.
+        ------------------------------------------------------------------------
+        """
+        with self.lock:
+            for key, (session, closer) in self.sessions.items():
+                if key[:2] == (kind, address):
+                    return session
+        return None
+
+    def discard(self, key):
+        """
+        ------------------------------------------------------------------------
+        Closes the session for key and removes it from the pool. Any KXCI
+        state mirrored on the session is forgotten, as a new session may find
+        the instrument changed.
+        ------------------------------------------------------------------------
+        """
+        with self.lock:
+            if key not in self.sessions:
+                return
+            session, closer = self.sessions.pop(key)
+            state = getattr(session, "kxci_state", None)
+            if state is not None:
+                state.forget()
+            try:
+                closer(session)
+            except:
+                print("failed to close {0}".format(session))
+
+    def close_all(self, kind=None):
+        """
+        ------------------------------------------------------------------------
+        Closes every session, or only those of the given kind.
+        ------------------------------------------------------------------------
+        """
+        with self.lock:
+            for key in list(self.sessions):
+                if kind is None or key[0] == kind:
+                    self.discard(key)
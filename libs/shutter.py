@@ -1,10 +1,12 @@
 import serial
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from threading import RLock
+from time import monotonic, sleep
 """
 --------------------------------------------------------------------------------
 MODULE: shutter.py
 WRITTEN IN: Python 3.4
-DEPENDENCIES: pyserial, time.sleep
+DEPENDENCIES: pyserial, time, threading, concurrent.futures
 AUTHOR: Finlay TD Knops-Mckim
 LAST MODIFIED: 2015/06/05
 --------------------------------------------------------------------------------
@@ -12,14 +14,16 @@ This module contains a single class (and demo) for controlling a simple Arduino
 shutter system. The system in question consists of a servo motor with a
 rectangular panel attached to it. The Arduino sets the servo to 90° when it
 recieves a serial '1', and 0° with serial '0'. The shutter will not move
-instantly and the methods have delays to reflect this, so take this into
-account if precise timings are needed.
+instantly, so open and close wait for the Arduino to reply and then for the
+servo travel time before returning.
 
 Example:
     >>import shutter.py
     >>S1 = ard_shutter(port=COM12)
     >>S1.open()
     >>S1.close()
+    >>f = S1.open_async()     # returns a future
+    >>S1.close(wait=False)    # fire and forget, S1.settle() waits for it
     >>S1.shutdown()
 
 Below is the code uploaded to the Arduino Uno.
@@ -73,6 +77,9 @@ class ard_shutter(object):
     ----------------------------------------------------------------------------
     CLASS: ard_shutter
     INIT VARIABLES: port (str)
+                    serial_class (class) --> serial.Serial
+                    travel (float) --> 0.9
+                    timeout (float) --> 2
     INHERITANCE: Object
     ----------------------------------------------------------------------------
     An instance of this class represents a single Arduino Uno. The user need
@@ -86,12 +93,28 @@ class ard_shutter(object):
      closed shutter.
     -shutdown() terminates the serial session for the port in use.
 
+    open and close return once the Arduino has replied "Open" or "Closed" and
+    travel seconds have passed, travel should be set to the measured time the
+    servo takes to move. If no reply comes within timeout seconds the move is
+    assumed to have happened anyway. The sketch ignores a character if it is
+    the same as the last one, so asking for the state the shutter is already
+    in returns straight away.
+
+    open_async and close_async do the same on a background thread and return
+    a concurrent.futures.Future. Passing wait=False to open or close only sends
+    the command, which lets it overlap other work such as a monochromator
+    move, settle() then blocks until that move is finished.
+
     When the user is finished with sending commands they should call the
     shutdown method to free up the serial port.
+
+    serial_class can be swapped for anything with the pyserial interface, such
+    as the simulated ports in simulator.py.
     ----------------------------------------------------------------------------
     """
 
-    def __init__(self, port="COM12"):
+    def __init__(self, port="COM12", serial_class=serial.Serial, travel=0.9,
+                 timeout=2):
         """
         ------------------------------------------------------------------------
         The 2 second wait is due to the Arduino resetting when a new serial
@@ -100,7 +123,13 @@ class ard_shutter(object):
         ------------------------------------------------------------------------
         """
         self.port = port
-        self.shutter = serial.Serial(port=self.port)
+        self.travel = travel
+        self.timeout = timeout
+        self.last = None
+        self.moving = None
+        self.lock = RLock()
+        self.executor = None
+        self.shutter = serial_class(port=self.port)
         sleep(4)
         self.shutter.flush()
 
@@ -118,35 +147,98 @@ class ard_shutter(object):
         returns true, else returns false.
         ------------------------------------------------------------------------
         """
-        self.shutter.write(b'q')
-        sleep(0.1)
-        status = self.shutter.read(self.shutter.inWaiting()).decode()
+        with self.lock:
+            self.settle()
+            if self.last == b'q':
+                # the sketch ignores a repeated character, so reset it first
+                self.shutter.write(b'-')
+            self.shutter.write(b'q')
+            self.last = b'q'
+            status = self.reply()
         correct = True if "Shutter" in status else False
         return correct
 
-    def open(self):
+    def reply(self):
+        """
+        ------------------------------------------------------------------------
+        Reads a single line from the Arduino, waiting up to timeout seconds.
+        Returns an empty string if nothing arrives.
+        ------------------------------------------------------------------------
+        """
+        self.shutter.timeout = self.timeout
+        return self.shutter.readline().decode().strip("\r\n")
+
+    def move(self, command, wait=True):
+        """
+        ------------------------------------------------------------------------
+        Sends command (b'0' or b'1') and, if wait is True, blocks until the
+        Arduino replies and the servo has had travel seconds to move. Returns
+        the reply, or None if not waiting.
+        ------------------------------------------------------------------------
+        """
+        with self.lock:
+            status = self.settle()
+            if command == self.last:
+                return status if wait else None
+            self.shutter.reset_input_buffer()
+            self.shutter.write(command)
+            self.last = command
+            self.moving = (command, monotonic())
+            if wait:
+                return self.settle()
+
+    def settle(self):
+        """
+        ------------------------------------------------------------------------
+        Blocks until the last move has finished, returning the reply for it,
+        or an empty string if nothing is moving.
+        ------------------------------------------------------------------------
+        """
+        with self.lock:
+            if self.moving is None:
+                return {b'0': "Open", b'1': "Closed"}.get(self.last, "")
+            command, start = self.moving
+            self.moving = None
+            status = self.reply()
+            remaining = self.travel - (monotonic() - start)
+            if remaining > 0:
+                sleep(remaining)
+            return status
+
+    def open(self, wait=True):
         """
         ------------------------------------------------------------------------
         The time taken to move the shutter will depend on the exact servo and
-        panel combination used. 1 second was about right for this experiment.
+        panel combination used, see travel.
         ------------------------------------------------------------------------
         """
-        self.shutter.write(b'0')
-        sleep(1)  # wait for movement
-        status = self.shutter.read(self.shutter.inWaiting())
-        return status.decode().strip("\r\n")
+        return self.move(b'0', wait)
 
-    def close(self):
+    def close(self, wait=True):
         """
         ------------------------------------------------------------------------
         As above, closing speed will change with equipment. And gravity if you
         are going the other way.
         ------------------------------------------------------------------------
         """
-        self.shutter.write(b'1')
-        sleep(1)  # wait for movement
-        status = self.shutter.read(self.shutter.inWaiting())
-        return status.decode().strip("\r\n")
+        return self.move(b'1', wait)
+
+    def background(self, function):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        return self.executor.submit(function)
+
+    def open_async(self):
+        """
+        ------------------------------------------------------------------------
+        Opens the shutter on a background thread, returning a future that
+        gives the reply once the shutter is open.
+        ------------------------------------------------------------------------
+        """
+        return self.background(self.open)
+
+    def close_async(self):
+        return self.background(self.close)
 
     def shutdown(self):
         """
@@ -154,6 +246,10 @@ class ard_shutter(object):
         Call when finished with commands to free serial port
         ------------------------------------------------------------------------
         """
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        self.settle()
         self.shutter.close()
 
 
@@ -0,0 +1,842 @@
+import random
+from math import exp, floor, log10, sqrt
+from threading import RLock
+from time import monotonic, sleep
+"""
+--------------------------------------------------------------------------------
+MODULE: simulator.py
+REQUIRES: Python 3.4+
+DEPENDENCIES: random, math, threading, time
+--------------------------------------------------------------------------------
+This module contains an offline stand-in for the whole CVW bench so that tests
+can be run, timed and profiled without any of the real equipment attached.
+
+The bench is made up of:
+    -Keithley 4200-SCS (KXCI over GPIB), CVU and SMU sweeps with SRQ
+    -Lakeshore 331 temperature controller (KRDG?)
+    -EG&G 5302 lock in amplifier (ID, FRQ, MAG, PHA)
+    -CM110 monochromator (binary serial protocol, see cm110.py)
+    -Arduino shutter (serial '0', '1', 'q', see shutter.py)
+
+The VISA instruments are served by a resource manager look-alike and the
+serial devices by a pyserial look-alike, so the existing drivers run on top of
+them unchanged. Every reply is delayed by a configurable latency, and sweeps
+only raise their service request once the simulated sweep time has elapsed.
+
+Example:
+    >>>from libs import simulator, Python_4200
+    >>>bench = simulator.sim_bench(time_scale=0.1)  # run 10x faster
+    >>>bench.install(Python_4200.K4200_test)        # swap out real hardware
+    >>>test = Python_4200.cv_test("sim", mono_port="COM1",
+    ...                           shutter_port="COM12")
+    >>>test.set_wavelengths(5000, 5500, 50)
+    >>>test.run_test()
+--------------------------------------------------------------------------------
+"""
+
+# Default timings in seconds, chosen to match what was seen on the real bench
+LATENCIES = {
+    "gpib_write": 0.002,        # per GPIB write
+    "gpib_read": 0.004,         # per GPIB read, before any payload
+    "gpib_byte": 2e-6,          # per byte of GPIB payload
+    "lia_reply": 0.05,          # 5302 needs a query_delay of ~50ms
+    "ls331_reply": 0.01,        # LS331 KRDG? turnaround
+    "cvu_point": (0.02, 0.1, 0.5),          # per CVU point for speed 0-2
+    "smu_point": (0.005, 0.01, 0.02, 0.3),  # per SMU point for IT 0-3
+    "cvu_spot": 0.05,           # :CVU:MEASZ? spot measurement
+    "rpm_switch": 1.5,          # kxci_rpm_switch user library call
+    "mono_command": 0.01,       # CM110 turnaround before moving
+    "mono_rate": 1000.0,        # CM110 slew rate in angstroms per second
+    "shutter_reply": 0.06,      # firmware loop delay before replying
+    "shutter_travel": 0.35,     # servo travel time
+    "arduino_reset": 2.0,       # boot loader delay after opening the port
+}
+
+
+class sim_timeout(Exception):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: sim_timeout
+    INHERITANCE: Exception
+    ----------------------------------------------------------------------------
+    Raised when a simulated read or service request wait runs out of time,
+    standing in for VisaIOError and an empty pyserial read.
+    ----------------------------------------------------------------------------
+    """
+    pass
+
+
+class sim_bench(object):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: sim_bench
+    INIT VARIABLES: time_scale (float) --> 1.0
+                    noise (float) --> 0.002
+                    seed (int) --> None
+                    **latencies (float) --> see LATENCIES
+    INHERITANCE: Object
+    ----------------------------------------------------------------------------
+    Holds every simulated instrument along with the shared optical state (the
+    monochromator position and shutter state) that the measurements depend on.
+    The shutter only lets light through once its servo travel time is up.
+    time_scale multiplies every simulated delay, so 0 gives an instant bench
+    and 1 a bench that runs in real time.
+
+    The sample is modelled as a junction with an absorption edge at
+    edge_wavelength angstroms. Light below the edge, with the shutter open,
+    raises capacitance, photocurrent and the lock in magnitude.
+    ----------------------------------------------------------------------------
+    """
+
+    edge_wavelength = 5200
+    edge_width = 80
+
+    def __init__(self, time_scale=1.0, noise=0.002, seed=None,
+                 ls331_address="GPIB0::1::INSTR",
+                 k4200_address="GPIB0::17::INSTR",
+                 lia5302_address="GPIB0::12::INSTR",
+                 mono_port="COM1", shutter_port="COM12", **latencies):
+        self.time_scale = time_scale
+        self.noise = noise
+        self.random = random.Random(seed)
+        self.latency = dict(LATENCIES)
+        for name, value in latencies.items():
+            if name not in self.latency:
+                raise KeyError("Unknown latency {0}".format(name))
+            self.latency[name] = value
+
+        self.mono = sim_cm110_state(self)
+        self.shutter = (0, False)
+
+        self.visa = {ls331_address: sim_ls331,
+                     k4200_address: sim_k4200,
+                     lia5302_address: sim_lia5302}
+        self.ports = {mono_port: sim_cm110_port,
+                      shutter_port: sim_shutter_port}
+        self.rm = sim_resource_manager(self)
+
+    def __repr__(self):
+        return "%s(time_scale=%r)" % (self.__class__, self.time_scale)
+
+    def __str__(self):
+        return "Simulated bench with {0} VISA and {1} serial devices".format(
+            len(self.visa), len(self.ports))
+
+    def delay(self, seconds):
+        """
+        ------------------------------------------------------------------------
+        Sleeps for a simulated duration, scaled by time_scale.
+        ------------------------------------------------------------------------
+        """
+        if seconds > 0 and self.time_scale > 0:
+            sleep(seconds * self.time_scale)
+
+    def later(self, seconds):
+        """
+        ------------------------------------------------------------------------
+        Returns the monotonic time at which a simulated duration will be over.
+        ------------------------------------------------------------------------
+        """
+        return monotonic() + seconds * self.time_scale
+
+    def illumination(self, t=None):
+        """
+        ------------------------------------------------------------------------
+        Returns the relative light level reaching the sample from 0 to 1, based
+        on the monochromator position at time t and the shutter state.
+        ------------------------------------------------------------------------
+        """
+        t = monotonic() if t is None else t
+        moved, is_open = self.shutter
+        if not is_open or t < moved:
+            return 0.0
+        w = self.mono.position(t)
+        x = (w - self.edge_wavelength) / self.edge_width
+        x = min(max(x, -50), 50)
+        return 1 / (1 + exp(x))
+
+    def jitter(self, value):
+        return value * (1 + self.random.gauss(0, self.noise))
+
+    def Serial(self, port=None, timeout=None, **kwargs):
+        """
+        ------------------------------------------------------------------------
+        Drop in replacement for serial.Serial. Opens the simulated device
+        at port, raising IOError if nothing is attached there.
+        ------------------------------------------------------------------------
+        """
+        try:
+            device = self.ports[port]
+        except KeyError:
+            raise IOError("could not open port {0}".format(port))
+        return device(self, port=port, timeout=timeout)
+
+    def comports(self):
+        """
+        ------------------------------------------------------------------------
+        Drop in replacement for serial.tools.list_ports.comports.
+        ------------------------------------------------------------------------
+        """
+        return [(p, "Simulated {0}".format(d.__name__), "SIM")
+                for p, d in sorted(self.ports.items())]
+
+    def install(self, test_class):
+        """
+        ------------------------------------------------------------------------
+        Points a K4200_test class (or subclass) at this bench, including the
+        instrument addresses and COM ports, so every later test runs offline.
+        The shutter travel waited for is set to the simulated one, scaled by
+        time_scale like every other delay.
+        ------------------------------------------------------------------------
+        """
+        test_class.rm = self.rm
+        test_class.shutter_travel = self.latency["shutter_travel"] * \
+            self.time_scale
+        test_class.serial_class = self.Serial
+        test_class.comports = self.comports
+        for address, instr in self.visa.items():
+            setattr(test_class, instr.address_attr, address)
+        for port, device in self.ports.items():
+            setattr(test_class, device.port_attr, port)
+
+
+class sim_resource_manager(object):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: sim_resource_manager
+    INIT VARIABLES: bench (sim_bench)
+    INHERITANCE: Object
+    ----------------------------------------------------------------------------
+    Stands in for visa.ResourceManager, listing and opening the simulated
+    instruments on the bench.
+    ----------------------------------------------------------------------------
+    """
+
+    def __init__(self, bench):
+        self.bench = bench
+
+    def list_resources(self):
+        serial = ["ASRL{0}::INSTR".format(p.replace("COM", ""))
+                  for p in sorted(self.bench.ports)]
+        return tuple(sorted(self.bench.visa) + serial)
+
+    def open_resource(self, address):
+        try:
+            instr = self.bench.visa[address]
+        except KeyError:
+            raise sim_timeout("no instrument at {0}".format(address))
+        return instr(self.bench, address)
+
+
+class sim_gpib_instr(object):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: sim_gpib_instr
+    INIT VARIABLES: bench (sim_bench)
+                    address (str)
+    INHERITANCE: Object
+    ----------------------------------------------------------------------------
+    Common behaviour for the simulated VISA sessions. Subclasses implement
+    respond(), which takes a single command and returns the reply string, or
+    None if the command does not produce one. Replies are queued and handed
+    back one at a time by read().
+    ----------------------------------------------------------------------------
+    """
+
+    address_attr = ""
+    reply_latency = "gpib_read"
+
+    def __init__(self, bench, address):
+        self.bench = bench
+        self.resource_name = address
+        self.primary_address = int(address.split("::")[1])
+        self.timeout = 2000
+        self.query_delay = 0
+        self.chunk_size = 20 * 1024
+        self.read_termination = None
+        self.write_termination = "\r\n"
+        self.session_open = True
+        self.srq_time = None
+        self.lock = RLock()
+        self.replies = []
+        self.log = []
+
+    def __repr__(self):
+        return "<%s(%r)>" % (self.__class__.__name__, self.resource_name)
+
+    def respond(self, command):
+        return None
+
+    def check_open(self):
+        if not self.session_open:
+            raise sim_timeout("session at {0} is closed".format(
+                self.resource_name))
+
+    def write(self, message, termination=None, encoding=None):
+        with self.lock:
+            self.check_open()
+            self.bench.delay(self.bench.latency["gpib_write"])
+            self.log.append(message)
+            for command in message.split(";"):
+                reply = self.respond(command.strip())
+                if reply is not None:
+                    self.replies.append(reply)
+            return len(message)
+
+    def read_bytes_ready(self):
+        """
+        ------------------------------------------------------------------------
+        Waits for the reply latency then returns the next queued reply encoded
+        to bytes, raising sim_timeout if there is nothing to read.
+        ------------------------------------------------------------------------
+        """
+        self.check_open()
+        if not self.replies:
+            self.bench.delay((self.timeout or 0) / 1000)
+            raise sim_timeout("read from {0} timed out".format(
+                self.resource_name))
+        reply = self.replies.pop(0).encode()
+        self.bench.delay(self.bench.latency[self.reply_latency] +
+                         self.bench.latency["gpib_byte"] * len(reply))
+        return reply
+
+    def read(self, termination=None, encoding=None):
+        with self.lock:
+            return self.read_bytes_ready().decode(encoding or "ascii")
+
+    def read_raw(self, size=None):
+        with self.lock:
+            return self.read_bytes_ready() + b"\r\n"
+
+    def query(self, message, delay=None):
+        with self.lock:
+            self.write(message)
+            self.bench.delay(self.query_delay if delay is None else delay)
+            return self.read()
+
+    def clear(self):
+        with self.lock:
+            self.replies = []
+
+    def wait_for_srq(self, timeout=25000):
+        """
+        ------------------------------------------------------------------------
+        Blocks until the pending sweep finishes. Timeout is in milliseconds as
+        in pyvisa, None waits forever.
+        ------------------------------------------------------------------------
+        """
+        self.check_open()
+        if self.srq_time is None:
+            self.bench.delay((timeout or 0) / 1000)
+            raise sim_timeout("no service request from {0}".format(
+                self.resource_name))
+        remaining = self.srq_time - monotonic()
+        if timeout is not None and remaining > timeout / 1000:
+            sleep(timeout / 1000)
+            raise sim_timeout("service request from {0} timed out".format(
+                self.resource_name))
+        if remaining > 0:
+            sleep(remaining)
+        self.srq_time = None
+
+    def close(self):
+        self.session_open = False
+
+
+class sim_k4200(sim_gpib_instr):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: sim_k4200
+    INHERITANCE: sim_gpib_instr
+    ----------------------------------------------------------------------------
+    Keithley 4200-SCS running KXCI. Keeps track of the CVU and SMU settings
+    sent by cvf_commands, ct_commands and iv_commands, so that sweeps take a
+    realistic amount of time and return the right number of points.
+    ----------------------------------------------------------------------------
+    """
+
+    address_attr = "k4200_address"
+
+    def __init__(self, bench, address):
+        sim_gpib_instr.__init__(self, bench, address)
+        self.reset_cvu()
+        self.smu = {"speed": 2, "delay": 0.0, "sweep": (-5.0, 5.0, 1.0)}
+        self.light = 0.0
+
+    def reset_cvu(self):
+        self.cvu = {"model": 2, "speed": 1, "delay": 0.0, "freq": 1e6,
+                    "dcv": 0.0, "sweep": (-5.0, 5.0, 1.0), "fsweep": None}
+
+    def respond(self, command):
+        c = command.upper()
+        cvu = self.cvu
+        if c in ("ID", "*IDN?"):
+            return "KI4200 KXCI"
+        elif c.startswith("EX PMUULIB KXCI_RPM_SWITCH"):
+            self.srq_time = self.bench.later(
+                self.bench.latency["rpm_switch"])
+        elif c == ":CVU:RESET":
+            self.reset_cvu()
+        elif c.startswith(":CVU:MODEL "):
+            cvu["model"] = int(c.split()[1])
+        elif c.startswith(":CVU:SPEED "):
+            cvu["speed"] = int(c.split()[1])
+        elif c.startswith(":CVU:DELAY:SWEEP "):
+            cvu["delay"] = float(c.split()[1])
+        elif c.startswith(":CVU:FREQ "):
+            cvu["freq"] = float(c.split()[1])
+        elif c.startswith(":CVU:DCV "):
+            cvu["dcv"] = float(c.split()[1])
+        elif c.startswith(":CVU:SWEEP:DCV "):
+            cvu["sweep"] = tuple(float(v) for v in c.split()[1].split(","))
+            cvu["fsweep"] = None
+        elif c.startswith(":CVU:SWEEP:FREQ "):
+            cvu["fsweep"] = tuple(float(f) for f in c.split()[1].split(","))
+        elif c == ":CVU:TEST:RUN":
+            n = len(self.cvu_axis())
+            self.light = self.bench.illumination()
+            self.srq_time = self.bench.later(
+                n * (self.bench.latency["cvu_point"][cvu["speed"]] +
+                     cvu["delay"]))
+        elif c == ":CVU:DATA:Z?":
+            return self.impedance()
+        elif c == ":CVU:DATA:VOLT?":
+            return self.cvu_list(
+                [cvu["dcv"]] * len(self.cvu_axis()) if cvu["fsweep"]
+                else self.cvu_axis())
+        elif c == ":CVU:DATA:FREQ?":
+            return self.cvu_list(
+                self.cvu_axis() if cvu["fsweep"]
+                else [cvu["freq"]] * len(self.cvu_axis()))
+        elif c == ":CVU:DATA:STATUS?":
+            return self.cvu_list([0] * len(self.cvu_axis()))
+        elif c == ":CVU:DATA:TSTAMP?":
+            return self.cvu_list(range(len(self.cvu_axis())))
+        elif c == ":CVU:MEASZ?":
+            self.bench.delay(self.bench.latency["cvu_spot"])
+            p = self.capacitance(cvu["dcv"], self.bench.illumination())
+            return "{0:.6E},{1:.6E}".format(p, self.bench.jitter(1e-3))
+        elif c.startswith("VR1,"):
+            values = c.split(",")
+            self.smu["sweep"] = tuple(float(v) for v in values[1:4])
+        elif c.startswith("DT "):
+            self.smu["delay"] = float(c.split()[1])
+        elif c.startswith("IT "):
+            self.smu["speed"] = int(c.split()[1])
+        elif c == "ME1":
+            n = len(self.sweep_points(*self.smu["sweep"]))
+            self.light = self.bench.illumination()
+            self.srq_time = self.bench.later(
+                n * (self.bench.latency["smu_point"][self.smu["speed"]] +
+                     self.smu["delay"]))
+        elif c == "DO 'IA'":
+            return ",".join("N{0:.4E}".format(self.current(v, self.light))
+                            for v in self.sweep_points(*self.smu["sweep"]))
+        elif c == "DO 'VA'":
+            return ",".join("N{0:.4E}".format(v)
+                            for v in self.sweep_points(*self.smu["sweep"]))
+        return None
+
+    def cvu_list(self, values):
+        return ",".join("{0:.6E}".format(v) for v in values)
+
+    def sweep_points(self, start, end, step):
+        if step == 0:
+            return [start]
+        count = int(floor(round((end - start) / step, 9))) + 1
+        return [round(start + i * step, 9) for i in range(max(count, 1))]
+
+    def cvu_axis(self):
+        if self.cvu["fsweep"]:
+            fstart, fstop = self.cvu["fsweep"]
+            step = 10 ** floor(log10(fstart))
+            return self.sweep_points(fstart, fstop, step)
+        return self.sweep_points(*self.cvu["sweep"])
+
+    def capacitance(self, v, light):
+        c = 1e-10 / sqrt(1 + max(v + 5, 0) / 0.7) * (1 + 0.4 * light)
+        return self.bench.jitter(c)
+
+    def current(self, v, light):
+        i = 1e-9 * (exp(min(v, 5) / 0.5) - 1) - 2e-7 * light
+        return self.bench.jitter(i)
+
+    def impedance(self):
+        pairs = []
+        for x in self.cvu_axis():
+            v = self.cvu["dcv"] if self.cvu["fsweep"] else x
+            pairs.append("{0:.6E};{1:.6E}".format(
+                self.capacitance(v, self.light), self.bench.jitter(1e-3)))
+        return ",".join(pairs)
+
+
+class sim_ls331(sim_gpib_instr):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: sim_ls331
+    INHERITANCE: sim_gpib_instr
+    ----------------------------------------------------------------------------
+    Lakeshore 331 reading a sample at around room temperature.
+    ----------------------------------------------------------------------------
+    """
+
+    address_attr = "ls331_address"
+    reply_latency = "ls331_reply"
+
+    def respond(self, command):
+        c = command.upper()
+        if c == "*IDN?":
+            return "LSCI,MODEL331S,331A001,1.8"
+        elif c.startswith("KRDG?"):
+            return "+{0:.3f}".format(
+                295.0 + self.bench.random.gauss(0, 0.05))
+        return None
+
+
+class sim_lia5302(sim_gpib_instr):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: sim_lia5302
+    INHERITANCE: sim_gpib_instr
+    ----------------------------------------------------------------------------
+    EG&G 5302 lock in amplifier. FRQ is in mHz, MAG in hundredths of a percent
+    and PHA in millidegrees, all returned as integers as on the real unit.
+    ----------------------------------------------------------------------------
+    """
+
+    address_attr = "lia5302_address"
+    reply_latency = "lia_reply"
+
+    def respond(self, command):
+        c = command.upper()
+        if c in ("ID", "ID?"):
+            return "5302"
+        elif c == "FRQ":
+            return str(int(self.bench.jitter(137000)))
+        elif c == "MAG":
+            return str(int(self.bench.jitter(
+                100 + 9000 * self.bench.illumination())))
+        elif c == "PHA":
+            return str(int(self.bench.jitter(-45000)))
+        return None
+
+
+class sim_serial_port(object):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: sim_serial_port
+    INIT VARIABLES: bench (sim_bench)
+                    port (str)
+                    timeout (float)
+    INHERITANCE: Object
+    ----------------------------------------------------------------------------
+    Common behaviour for the simulated serial devices, covering the parts of
+    the pyserial interface used by the drivers. Subclasses implement receive(),
+    which is handed each byte written to the port and schedules replies with
+    reply(). Replies only become readable once their scheduled time is up.
+    ----------------------------------------------------------------------------
+    """
+
+    port_attr = ""
+
+    def __init__(self, bench, port, timeout=None):
+        self.bench = bench
+        self.port = port
+        self.timeout = timeout
+        self.is_open = True
+        self.lock = RLock()
+        self.pending = []
+        self.buffer = bytearray()
+        self.log = bytearray()
+
+    def __repr__(self):
+        return "<%s(%r)>" % (self.__class__.__name__, self.port)
+
+    def reply(self, data, ready):
+        with self.lock:
+            self.pending.append((ready, bytes(data)))
+            self.pending.sort(key=lambda p: p[0])
+
+    def receive(self, byte):
+        pass
+
+    def collect(self):
+        now = monotonic()
+        with self.lock:
+            while self.pending and self.pending[0][0] <= now:
+                self.buffer += self.pending.pop(0)[1]
+
+    def write(self, data):
+        if not self.is_open:
+            raise IOError("port {0} is closed".format(self.port))
+        for byte in bytes(data):
+            self.log.append(byte)
+            self.receive(byte)
+        return len(data)
+
+    def inWaiting(self):
+        self.collect()
+        return len(self.buffer)
+
+    @property
+    def in_waiting(self):
+        return self.inWaiting()
+
+    def read(self, size=1):
+        """
+        ------------------------------------------------------------------------
+        Blocks until size bytes have arrived or the timeout runs out, then
+        returns whatever has arrived, as pyserial does.
+        ------------------------------------------------------------------------
+        """
+        end = None if self.timeout is None else monotonic() + self.timeout
+        while True:
+            self.collect()
+            with self.lock:
+                if len(self.buffer) >= size:
+                    break
+                ready = self.pending[0][0] if self.pending else None
+            if end is not None and monotonic() >= end:
+                break
+            if ready is None and end is None:
+                raise sim_timeout("read on {0} would block forever".format(
+                    self.port))
+            wake = min(t for t in (ready, end) if t is not None)
+            sleep(max(wake - monotonic(), 0))
+        with self.lock:
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+        return data
+
+    def readline(self):
+        """
+        ------------------------------------------------------------------------
+        Reads up to and including a newline, with the timeout covering the
+        whole line as in pyserial.
+        ------------------------------------------------------------------------
+        """
+        line = bytearray()
+        timeout = self.timeout
+        end = None if timeout is None else monotonic() + timeout
+        try:
+            while not line.endswith(b"\n"):
+                if end is not None:
+                    self.timeout = max(end - monotonic(), 0)
+                byte = self.read(1)
+                if not byte:
+                    break
+                line += byte
+        finally:
+            self.timeout = timeout
+        return bytes(line)
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        self.collect()
+        with self.lock:
+            self.buffer = bytearray()
+
+    flushInput = reset_input_buffer
+
+    def close(self):
+        self.is_open = False
+
+
+class sim_cm110_state(object):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: sim_cm110_state
+    INIT VARIABLES: bench (sim_bench)
+    INHERITANCE: Object
+    ----------------------------------------------------------------------------
+    Mechanical state of the monochromator, kept on the bench so that it lasts
+    between serial sessions like the real grating does. Moves are stored as
+    (start time, end time, start position, end position) so the position can
+    be found at any moment, including part way through a scan.
+    ----------------------------------------------------------------------------
+    """
+
+    def __init__(self, bench):
+        self.bench = bench
+        self.move = (0, 0, 5000, 5000)
+        self.speed = 1000
+        self.units = 2
+        self.config = {0: 5000, 1: 0, 2: 1200, 3: 5000, 4: 1, 5: 1000,
+                       6: 1, 13: 2, 14: 2, 19: 11205}
+
+    def position(self, t=None):
+        t = monotonic() if t is None else t
+        t0, t1, p0, p1 = self.move
+        if t >= t1 or t1 == t0:
+            return p1
+        if t <= t0:
+            return p0
+        return p0 + (p1 - p0) * (t - t0) / (t1 - t0)
+
+    def goto(self, target, rate=None, start=None):
+        """
+        ------------------------------------------------------------------------
+        Starts a move to target and returns the time it will finish.
+        ------------------------------------------------------------------------
+        """
+        rate = rate or self.bench.latency["mono_rate"]
+        t0 = self.bench.later(self.bench.latency["mono_command"]) \
+            if start is None else start
+        p0 = self.position(t0)
+        t1 = t0 + abs(target - p0) / rate * self.bench.time_scale
+        self.move = (t0, t1, p0, target)
+        self.config[0] = target
+        return t1
+
+
+class sim_cm110_port(sim_serial_port):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: sim_cm110_port
+    INHERITANCE: sim_serial_port
+    ----------------------------------------------------------------------------
+    CM110 binary protocol. Each command byte is followed by a fixed number of
+    data bytes, once a frame is complete the reply is scheduled. Replies are
+    the status byte followed by the cancel byte 24, with the high and low data
+    bytes first for a query. Moves only reply when the grating has stopped.
+    ----------------------------------------------------------------------------
+    """
+
+    port_attr = "mono_port"
+    frame_lengths = {1: 0, 7: 0, 12: 4, 13: 2, 16: 2, 18: 2, 26: 1, 27: 0,
+                     50: 1, 51: 1, 52: 0, 54: 0, 55: 1, 56: 1, 255: 2}
+
+    def __init__(self, bench, port, timeout=None):
+        sim_serial_port.__init__(self, bench, port, timeout)
+        self.frame = []
+
+    def status(self, accepted=True):
+        s = self.bench.mono.units
+        return s if accepted else s | 1 << 7
+
+    def receive(self, byte):
+        if not self.frame:
+            if byte not in self.frame_lengths:
+                return  # unknown commands are ignored
+        self.frame.append(byte)
+        if len(self.frame) - 1 < self.frame_lengths[self.frame[0]]:
+            return
+        frame, self.frame = self.frame, []
+        state = self.bench.mono
+        c = frame[0]
+        now = self.bench.later(self.bench.latency["mono_command"])
+        if c == 27:
+            self.reply([27], now)
+        elif c == 56:
+            value = state.config.get(frame[1], 0)
+            if frame[1] == 0:
+                value = int(round(state.position()))
+            self.reply(list(divmod(value, 0x100)) + [self.status(), 24], now)
+        elif c == 16:
+            target = frame[1] * 0x100 + frame[2]
+            self.reply([self.status(), 24], state.goto(target))
+        elif c in (1, 7):
+            step = state.config[5] // 100 or 1
+            target = int(state.position()) + (step if c == 7 else -step)
+            self.reply([self.status(), 24], state.goto(target))
+        elif c == 13:
+            state.speed = frame[1] * 0x100 + frame[2]
+            self.reply([self.status(), 24], now)
+        elif c == 12:
+            start = frame[1] * 0x100 + frame[2]
+            end = frame[3] * 0x100 + frame[4]
+            t = state.goto(start)
+            self.reply([self.status(), 24],
+                       state.goto(end, rate=state.speed, start=t))
+        elif c == 255:
+            self.reply([self.status(), 24], state.goto(5000))
+        elif c == 50:
+            state.units = frame[1] if frame[1] in range(3) else state.units
+            self.reply([self.status(frame[1] in range(3)), 24], now)
+        else:
+            self.reply([self.status(), 24], now)
+
+
+class sim_shutter_port(sim_serial_port):
+
+    """
+    ----------------------------------------------------------------------------
+    CLASS: sim_shutter_port
+    INHERITANCE: sim_serial_port
+    ----------------------------------------------------------------------------
+    Arduino shutter running the sketch listed in shutter.py. Opening the port
+    resets the board, so anything written during the boot delay is lost. As in
+    the sketch, a character is only acted on if it differs from the last one.
+    ----------------------------------------------------------------------------
+    """
+
+    port_attr = "shutter_port"
+
+    def __init__(self, bench, port, timeout=None):
+        sim_serial_port.__init__(self, bench, port, timeout)
+        self.booted = bench.later(bench.latency["arduino_reset"])
+        self.last = None
+
+    def receive(self, byte):
+        if monotonic() < self.booted:
+            return
+        p = chr(byte)
+        if p == self.last:
+            return
+        self.last = p
+        ready = self.bench.later(self.bench.latency["shutter_reply"])
+        if p == "0":
+            self.bench.shutter = (self.bench.later(
+                self.bench.latency["shutter_travel"]), True)
+            self.reply(b"Open\r\n", ready)
+        elif p == "1":
+            self.bench.shutter = (monotonic(), False)
+            self.reply(b"Closed\r\n", ready)
+        elif p == "q":
+            self.reply(b"Shutter\r\n", ready)
+
+
+if __name__ == "__main__":
+    """
+    ----------------------------------------------------------------------------
+    Demo program to verify function:
+    1) Creates a bench running in real time.
+    2) Queries each VISA instrument and runs a short CV sweep.
+    3) Moves the monochromator and opens the shutter.
+    ----------------------------------------------------------------------------
+    """
+    bench = sim_bench()
+    for address in bench.rm.list_resources():
+        if "ASRL" in address:
+            continue
+        instr = bench.rm.open_resource(address)
+        for q in ("ID", "*IDN?"):
+            instr.write(q)
+        print(address, instr.read())
+        instr.close()
+
+    k4200 = bench.rm.open_resource("GPIB0::17::INSTR")
+    k4200.write(":CVU:SWEEP:DCV -1,1,0.5")
+    k4200.write(":CVU:TEST:RUN")
+    k4200.wait_for_srq()
+    print(k4200.query(":CVU:DATA:Z?"))
+
+    cm = bench.Serial("COM1")
+    cm.write(bytes([16, 0x15, 0x7C]))
+    print(list(cm.read(2)), bench.mono.position())
+    sh = bench.Serial("COM12")
+    sleep(bench.latency["arduino_reset"])
+    sh.write(b"0")
+    print(sh.read(6))
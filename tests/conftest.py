@@ -0,0 +1,5 @@
+import sys
+from os import path
+
+# the tests import the modules the way the notebooks do, as libs.<module>
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
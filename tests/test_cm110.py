@@ -0,0 +1,108 @@
+import pytest
+
+from libs import cm110
+
+
+class port(object):
+
+    """
+    A stand in for serial.Serial that hands back replies in the chunks they
+    are queued in, as a real port does when a reply arrives in pieces.
+    Anything in replies is queued one at a time as commands are written.
+    """
+
+    def __init__(self, **settings):
+        self.timeout = settings.get("timeout")
+        self.chunks = []
+        self.replies = []
+        self.reads = 0
+
+    def queue(self, *chunks):
+        self.chunks.extend(bytes(c) for c in chunks)
+
+    def inWaiting(self):
+        return len(self.chunks[0]) if self.chunks else 0
+
+    def read(self, size=1):
+        self.reads += 1
+        if not self.chunks:
+            return b""
+        data, rest = self.chunks[0][:size], self.chunks[0][size:]
+        if rest:
+            self.chunks[0] = rest
+        else:
+            self.chunks.pop(0)
+        return data
+
+    def write(self, data):
+        if self.replies:
+            self.queue(self.replies.pop(0))
+
+    def reset_input_buffer(self):
+        self.chunks = []
+
+    def close(self):
+        pass
+
+
+@pytest.fixture(params=[False, True], ids=["polled", "framed"])
+def mono(request, monkeypatch):
+    monkeypatch.setattr(cm110.mono, "poll", 0)
+    return cm110.mono("COM1", serial_class=port, framed=request.param,
+                      timeout=0.05)
+
+
+def data(value, status=0, cancel=cm110.CANCEL):
+    return cm110.DATA_FRAME.pack(value, status, cancel)
+
+
+def test_frame_split_across_reads(mono):
+    reply = data(5000) + data(6000)
+    mono.cm.queue(reply[:1], reply[1:5], reply[5:])
+    assert mono.read_frames(cm110.DATA_FRAME) == [(5000, 0, cm110.CANCEL)]
+    assert mono.read_hi_lo() == (6000, 0, cm110.CANCEL)
+    assert mono.pending == b""
+
+
+def test_part_frame_kept_after_timeout(mono):
+    reply = data(5000, 1)
+    mono.cm.queue(reply[:3])
+    assert mono.read_frames(cm110.DATA_FRAME) == []
+    assert mono.pending == reply[:3]
+    mono.cm.queue(reply[3:])
+    assert mono.read_frames(cm110.DATA_FRAME) == [(5000, 1, cm110.CANCEL)]
+    assert mono.pending == b""
+
+
+def test_several_frames_in_one_read(mono):
+    status = cm110.STATUS_FRAME.pack(0, cm110.CANCEL)
+    mono.cm.queue(status * 3)
+    assert mono.read_frames(cm110.STATUS_FRAME, 3) == [(0, 24)] * 3
+    assert mono.cm.reads == 1
+
+
+def test_garbled_reply_clears_pending(mono):
+    mono.cm.queue(data(5000, 0, cancel=5) + data(6000)[:2])
+    frames = mono.read_frames(cm110.DATA_FRAME)
+    assert frames == [(5000, 0, 5)]
+    assert mono.pending == b""
+    mono.cm.queue(data(5000, 0, cancel=5))
+    assert mono.read_hi_lo() == -1
+
+
+def test_garbled_frame_among_good_ones(mono):
+    mono.cm.queue(data(1) + data(2, cancel=0) + data(3))
+    assert len(mono.read_frames(cm110.DATA_FRAME, 3)) == 3
+    assert mono.pending == b""
+
+
+def test_echo_has_no_cancel_byte(mono):
+    mono.cm.replies.append(b"\x1b")
+    assert mono.echo() == "Echo test succesful"
+    assert mono.echo() == "No response recieved"
+
+
+def test_message_status(mono):
+    mono.cm.queue(cm110.STATUS_FRAME.pack(0, 0))
+    assert mono.message_status() == -1
+    assert mono.message_status() == -1
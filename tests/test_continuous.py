@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from libs import continuous
+
+
+def test_bin_samples_rising():
+    ws = [4000, 4049, 4051, 4100, 4149.9, 4180, 4200]
+    assert continuous.bin_samples(ws, 4000, 4200, 100) == [
+        (4000, [0, 1]), (4100, [2, 3, 4]), (4200, [5, 6])]
+
+
+def test_bin_samples_edge_bins():
+    # half a step either side of the range still belongs to its end bins
+    ws = [3940, 3951, 4000, 4249, 4251, 4300]
+    assert continuous.bin_samples(ws, 4000, 4200, 100) == [
+        (4000, [1, 2]), (4200, [3])]
+
+
+def test_bin_samples_partial_last_step():
+    # 4000 to 4250 in steps of 100 ends at 4200, as range() would
+    ws = [4200, 4240, 4260]
+    assert continuous.bin_samples(ws, 4000, 4250, 100) == [
+        (4200, [0, 1])]
+
+
+def test_bin_samples_falling():
+    ws = [7010, 7000, 6960, 6940, 6900, 6876, 6874]
+    assert continuous.bin_samples(ws, 7000, 6900, -50) == [
+        (7000, [0, 1]), (6950, [2, 3]), (6900, [4, 5])]
+
+
+def test_bin_samples_first_reached_order_and_gaps():
+    ws = [4200, 4000, 4210, 3990]
+    assert continuous.bin_samples(ws, 4000, 4200, 100) == [
+        (4200, [0, 2]), (4000, [1, 3])]
+    assert continuous.bin_samples([], 4000, 4200, 100) == []
+
+
+def test_scan_clock_clips_to_range():
+    clock = continuous.scan_clock(4000, 5000, 100)
+    clock.begin(10.0)
+    assert clock.duration == pytest.approx(10.0)
+    ws = clock.wavelength([5.0, 10.0, 12.5, 20.0, 30.0])
+    assert np.allclose(ws, [4000, 4000, 4250, 5000, 5000])
+
+
+def test_scan_clock_uses_measured_duration():
+    clock = continuous.scan_clock(5000, 4000, 100)
+    clock.begin(0.0)
+    clock.finish(20.0)
+    assert clock.duration == pytest.approx(20.0)
+    assert clock.wavelength(5.0) == pytest.approx(4750)
+    assert clock.deadline() == pytest.approx(30.0)
+    # a reply that arrives before the scan began is ignored
+    clock.finish(-1.0)
+    assert clock.duration == pytest.approx(clock.nominal)
+
+
+def test_scan_clock_speed_must_be_positive():
+    with pytest.raises(ValueError):
+        continuous.scan_clock(4000, 5000, 0)
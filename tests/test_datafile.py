@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from libs import datafile
+
+
+def test_columns_round_trip(tmp_path):
+    filename = str(tmp_path / "data.cvw")
+    arrays = {"wavelength": np.arange(4000, 4100, 10),
+              "primary": np.random.RandomState(0).normal(size=(10, 3)),
+              "count": np.arange(30, dtype=np.int32).reshape(10, 3),
+              "flags": np.array([True, False, True])}
+    metadata = {"mode": "cv", "voltages": [-1.0, 0.0, 1.0]}
+    datafile.write_columns(filename, arrays, metadata)
+
+    f = datafile.column_file(filename)
+    assert f.metadata == metadata
+    assert sorted(f.keys()) == sorted(arrays)
+    assert "primary" in f and "secondary" not in f
+    for name, a in arrays.items():
+        column = f[name]
+        assert isinstance(column, np.memmap)
+        assert column.dtype == a.dtype and column.shape == a.shape
+        assert np.array_equal(column, a)
+        assert column.offset % datafile.COLUMN_ALIGN == 0
+    assert np.array_equal(f["primary"][2:5, 1], arrays["primary"][2:5, 1])
+    assert not isinstance(f.load("primary"), np.memmap)
+    assert not (tmp_path / "data.cvw.part").exists()
+
+
+def test_columns_big_endian_and_empty(tmp_path):
+    filename = str(tmp_path / "data.cvw")
+    big = np.arange(5, dtype=">f8")
+    datafile.write_columns(filename, {"big": big, "empty": np.zeros((0, 3))})
+    f = datafile.column_file(filename)
+    assert f.metadata == {}
+    assert f["big"].dtype == np.dtype("<f8")
+    assert np.array_equal(f["big"], big)
+    assert f["empty"].shape == (0, 3)
+
+
+def test_columns_replace_existing_file(tmp_path):
+    filename = str(tmp_path / "data.cvw")
+    datafile.write_columns(filename, {"a": np.ones(100)})
+    datafile.write_columns(filename, {"a": np.zeros(2)})
+    assert np.array_equal(datafile.column_file(filename)["a"], [0, 0])
+
+
+def test_not_a_column_file(tmp_path):
+    filename = tmp_path / "data.csv"
+    filename.write_text("Wavelengths (A),-1.0 V\n")
+    with pytest.raises(ValueError):
+        datafile.column_file(str(filename))
@@ -0,0 +1,117 @@
+import pytest
+
+from libs import ki4200
+
+
+CV = [":CVU:RESET", ":CVU:MODE 1", ":CVU:MODEL 2", ":CVU:SPEED 1",
+      ":CVU:ACV 0.03", ":CVU:SOAK:DCV 0", ":CVU:ACZ:RANGE 0",
+      ":CVU:CORRECT 0,0,0", ":CVU:LENGTH 1.5", ":CVU:STANDBY 1",
+      ":CVU:DELAY:SWEEP 0", ":CVU:FREQ 1E6", ":CVU:SWEEP:DCV -1,1,0.1"]
+
+IV = ["DE", "DR1", "CH1;CH2", "CH1,'VA','IA',1,1", "CH2,'VC','IC',3,3",
+      "SS", "VR1,-1,1,0.1,0.01", "DT 0", "IT 2", "RS 5", "RG 1, 1e-9",
+      "SM DM2", "LI 'VA','IA'", "MD"]
+
+
+class instrument(object):
+
+    def __init__(self, fail_at=None):
+        self.written = []
+        self.fail_at = fail_at
+
+    def write(self, command):
+        if len(self.written) == self.fail_at:
+            raise IOError("write failed")
+        self.written.append(command)
+
+
+def uploaded(commands):
+    state = ki4200.kxci_state()
+    state.upload(instrument(), commands)
+    return state
+
+
+def replace(commands, old, new):
+    return [new if c == old else c for c in commands]
+
+
+def test_page_of():
+    assert ki4200.page_of("SM DM2") == "SM"
+    assert ki4200.page_of("DE") == "DE"
+    assert ki4200.page_of("DR1") is None
+    assert ki4200.page_of(":CVU:RESET") is None
+
+
+def test_empty_mirror_sends_everything():
+    assert ki4200.kxci_state().plan(CV) == CV
+    assert ki4200.kxci_state().plan(IV) == IV
+
+
+def test_nothing_changed_sends_nothing():
+    assert uploaded(CV).plan(CV) == []
+    assert uploaded(IV).plan(IV) == []
+
+
+def test_only_changed_cvu_commands_are_sent():
+    new = replace(CV, ":CVU:FREQ 1E6", ":CVU:FREQ 1E5")
+    new = replace(new, ":CVU:ACV 0.03", ":CVU:ACV 0.05")
+    assert uploaded(CV).plan(new) == [":CVU:ACV 0.05", ":CVU:FREQ 1E5"]
+
+
+def test_sweep_commands_share_one_setting():
+    new = replace(CV, ":CVU:SWEEP:DCV -1,1,0.1", ":CVU:SWEEP:FREQ 1E4,1E6")
+    assert uploaded(CV).plan(new) == [":CVU:SWEEP:FREQ 1E4,1E6"]
+
+
+def test_reset_sent_when_old_settings_would_survive():
+    state = uploaded(CV)
+    state.record(":CVU:DCV 2")
+    send = state.plan(CV)
+    assert send == CV
+
+
+def test_reset_sent_before_first_reset():
+    state = ki4200.kxci_state()
+    for c in CV[1:]:
+        state.record(c)
+    assert state.plan(CV) == [":CVU:RESET"] + CV[1:]
+
+
+def test_whole_page_sent_when_one_item_changes():
+    new = replace(IV, "DT 0", "DT 0.5")
+    assert uploaded(IV).plan(new) == [
+        "SS", "VR1,-1,1,0.1,0.01", "DT 0.5", "IT 2", "RS 5", "RG 1, 1e-9",
+        "MD"]
+
+
+def test_last_page_reselected():
+    state = uploaded(IV)
+    state.record("SS")
+    assert state.plan(IV) == ["MD"]
+
+
+def test_upload_records_what_was_sent():
+    state = uploaded(IV)
+    device = instrument()
+    new = replace(IV, "SM DM2", "SM DM1")
+    assert state.upload(device, new) == ["SM DM1", "LI 'VA','IA'", "MD"]
+    assert device.written == ["SM DM1", "LI 'VA','IA'", "MD"]
+    assert state.plan(new) == []
+
+
+def test_failed_upload_forgets_everything():
+    state = uploaded(CV)
+    device = instrument(fail_at=1)
+    new = replace(CV, ":CVU:FREQ 1E6", ":CVU:FREQ 1E5")
+    new = replace(new, ":CVU:MODEL 2", ":CVU:MODEL 3")
+    with pytest.raises(IOError):
+        state.upload(device, new)
+    assert device.written == [":CVU:MODEL 3"]
+    assert state.settings == {}
+    assert state.plan(new) == new
+
+
+def test_state_of_is_kept_on_the_session():
+    device = instrument()
+    state = ki4200.state_of(device)
+    assert ki4200.state_of(device) is state
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from libs import planner
+
+
+def step(w):
+    return [1.0 if w >= 537 else 0.0, 2.0]
+
+
+def scan(plan, spectrum=step):
+    passes = []
+    while True:
+        ws = plan.next_pass()
+        if not ws:
+            return passes
+        passes.append(ws)
+        for w in ws:
+            plan.record(w, spectrum(w))
+
+
+def test_first_pass_is_coarse_grid():
+    plan = planner.scan_planner(400, 700, 50)
+    assert plan.next_pass() == [400, 450, 500, 550, 600, 650, 700]
+
+
+@pytest.mark.parametrize("method", ["gradient", "curvature"])
+def test_refines_around_step(method):
+    plan = planner.scan_planner(400, 700, 50, fine_step=5, method=method)
+    passes = scan(plan)
+    refined = [w for ws in passes[1:] for w in ws]
+    assert refined
+    assert all(450 <= w <= 600 for w in refined)
+    w = np.array(sorted(plan.values))
+    assert np.diff(w).min() >= 5
+    # the step ends up bracketed as finely as fine_step allows
+    below = w[w < 537].max()
+    above = w[w >= 537].min()
+    assert above - below < 10
+
+
+def test_flat_spectrum_is_not_refined():
+    plan = planner.scan_planner(400, 700, 50)
+    assert len(scan(plan, lambda w: [3.0])) == 1
+    assert len(plan) == 7
+
+
+def test_max_points_splits_largest_change_first():
+    def spectrum(w):
+        return [0.0 if w < 500 else 0.2 if w < 600 else 1.0]
+    plan = planner.scan_planner(400, 700, 100, max_points=5)
+    scan(plan, spectrum)
+    assert len(plan) == 5
+    assert 550 in plan.values and 450 not in plan.values
+
+
+def test_unknown_method():
+    with pytest.raises(ValueError):
+        planner.scan_planner(400, 700, 50, method="spline")
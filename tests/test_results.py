@@ -0,0 +1,158 @@
+import numpy as np
+import pytest
+
+from libs import results
+
+
+def sweeps(n=20, points=4, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.normal(5.0, 0.5, (n, points))
+
+
+def test_running_stats_match_numpy():
+    x = sweeps()
+    s = results.running_stats(x.shape[1])
+    for sweep in x:
+        s.add(sweep)
+    assert np.array_equal(s.count, [len(x)] * x.shape[1])
+    assert np.allclose(s.mean, x.mean(axis=0))
+    assert np.allclose(s.std, x.std(axis=0, ddof=1))
+    assert np.allclose(s.sem, x.std(axis=0, ddof=1) / np.sqrt(len(x)))
+
+
+def test_running_stats_skip_nan():
+    x = sweeps(10, 3)
+    x[2, 1] = x[7, 1] = np.nan
+    s = results.running_stats(3)
+    for sweep in x:
+        s.add(sweep)
+    assert list(s.count) == [10, 8, 10]
+    assert np.allclose(s.mean, np.nanmean(x, axis=0))
+    assert np.allclose(s.std, np.nanstd(x, axis=0, ddof=1))
+
+
+def test_running_stats_single_reading_has_no_spread():
+    s = results.running_stats(2)
+    s.add([1.0, 2.0])
+    assert np.allclose(s.mean, [1.0, 2.0])
+    assert np.all(np.isnan(s.std))
+
+
+def test_online_rejection_drops_outlier():
+    s = results.running_stats(1, sigma=3)
+    for x in [1.0, 1.1, 0.9, 1.05, 0.95]:
+        s.add([x])
+    assert not s.add([50.0])[0]
+    assert s.count[0] == 5 and s.rejected[0] == 1
+    assert np.allclose(s.mean, [1.0])
+
+
+def test_clip_matches_numpy():
+    x = sweeps(12, 2, seed=1)
+    x[3, 0] = 40.0
+    x[8, 1] = -30.0
+    s = results.running_stats(2, keep=len(x))
+    for sweep in x:
+        s.add(sweep)
+    s.clip(sigma=2.5)
+
+    use = np.ones_like(x, dtype=bool)
+    for i in range(5):
+        masked = np.where(use, x, np.nan)
+        mean = np.nanmean(masked, axis=0)
+        std = np.nanstd(masked, axis=0, ddof=1)
+        keep = np.abs(x - mean) <= 2.5 * std
+        if (use & keep).sum() == use.sum():
+            break
+        use &= keep
+    clipped = np.where(use, x, np.nan)
+    assert list(s.rejected) == [1, 1]
+    assert np.allclose(s.mean, np.nanmean(clipped, axis=0))
+    assert np.allclose(s.std, np.nanstd(clipped, axis=0, ddof=1))
+
+
+def test_clip_keeps_last_sweeps_only():
+    s = results.running_stats(1, keep=3)
+    for x in range(6):
+        s.add([float(x)])
+    assert s.raw[:, 0].tolist() == [3.0, 4.0, 5.0]
+
+
+def test_sweep_results_streams_repetitions():
+    x = sweeps(3, 4)
+    r = results.sweep_results(2, 3)
+    for sweep in x:
+        r.add_repetition(sweep, 295.0, 80.0, -45.0)
+    assert r.finish() == 0
+    assert r.raw_primary is None
+    assert np.allclose(r.primary, [x.mean(axis=0)])
+    assert np.allclose(r.primary_sem, [x.std(axis=0, ddof=1) / np.sqrt(3)])
+    assert list(r.used_repetitions) == [3]
+    assert np.allclose(r.temperature, [295.0])
+
+
+def test_sweep_results_keep_raw_and_grow():
+    r = results.sweep_results(1, 2, keep_raw=True)
+    for i in range(3):
+        r.add([[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]],
+              [295] * 3, [80] * 3, [-45] * 3)
+    assert len(r) == 3 and r.wsteps >= 3 and r.repetitions == 3
+    assert np.allclose(r.primary, [[3.0, 4.0]] * 3)
+    assert np.allclose(r.raw_primary[2, :, 1], [2.0, 4.0, 6.0])
+
+
+def test_sweep_results_spot_values_are_1d():
+    r = results.sweep_results(2, 2)
+    r.add([1.0, 3.0], [295] * 2, [80] * 2, [-45] * 2)
+    assert r.primary.shape == (1,)
+    assert r.primary[0] == pytest.approx(2.0)
+
+
+def repeat(rule, values):
+    taken = []
+    for i in rule:
+        taken.append(values[i])
+        rule.add(primary=values[i], magnitude=np.negative(values[i]))
+    return taken
+
+
+def test_repeat_rule_fixed_count():
+    rule = results.repeat_rule(4)
+    assert repeat(rule, list(range(10))) == [0, 1, 2, 3]
+    assert rule.done and np.isnan(rule.error)
+
+
+def test_repeat_rule_stops_at_target():
+    values = [[1.0, 2.0], [1.01, 2.02], [0.99, 1.98], [1.0, 2.0]] + \
+             [[5.0, 9.0]] * 6
+    rule = results.repeat_rule(3, target=0.01)
+    taken = repeat(rule, values)
+    assert len(taken) == 2 and rule.n == 2
+    sem = np.std(taken, axis=0, ddof=1) / np.sqrt(2)
+    assert rule.error == pytest.approx(sem.max() / 2.01)
+    assert rule.error <= 0.01
+
+
+def test_repeat_rule_absolute_target():
+    values = [[1.0], [1.5], [1.0], [1.5], [1.0], [1.5]]
+    rule = results.repeat_rule(3, target=0.2, relative=False, maximum=6)
+    taken = repeat(rule, values)
+    assert len(taken) == 3
+    assert np.std(taken, ddof=1) / np.sqrt(3) <= 0.2
+
+
+def test_repeat_rule_stops_at_maximum():
+    rng = np.random.RandomState(2)
+    values = rng.normal(1.0, 1.0, (20, 3))
+    rule = results.repeat_rule(3, target=1e-6, minimum=3, maximum=7)
+    assert len(repeat(rule, values)) == 7
+    assert rule.error > 1e-6
+
+
+def test_repeat_rule_watches_magnitude():
+    values = [[1.0], [1.0], [1.0]]
+    rule = results.repeat_rule(3, target=0.01, of="magnitude")
+    repeat(rule, values)
+    assert rule.n == 2 and rule.error == 0
+    with pytest.raises(ValueError):
+        results.repeat_rule(3, of="phase")